@@ -5,22 +5,889 @@
 
 import sys
 import os
-from datetime import datetime
+import re
+import argparse
+import statistics
+import json
+import time
+import base64
+import hashlib
+import io
+import uuid
+import queue
+import threading
+import heapq
+import itertools
+import unicodedata
+import mimetypes
+import tempfile
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, timedelta
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QVBoxLayout, QWidget,
-    QTextEdit, QSplitter, QStyleFactory, QPushButton, QHBoxLayout, 
-    QScrollArea, QLabel, QFrame
+    QTextEdit, QSplitter, QStyleFactory, QPushButton, QHBoxLayout,
+    QScrollArea, QLabel, QFrame, QFileDialog, QMessageBox, QTabWidget, QShortcut,
+    QDialog, QDialogButtonBox, QFormLayout, QDateEdit, QComboBox, QCheckBox
 )
-from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEngineProfile, QWebEnginePage
-from PyQt5.QtCore import QUrl, Qt, QByteArray, QBuffer, QIODevice, QTimer, QPropertyAnimation, QEasingCurve
-from PyQt5.QtGui import QFont, QPalette, QColor
+from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEngineProfile, QWebEnginePage, QWebEngineScript
+from PyQt5.QtCore import (
+    QUrl, Qt, QByteArray, QBuffer, QIODevice, QTimer, QPropertyAnimation, QEasingCurve,
+    QObject, pyqtSignal, pyqtSlot, pyqtProperty, QFileSystemWatcher, QEvent, QFile, QDate
+)
+from PyQt5.QtWebChannel import QWebChannel
+from PyQt5.QtGui import QFont, QPalette, QColor, QCursor, QKeySequence, QTextDocument
+
+# 页面桥接脚本：在文档创建时注入一次，之后所有页面操作都通过 window.__mlb 上预注册的函数完成，
+# Python 端只传 JSON 参数，不再拼接脚本源码
+PAGE_BRIDGE_JS = r"""
+(function() {
+    if (window.__mlb) return;
+    const mlb = {};
+
+    // 输入框选择器
+    const inputSelectors = [
+        'textarea[data-testid="chat_input_input"]',
+        'textarea.semi-input-textarea',
+        'textarea[placeholder*="发消息"]',
+        'textarea',
+        '[contenteditable="true"]',
+        '.chat-input',
+        '[class*="input"] textarea'
+    ];
+
+    // 发送按钮选择器
+    const sendSelectors = [
+        'button[type="submit"]',
+        'button[class*="send"]',
+        '.send-button',
+        'button[aria-label*="发送"]',
+        'button[data-testid*="send"]',
+        'button.semi-button'
+    ];
+
+    // 文件输入选择器
+    const fileSelectors = [
+        'input[type="file"]',
+        'input[accept*="image"]',
+        'input[data-testid*="upload"]',
+        'input[data-testid*="file"]',
+        'input.semi-upload-input',
+        'input[class*="upload"]',
+        'input[class*="file"]',
+        '.upload-button input',
+        '[class*="attachment"] input',
+        '[class*="file-input"]'
+    ];
+
+    // 用户消息选择器
+    const userSelectors = [
+        '[data-role="user-message"]',
+        '[class*="user"]',
+        '[class*="role-user"]',
+        '[class*="msg-bubble"]',
+        '[class*="message"]',
+        '[data-testid*="message"]',
+        'div[class*="chat"] > div',
+        '.markdown-body',
+        'p', 'span', 'div'
+    ];
+
+    // 机器人消息选择器
+    const msgSelectors = [
+        'div[data-testid="message_text_content"]',
+        'div.msg-bubble',
+        'div[class*="message-content"]',
+        'div[class*="markdown-body"]',
+        'div[class*="chat-message"]',
+        '.markdown-body',
+        '[class*="assistant"] > div',
+        '[data-role*="assistant"]'
+    ];
+
+    // 回复进行中的停止按钮选择器
+    const stopSelectors = [
+        'button[data-testid*="stop"]',
+        'button[aria-label*="停止"]',
+        'button[class*="stop"]',
+        'button[class*="abort"]'
+    ];
+
+    // 站点选择器配置：window.__mlbSelectors 中的同名列表排在内置列表之前
+    const custom = function(name) {
+        const profile = window.__mlbSelectors;
+        return (profile && profile[name]) || [];
+    };
+    const pick = function(name, defaults) {
+        return custom(name).concat(defaults);
+    };
+
+    const first = function(selectors, accept) {
+        for (let sel of selectors) {
+            const els = document.querySelectorAll(sel);
+            for (let el of els) {
+                if (!accept || accept(el)) {
+                    return { el: el, sel: sel };
+                }
+            }
+        }
+        return null;
+    };
+
+    // 填充输入框并点击发送；large 为 true 时只派发一次 input 事件，避免页面框架多次重渲染
+    mlb.sendText = function(text, large) {
+        const hit = first(pick('input', inputSelectors));
+        if (!hit) {
+            console.log('❌ 未找到输入框');
+            return false;
+        }
+        console.log('✅ 找到输入框:', hit.sel);
+        if (window.__mlbStream) {
+            window.__mlbStream.baseline = window.__mlbStream.seq;
+        }
+        const ta = hit.el;
+        ta.focus();
+        if (ta instanceof HTMLTextAreaElement) {
+            const nativeSetter = Object.getOwnPropertyDescriptor(HTMLTextAreaElement.prototype, 'value').set;
+            nativeSetter.call(ta, text);
+        } else {
+            // contenteditable 编辑器：通过编辑命令插入，让页面框架感知到输入
+            document.execCommand('selectAll', false, null);
+            document.execCommand('insertText', false, text);
+        }
+        const events = large ? ['input'] : ['input', 'change', 'keyup', 'keydown'];
+        events.forEach(evt => {
+            ta.dispatchEvent(new Event(evt, { bubbles: true, composed: true }));
+        });
+        setTimeout(() => {
+            const btn = first(pick('send', sendSelectors));
+            if (btn) {
+                console.log('✅ 找到发送按钮:', btn.sel);
+                btn.el.click();
+                console.log('✅ 点击发送按钮');
+            } else {
+                console.log('❌ 未找到发送按钮');
+            }
+        }, 300);
+        return true;
+    };
+
+    // 检测用户消息是否已出现在页面上
+    mlb.hasUserMessage = function(text) {
+        try {
+            const needle = text.substring(0, 50);
+            const hit = first(pick('user', userSelectors), el => {
+                const txt = el.textContent.trim();
+                return txt && txt.includes(needle);
+            });
+            if (hit) {
+                console.log('✅ 找到用户消息(选择器):', hit.sel);
+                return true;
+            }
+            if (document.body.textContent.includes(needle)) {
+                console.log('✅ 找到用户消息(全局搜索)');
+                return true;
+            }
+            return false;
+        } catch (error) {
+            console.error('❌ 检测用户消息异常:', error);
+            return false;
+        }
+    };
+
+    // 回复 DOM → Markdown 增量序列化：已序列化的子树按节点缓存，
+    // MutationObserver 只让发生变化的节点及其祖先失效
+    let mdCache = new WeakMap();
+    let observedRoot = null;
+    let lastMutation = Date.now();
+    const observer = new MutationObserver(records => {
+        lastMutation = Date.now();
+        for (let rec of records) {
+            let node = rec.target;
+            while (node) {
+                mdCache.delete(node);
+                if (node === observedRoot) break;
+                node = node.parentNode;
+            }
+        }
+    });
+    const observe = function(root) {
+        if (observedRoot === root) return;
+        observer.disconnect();
+        mdCache = new WeakMap();
+        observedRoot = root;
+        lastMutation = Date.now();
+        observer.observe(root, { childList: true, subtree: true, characterData: true });
+    };
+
+    const inline = function(node) {
+        return serializeChildren(node).replace(/\s*\n\s*/g, ' ').trim();
+    };
+
+    const serializeChildren = function(node) {
+        let out = '';
+        for (let child of node.childNodes) {
+            out += serialize(child);
+        }
+        return out;
+    };
+
+    const serializeList = function(node, ordered) {
+        let out = '';
+        let index = 1;
+        for (let item of node.children) {
+            if (item.tagName !== 'LI') continue;
+            const marker = ordered ? (index++) + '. ' : '- ';
+            const body = serializeChildren(item).trim().replace(/\n/g, '\n  ');
+            out += marker + body + '\n';
+        }
+        return out + '\n';
+    };
+
+    const serializeTable = function(node) {
+        const rows = Array.from(node.querySelectorAll('tr'));
+        if (rows.length === 0) return '';
+        let out = '';
+        rows.forEach((row, i) => {
+            const cells = Array.from(row.children).map(c => inline(c).replace(/\|/g, '\\|'));
+            out += '| ' + cells.join(' | ') + ' |\n';
+            if (i === 0) {
+                out += '|' + cells.map(() => ' --- ').join('|') + '|\n';
+            }
+        });
+        return out + '\n';
+    };
+
+    const serializeElement = function(el) {
+        const tag = el.tagName;
+        switch (tag) {
+            case 'H1': case 'H2': case 'H3': case 'H4': case 'H5': case 'H6':
+                return '#'.repeat(Number(tag[1])) + ' ' + inline(el) + '\n\n';
+            case 'P':
+                return inline(el) + '\n\n';
+            case 'BR':
+                return '\n';
+            case 'HR':
+                return '---\n\n';
+            case 'STRONG': case 'B':
+                return '**' + serializeChildren(el) + '**';
+            case 'EM': case 'I':
+                return '*' + serializeChildren(el) + '*';
+            case 'CODE':
+                return '`' + el.textContent + '`';
+            case 'PRE': {
+                const code = el.querySelector('code') || el;
+                const m = (code.className + ' ' + el.className).match(/(?:language|lang)-([\w+#-]+)/);
+                return '```' + (m ? m[1] : '') + '\n' + code.textContent.replace(/\n$/, '') + '\n```\n\n';
+            }
+            case 'UL':
+                return serializeList(el, false);
+            case 'OL':
+                return serializeList(el, true);
+            case 'TABLE':
+                return serializeTable(el);
+            case 'BLOCKQUOTE':
+                return serializeChildren(el).trim().split('\n').map(l => '> ' + l).join('\n') + '\n\n';
+            case 'A':
+                return '[' + inline(el) + '](' + (el.getAttribute('href') || '') + ')';
+            case 'IMG':
+                return '![' + (el.getAttribute('alt') || '') + '](' + (el.getAttribute('src') || '') + ')';
+            case 'SCRIPT': case 'STYLE': case 'BUTTON': case 'svg': case 'SVG':
+                return '';
+            default:
+                return serializeChildren(el);
+        }
+    };
+
+    const serialize = function(node) {
+        if (node.nodeType === Node.TEXT_NODE) {
+            return node.nodeValue;
+        }
+        if (node.nodeType !== Node.ELEMENT_NODE) {
+            return '';
+        }
+        const cached = mdCache.get(node);
+        if (cached !== undefined) return cached;
+        const md = serializeElement(node);
+        mdCache.set(node, md);
+        return md;
+    };
+
+    mlb.replyMarkdown = function(el) {
+        observe(el);
+        return serialize(el).replace(/\n{3,}/g, '\n\n').trim();
+    };
+
+    // 已推送给 Python 的回复文本。Markdown 会随回复增长被改写（代码块收尾、表格分隔行、
+    // 列表重新编号），只有新文本以它开头时才能发增量，否则整体替换
+    let streamed = '';
+
+    // 定位页面上最后一条机器人消息并序列化为 Markdown；没有机器人消息时返回 null
+    const domReply = function(probe) {
+        let msgs = [];
+        let tuned = false;
+        const tunedSelectors = custom('message');
+        for (let sel of tunedSelectors.concat(msgSelectors)) {
+            const found = document.querySelectorAll(sel);
+            if (found && found.length > 0) {
+                msgs = Array.from(found);
+                tuned = tunedSelectors.includes(sel);
+                break;
+            }
+        }
+        if (msgs.length === 0) {
+            return null;
+        }
+
+        const lastMsg = msgs[msgs.length - 1];
+        const cls = lastMsg.className || '';
+        const role = lastMsg.getAttribute('data-role') || '';
+        // 站点配置的回复选择器命中即视为机器人消息
+        probe.hasBot = tuned ||
+                       cls.includes('assistant') ||
+                       cls.includes('bot') ||
+                       cls.includes('markdown-body') ||
+                       role.includes('assistant');
+        if (!probe.hasBot) {
+            return null;
+        }
+        const text = mlb.replyMarkdown(lastMsg);
+        probe.idleMs = Date.now() - lastMutation;
+        return text;
+    };
+
+    // 采集回复状态信号，由 Python 端的判定策略决定是否完成；
+    // withText 为 false 时只返回长度，减少跨进程传输；since >= 0 表示需要流式内容，值为上次返回的 streamedLength
+    // （0 表示新消息），附带 replyDelta（追加）或 replyReplace（全文替换）；长度一律按 JS 字符串（UTF-16 码元）计，
+    // Python 端不自行计算，否则回复中出现 emoji 等增补平面字符后两边永远对不上；
+    // markerSelector 为结束标记选择器（可为 null）；netCapture 为 true 且捕获到本轮回复流时，
+    // 回复正文直接取自网络流（fromNetwork），不再序列化 DOM，并附带流是否已结束（netDone）
+    mlb.checkResponse = function(withText, since, markerSelector, netCapture) {
+        try {
+            const stopBtn = document.querySelector(pick('stop', stopSelectors).join(', '));
+            const stream = window.__mlbStream;
+            const probe = {
+                stopVisible: !!(stopBtn && stopBtn.offsetParent !== null),
+                hasBot: false,
+                replyLength: 0,
+                idleMs: 0,
+                openStreams: stream ? stream.open : -1,
+                closedStreams: stream ? stream.closed : -1,
+                markerCount: markerSelector ? document.querySelectorAll(markerSelector).length : 0
+            };
+            // 本轮回复流已收到文本时以它为正文（站点下发的原始 Markdown），未捕获到时回退为 DOM
+            const entry = (netCapture && stream) ? stream.current() : null;
+            let text;
+            if (entry && entry.text) {
+                text = entry.text;
+                probe.hasBot = true;
+                probe.fromNetwork = true;
+                probe.netDone = entry.done;
+                probe.idleMs = Date.now() - entry.updated;
+            } else {
+                text = domReply(probe);
+                if (text === null) {
+                    return probe;
+                }
+            }
+            probe.replyLength = text.length;
+            if (withText) {
+                probe.replyText = text;
+            }
+            if (since >= 0) {
+                if (since === 0) streamed = '';
+                if (since === streamed.length && text.startsWith(streamed)) {
+                    if (text.length > streamed.length) {
+                        probe.replyDelta = text.slice(streamed.length);
+                    }
+                } else if (text !== streamed || since !== streamed.length) {
+                    probe.replyReplace = text;
+                }
+                streamed = text;
+                probe.streamedLength = streamed.length;
+            }
+            return probe;
+        } catch (error) {
+            console.error('❌ 检查回复异常:', error);
+            return null;
+        }
+    };
+
+    // 将 base64 数据作为文件放入页面的文件输入控件
+    mlb.attachFile = function(base64, name, mime) {
+        try {
+            const byteString = atob(base64);
+            const ia = new Uint8Array(byteString.length);
+            for (let i = 0; i < byteString.length; i++) {
+                ia[i] = byteString.charCodeAt(i);
+            }
+            const file = new File([ia], name, { type: mime });
+
+            const hit = first(pick('file', fileSelectors), el => !el.disabled);
+            if (!hit) {
+                console.log('⚠️ 未找到文件输入，继续执行但不影响文字发送');
+                return false;
+            }
+            console.log('✅ 找到文件输入:', hit.sel);
+            const dt = new DataTransfer();
+            dt.items.add(file);
+            hit.el.files = dt.files;
+            ['change', 'input'].forEach(eventType => {
+                hit.el.dispatchEvent(new Event(eventType, { bubbles: true, cancelable: true }));
+            });
+            console.log('✅ 截图上传成功');
+            return true;
+        } catch (error) {
+            console.error('❌ 截图上传异常:', error);
+            return false;
+        }
+    };
+
+    // 从本地附件服务并行拉取多个文件放入文件输入控件；文件内容不经过脚本字面量。
+    // 结果经 WebChannel 回报 'ok' / 'failed' / 'blocked'（fetch 在网络层被拒，多为站点 CSP
+    // 的 connect-src 不允许访问本机端口），没有 WebChannel 时请求 doneUrl（ok=1 成功，ok=0 失败）
+    mlb.attachUrls = function(files, batch, doneUrl) {
+        const hit = first(pick('file', fileSelectors), el => !el.disabled);
+        if (!hit) {
+            console.log('⚠️ 未找到文件输入，附件未上传');
+            return false;
+        }
+        const report = function(status) {
+            const store = window.__mlbPayloads;
+            if (store) {
+                store.report_attached(batch, status);
+            } else {
+                fetch(doneUrl + '?ok=' + (status === 'ok' ? 1 : 0)).catch(() => {});
+            }
+        };
+        Promise.all(files.map(f => fetch(f.url).then(resp => {
+            if (!resp.ok) throw new Error(f.name + ': HTTP ' + resp.status);
+            return resp.blob();
+        }, error => {
+            error.blocked = true;
+            throw error;
+        }).then(blob => new File([blob], f.name, { type: f.mime || blob.type })))).then(list => {
+            const dt = new DataTransfer();
+            list.forEach(file => dt.items.add(file));
+            hit.el.files = dt.files;
+            ['change', 'input'].forEach(eventType => {
+                hit.el.dispatchEvent(new Event(eventType, { bubbles: true, cancelable: true }));
+            });
+            console.log('✅ 附件上传成功:', list.length);
+            report('ok');
+        }).catch(error => {
+            console.error('❌ 附件上传异常:', error);
+            report(error.blocked ? 'blocked' : 'failed');
+        });
+        return true;
+    };
+
+    // 限流信号只来自 HTTP 429 响应和错误/提示类节点，不看回复正文
+    const alertSelectors = [
+        '[role="alert"]',
+        '[class*="toast"]',
+        '[class*="Toast"]',
+        '[class*="notification"]',
+        '[class*="error"]'
+    ];
+    let throttledResponses = 0;
+    const sameSite = function(url) {
+        try {
+            const host = new URL(url, location.href).hostname;
+            const base = location.hostname.split('.').slice(-2).join('.');
+            return host === base || host.endsWith('.' + base);
+        } catch (e) {
+            return false;
+        }
+    };
+    const countStatus = function(status, url) {
+        if (status === 429 && sameSite(url)) throttledResponses++;
+    };
+    if (window.fetch) {
+        const origFetch = window.fetch;
+        window.fetch = function() {
+            return origFetch.apply(this, arguments).then(resp => {
+                countStatus(resp.status, resp.url);
+                return resp;
+            });
+        };
+    }
+    const origXhrSend = XMLHttpRequest.prototype.send;
+    XMLHttpRequest.prototype.send = function() {
+        this.addEventListener('loadend', () => countStatus(this.status, this.responseURL));
+        return origXhrSend.apply(this, arguments);
+    };
+
+    // 返回上次调用以来的 429 次数，以及含限流文案的可见提示节点文本（不在消息节点内）
+    mlb.throttleSignal = function(patterns) {
+        const responses = throttledResponses;
+        throttledResponses = 0;
+        const lowered = patterns.map(p => p.toLowerCase());
+        const inMessage = pick('message', msgSelectors).join(', ');
+        let notice = null;
+        for (let el of document.querySelectorAll(pick('alert', alertSelectors).join(', '))) {
+            if (el.offsetParent === null || el.closest(inMessage)) continue;
+            const text = (el.innerText || '').trim().slice(0, 200);
+            if (lowered.some(p => text.toLowerCase().includes(p))) {
+                notice = text;
+                break;
+            }
+        }
+        return { responses: responses, notice: notice };
+    };
+
+    // 大段参数不进入脚本源码：Python 端先把内容放进 WebChannel 上的 mlbPayloads，
+    // 这里按 ID 取回后调用 funcName(内容, ...args)，结果经 report 异步回报
+    mlb.withPayload = function(id, funcName, args) {
+        const store = window.__mlbPayloads;
+        if (!store || typeof mlb[funcName] !== 'function') return false;
+        store.take(id, function(payload) {
+            let ok = false;
+            try {
+                ok = !!mlb[funcName].apply(null, [payload].concat(args));
+            } catch (error) {
+                console.error('❌ 调用异常:', error);
+            }
+            store.report(id, ok);
+        });
+        return true;
+    };
+
+    window.__mlb = mlb;
+})();
+"""
+
+# WebChannel 初始化：qt.webChannelTransport 可能晚于文档创建脚本就绪，稍后重试
+CHANNEL_INIT_JS = r"""
+(function() {
+    let tries = 0;
+    const connect = function() {
+        if (typeof qt === 'undefined' || !qt.webChannelTransport) {
+            if (++tries < 100) setTimeout(connect, 50);
+            return;
+        }
+        new QWebChannel(qt.webChannelTransport, function(channel) {
+            window.__mlbPayloads = channel.objects.mlbPayloads;
+        });
+    };
+    connect();
+})();
+"""
+
+# 离线模拟聊天页面：保留 chat_input_input、message_text_content、停止按钮和 semi-upload-input 等结构
+MOCK_CHAT_HTML = r"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<title>Mock Chat</title>
+<style>
+    body { font-family: sans-serif; margin: 0; display: flex; flex-direction: column; height: 100vh; }
+    #messages { flex: 1; overflow-y: auto; padding: 16px; }
+    .user-message { text-align: right; margin: 8px 0; color: #0051D5; }
+    .markdown-body { margin: 8px 0; background: #F0F0F0; padding: 8px; border-radius: 8px; }
+    #composer { display: flex; gap: 8px; padding: 12px; border-top: 1px solid #ddd; }
+    textarea { flex: 1; height: 48px; }
+    .semi-upload-input { display: none; }
+</style>
+</head>
+<body>
+<div id="messages"></div>
+<div id="composer">
+    <input type="file" class="semi-upload-input" accept="image/*,text/plain">
+    <textarea data-testid="chat_input_input" class="semi-input-textarea" placeholder="发消息..."></textarea>
+    <button type="submit" data-testid="chat_input_send_button" class="send-button">发送</button>
+    <button data-testid="chat_input_stop_button" class="stop-button" style="display: none;">停止</button>
+</div>
+<script>
+(function() {
+    const params = new URLSearchParams(location.search);
+    const rate = Math.max(1, Number(params.get('rate')) || 20);
+    const tokenCount = Math.max(1, Number(params.get('tokens')) || 120);
+    const messages = document.getElementById('messages');
+    const input = document.querySelector('textarea');
+    const sendBtn = document.querySelector('.send-button');
+    const stopBtn = document.querySelector('.stop-button');
+    const upload = document.querySelector('.semi-upload-input');
+    let pendingFiles = [];
+    let streaming = null;
+
+    upload.addEventListener('change', () => {
+        pendingFiles = Array.from(upload.files).map(f => f.name + ' (' + f.size + ' B)');
+    });
+
+    const finish = function() {
+        if (streaming) streaming.abort();
+        streaming = null;
+        stopBtn.style.display = 'none';
+    };
+    stopBtn.addEventListener('click', finish);
+
+    // 把 Markdown 渲染为段落和代码块，结构与真实站点一致
+    const render = function(reply, markdown) {
+        reply.textContent = '';
+        markdown.split(/\n*```/).forEach((part, i) => {
+            if (i % 2 === 0) {
+                if (!part.trim()) return;
+                const para = document.createElement('p');
+                para.textContent = part.trim();
+                reply.appendChild(para);
+                return;
+            }
+            const newline = part.indexOf('\n');
+            const pre = document.createElement('pre');
+            const code = document.createElement('code');
+            code.className = 'language-' + (newline >= 0 ? part.slice(0, newline) : part);
+            code.textContent = newline >= 0 ? part.slice(newline + 1) : '';
+            pre.appendChild(code);
+            reply.appendChild(pre);
+        });
+    };
+
+    // 回复全文（含前缀和代码块）都来自 /api/chat 的 SSE 流，与真实站点一样边收边渲染，
+    // 网络捕获到的文本与页面上的回复一致
+    const streamReply = async function(text, attachments, reply) {
+        const resp = await fetch('/api/chat?rate=' + rate + '&tokens=' + tokenCount, {
+            method: 'POST', body: JSON.stringify({ text: text, attachments: attachments }),
+            signal: streaming.signal
+        });
+        const reader = resp.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let markdown = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            let idx;
+            while ((idx = buffer.indexOf('\n')) >= 0) {
+                const line = buffer.slice(0, idx).trim();
+                buffer = buffer.slice(idx + 1);
+                if (!line.startsWith('data:')) continue;
+                const payload = line.slice(5).trim();
+                if (payload === '[DONE]') continue;
+                markdown += JSON.parse(payload).choices[0].delta.content;
+                render(reply, markdown);
+                messages.scrollTop = messages.scrollHeight;
+            }
+        }
+    };
+
+    sendBtn.addEventListener('click', () => {
+        const text = input.value.trim();
+        if (!text || streaming) return;
+        input.value = '';
+
+        const userMsg = document.createElement('div');
+        userMsg.className = 'user-message';
+        userMsg.setAttribute('data-role', 'user-message');
+        userMsg.textContent = text;
+        messages.appendChild(userMsg);
+
+        const reply = document.createElement('div');
+        reply.className = 'markdown-body assistant';
+        reply.setAttribute('data-testid', 'message_text_content');
+        messages.appendChild(reply);
+        stopBtn.style.display = '';
+
+        const attachments = pendingFiles;
+        pendingFiles = [];
+        streaming = new AbortController();
+        streamReply(text, attachments, reply).catch(error => console.log('stream aborted:', error)).finally(finish);
+    });
+})();
+</script>
+</body>
+</html>
+"""
+
+# 流式响应钩子：只在需要网络信号的站点注入。统计 fetch 流式响应的打开/关闭次数，
+# 并按 SSE / NDJSON 格式解析事件，拼出本轮发送对应的回复流的全文并跟踪它何时结束
+STREAM_HOOK_JS = r"""
+(function() {
+    if (window.__mlbStream) return;
+    const state = { open: 0, closed: 0, seq: 0, baseline: 0, streams: [] };
+    window.__mlbStream = state;
+    const origFetch = window.fetch;
+    const contentType = resp => resp.headers.get('content-type') || '';
+    // 只认 SSE 和 NDJSON，application/octet-stream 等下载流不算回复流
+    const isStream = resp => /^(text\/event-stream|application\/(x-)?ndjson)\s*(;|$)/i.test(contentType(resp).trim());
+
+    // 常见流式接口中文本片段所在的字段；字符串值若本身是 JSON 则继续向内解析
+    const textPaths = [
+        ['choices', 0, 'delta', 'content'], ['choices', 0, 'text'],
+        ['delta', 'content'], ['delta', 'text'], ['message', 'content'],
+        ['content'], ['text'], ['event_data'], ['data']
+    ];
+    const pickText = function(obj, depth) {
+        if (depth > 4 || obj === null || obj === undefined) return null;
+        if (typeof obj === 'string') {
+            const t = obj.trim();
+            if (t[0] !== '{' && t[0] !== '[') return null;
+            try {
+                return pickText(JSON.parse(t), depth + 1);
+            } catch (e) {
+                return null;
+            }
+        }
+        if (typeof obj !== 'object') return null;
+        for (let path of textPaths) {
+            let v = obj;
+            for (let key of path) {
+                v = (v === null || v === undefined) ? undefined : v[key];
+            }
+            if (v === null || v === undefined) continue;
+            const nested = pickText(v, depth + 1);
+            if (nested !== null) return nested;
+            const last = path[path.length - 1];
+            if (typeof v === 'string' && last !== 'event_data' && last !== 'data') return v;
+        }
+        return null;
+    };
+
+    const handleLine = function(entry, line) {
+        let payload = line;
+        if (entry.sse) {
+            if (!line.startsWith('data:')) return;
+            payload = line.slice(5).trim();
+        }
+        if (!payload || payload === '[DONE]') return;
+        let piece = null;
+        try {
+            piece = pickText(JSON.parse(payload), 0);
+        } catch (e) {
+            piece = null;
+        }
+        if (piece === null) return;
+        // 有的接口每次推送完整文本，有的只推增量
+        if (entry.text && piece.startsWith(entry.text)) {
+            entry.text = piece;
+        } else {
+            entry.text += piece;
+        }
+        entry.updated = Date.now();
+    };
+
+    // seq 在发起请求时分配：发送前已发起、发送后才返回的请求不会被当成本轮的回复流
+    const track = function(stream, sse, seq, post) {
+        const entry = { seq: seq, post: post, text: '', done: false, sse: sse, updated: Date.now() };
+        state.streams.push(entry);
+        if (state.streams.length > 20) state.streams.shift();
+        state.open++;
+
+        const reader = stream.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        const finish = () => {
+            if (buffer) handleLine(entry, buffer.replace(/\r$/, ''));
+            entry.done = true;
+            state.open--;
+            state.closed++;
+        };
+        const pump = () => reader.read().then(({ done, value }) => {
+            if (done) {
+                finish();
+                return;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            let idx;
+            while ((idx = buffer.indexOf('\n')) >= 0) {
+                handleLine(entry, buffer.slice(0, idx).replace(/\r$/, ''));
+                buffer = buffer.slice(idx + 1);
+            }
+            return pump();
+        }, finish);
+        pump();
+    };
+
+    window.fetch = function(input, init) {
+        const seq = ++state.seq;
+        const method = (init && init.method) || (input instanceof Request ? input.method : 'GET');
+        return origFetch.apply(this, arguments).then(resp => {
+            if (!resp.body || !isStream(resp)) return resp;
+            const [mine, theirs] = resp.body.tee();
+            track(mine, contentType(resp).includes('event-stream'), seq, method.toUpperCase() === 'POST');
+            const proxied = new Response(theirs, {
+                status: resp.status, statusText: resp.statusText, headers: resp.headers
+            });
+            Object.defineProperty(proxied, 'url', { value: resp.url });
+            return proxied;
+        });
+    };
+
+    // 本轮发送之后发起的第一条流（POST 优先），即这次发送对应的回复流；之后出现的其他流不会顶替它
+    state.current = function() {
+        let fallback = null;
+        for (let entry of state.streams) {
+            if (entry.seq <= state.baseline) continue;
+            if (entry.post) return entry;
+            fallback = fallback || entry;
+        }
+        return fallback;
+    };
+})();
+"""
+
+def to_js_literal(value):
+    """将 Python 值编码为 JSON 字面量，可直接作为 JS 表达式使用"""
+    try:
+        literal = json.dumps(value, ensure_ascii=False)
+        literal.encode("utf-8")
+    except UnicodeEncodeError:
+        # 含有孤立代理项时退回纯 ASCII 转义
+        literal = json.dumps(value)
+    # U+2028/U+2029 在旧 JS 引擎中是行终止符，"</" 可能提前结束 script 标签
+    return (literal.replace("\u2028", "\\u2028")
+                   .replace("\u2029", "\\u2029")
+                   .replace("</", "<\\/"))
+
+class MessageRecord:
+    """历史消息记录 - __slots__ 紧凑存储，时间戳为 epoch 秒，日期键做字符串驻留
+
+    uid 在进程内唯一且不随清空、导入归并而变化，异步结果（后处理等）按 uid 找回记录。
+    """
+    __slots__ = ('uid', 'text', 'is_user', 'epoch', 'date', 'meta')
+    _uids = itertools.count(1)
+
+    def __init__(self, text, is_user, epoch, date=None, meta=None):
+        self.uid = next(MessageRecord._uids)
+        self.text = text
+        self.is_user = is_user
+        self.epoch = epoch
+        self.date = sys.intern(date or datetime.fromtimestamp(epoch).strftime("%Y年%m月%d日"))
+        self.meta = meta
+
+    @property
+    def timestamp(self):
+        return datetime.fromtimestamp(self.epoch)
+
+    def to_dict(self):
+        return {
+            'text': self.text,
+            'is_user': self.is_user,
+            'timestamp': self.timestamp.isoformat()
+        }
 
 class MessageBubble(QFrame):
-    """消息气泡组件"""
-    def __init__(self, text, is_user=True, timestamp=None):
+    """消息气泡组件（只持有消息记录的引用）
+
+    pending 为 True 的回复先以纯文本显示，后处理进程把 Markdown 转好 HTML 后再经 set_rich_text 替换，
+    GUI 线程不解析 Markdown；导入的记录没有后处理，仍直接按 Markdown 显示。
+    """
+    def __init__(self, record, pending=False):
         super().__init__()
-        self.is_user = is_user
-        self.init_ui(text, timestamp)
+        self.record = record
+        self.pending = pending
+        timestamp = record.timestamp.strftime("%H:%M")
+        if record.meta and record.meta.get('cached'):
+            timestamp = "⚡ 缓存 · " + timestamp
+        self.init_ui(record.text, timestamp)
+
+    @property
+    def is_user(self):
+        return self.record.is_user
     
     def init_ui(self, text, timestamp):
         layout = QVBoxLayout(self)
@@ -42,11 +909,15 @@ class MessageBubble(QFrame):
         # 消息文本
         msg_label = QLabel(text)
         msg_label.setWordWrap(True)
+        if not self.is_user:
+            # 机器人回复以 Markdown 形式保存，保留代码块、列表和表格
+            msg_label.setTextFormat(Qt.PlainText if self.pending else Qt.MarkdownText)
+        self.msg_label = msg_label
         msg_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
         msg_label.setFont(QFont("Microsoft YaHei", 10))
         
         # 时间戳
-        time_label = QLabel(timestamp or datetime.now().strftime("%H:%M"))
+        time_label = QLabel(timestamp)
         time_label.setFont(QFont("Microsoft YaHei", 8))
         time_label.setStyleSheet("color: rgba(100, 100, 100, 0.7);")
         
@@ -82,6 +953,12 @@ class MessageBubble(QFrame):
         layout.addWidget(bubble_container)
         self.setStyleSheet("background: transparent;")
 
+    def set_rich_text(self, html):
+        """换上后处理进程生成的 HTML"""
+        self.pending = False
+        self.msg_label.setTextFormat(Qt.RichText)
+        self.msg_label.setText(html)
+
 class DateSeparator(QWidget):
     """日期分隔符"""
     def __init__(self, date_text):
@@ -113,18 +990,162 @@ class DateSeparator(QWidget):
         layout.addWidget(date_label, 0)
         layout.addWidget(right_line, 1)
 
-class HistoryPanel(QWidget):
+class CollapsiblePanel(QWidget):
+    """可折叠面板基类 - 内容放在固定几何的子容器中，折叠动画只改变外层裁剪高度
+
+    动画过程中内容容器的尺寸不变，子控件（消息气泡、日志文本）不会被重新布局。
+    """
+    height_changed = pyqtSignal(int)    # 面板高度变化量，供悬浮窗按底边锚定调整自身
+
+    def __init__(self, expanded_height):
+        super().__init__()
+        self.expanded_height = expanded_height
+        self.expanded = False
+        self.animation = None
+        self._panel_height = 0
+        self.setFixedHeight(0)  # 初始隐藏
+        self.content = QWidget(self)
+        self.content.setGeometry(0, 0, self.width(), expanded_height)
+
+    def resizeEvent(self, event):
+        # 只有宽度变化才需要重新布局内容，高度变化仅是裁剪
+        if event.size().width() != event.oldSize().width():
+            self.content.setGeometry(0, 0, event.size().width(), self.expanded_height)
+        super().resizeEvent(event)
+
+    def get_panel_height(self):
+        return self._panel_height
+
+    def set_panel_height(self, height):
+        delta = height - self._panel_height
+        if not delta:
+            return
+        self._panel_height = height
+        self.setFixedHeight(height)
+        self.height_changed.emit(delta)
+
+    panel_height = pyqtProperty(int, get_panel_height, set_panel_height)
+
+    def toggle_visibility(self):
+        """切换显示/隐藏"""
+        self.expanded = not self.expanded
+        target_height = self.expanded_height if self.expanded else 0
+        if self.animation:
+            self.animation.stop()
+
+        self.animation = QPropertyAnimation(self, b"panel_height")
+        self.animation.setDuration(300)
+        self.animation.setStartValue(self._panel_height)
+        self.animation.setEndValue(target_height)
+        self.animation.setEasingCurve(QEasingCurve.InOutQuad)
+        self.animation.start()
+
+def write_messages(path, messages):
+    """流式写出消息，格式由扩展名决定：.jsonl / .md / .parquet，返回写出条数（不触碰 Qt，可在后台线程调用）"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.parquet':
+        return write_parquet(path, messages)
+
+    count = 0
+    last_date = None
+    with open(path, 'w', encoding='utf-8') as f:
+        for msg in messages:
+            if ext == '.md':
+                if msg.date != last_date:
+                    f.write(f"## {msg.date}\n\n")
+                    last_date = msg.date
+                speaker = "🧑 用户" if msg.is_user else "🤖 回复"
+                f.write(f"**{speaker}** {msg.timestamp.strftime('%H:%M:%S')}\n\n{msg.text}\n\n")
+            else:
+                f.write(json.dumps(msg.to_dict(), ensure_ascii=False))
+                f.write("\n")
+            count += 1
+    return count
+
+def write_parquet(path, messages, batch_size=10000):
+    """分批写入 Parquet（需要 pyarrow）"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ('text', pa.string()),
+        ('is_user', pa.bool_()),
+        ('timestamp', pa.timestamp('ms'))
+    ])
+    count = 0
+    batch = {'text': [], 'is_user': [], 'timestamp': []}
+    with pq.ParquetWriter(path, schema) as writer:
+        for msg in messages:
+            batch['text'].append(msg.text)
+            batch['is_user'].append(msg.is_user)
+            batch['timestamp'].append(msg.timestamp)
+            count += 1
+            if len(batch['text']) >= batch_size:
+                writer.write_table(pa.table(batch, schema=schema))
+                batch = {'text': [], 'is_user': [], 'timestamp': []}
+        if batch['text']:
+            writer.write_table(pa.table(batch, schema=schema))
+    return count
+
+class ExportOptionsDialog(QDialog):
+    """导出筛选条件：日期范围和角色"""
+    ROLES = [("全部", None), ("🧑 用户", 'user'), ("🤖 回复", 'bot')]
+
+    def __init__(self, messages, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("导出对话")
+        today = QDate.currentDate()
+        first = QDate(datetime.fromtimestamp(messages[0].epoch).date()) if messages else today
+
+        self.use_range = QCheckBox("按日期筛选")
+        self.start_edit = QDateEdit(first)
+        self.end_edit = QDateEdit(today)
+        for edit in (self.start_edit, self.end_edit):
+            edit.setCalendarPopup(True)
+            edit.setDisplayFormat("yyyy-MM-dd")
+            edit.setEnabled(False)
+            self.use_range.toggled.connect(edit.setEnabled)
+        self.role_combo = QComboBox()
+        for label, _ in self.ROLES:
+            self.role_combo.addItem(label)
+
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+
+        layout = QFormLayout(self)
+        layout.addRow(self.use_range)
+        layout.addRow("开始日期", self.start_edit)
+        layout.addRow("结束日期", self.end_edit)
+        layout.addRow("角色", self.role_combo)
+        layout.addRow(buttons)
+
+    def filters(self):
+        """返回 (start, end, role)，与 HistoryPanel.iter_messages 的参数一致；结束日期包含当天"""
+        role = self.ROLES[self.role_combo.currentIndex()][1]
+        if not self.use_range.isChecked():
+            return None, None, role
+        start = datetime.combine(self.start_edit.date().toPyDate(), datetime.min.time())
+        end = datetime.combine(self.end_edit.date().toPyDate(), datetime.max.time())
+        return start, end, role
+
+class HistoryPanel(CollapsiblePanel):
     """历史消息面板"""
+    export_finished = pyqtSignal(str, int, str)   # 路径, 条数, 错误信息（成功为空）
+    message_added = pyqtSignal(object)            # 新增的 MessageRecord（不含导入的记录）
+
     def __init__(self):
-        super().__init__()
+        super().__init__(400)
         self.messages = []
+        self.by_uid = {}         # uid -> 本次运行中新增的记录（导入的记录不会附加元数据）
+        self.keyword_index = {}  # 关键词 -> 记录 uid 列表
+        self.pending_bubbles = {}  # uid -> 等待后处理 HTML 的回复气泡
         self.last_date = None
         self.init_ui()
+        self.export_finished.connect(self.on_export_finished)
     
     def init_ui(self):
-        self.setFixedHeight(0)  # 初始隐藏
-        
-        main_layout = QVBoxLayout(self)
+        main_layout = QVBoxLayout(self.content)
         main_layout.setContentsMargins(0, 0, 0, 0)
         main_layout.setSpacing(0)
         
@@ -144,9 +1165,7 @@ class HistoryPanel(QWidget):
         title.setFont(QFont("Microsoft YaHei", 11, QFont.Bold))
         title.setStyleSheet("color: #1D1D1F; background: transparent; border: none;")
         
-        self.clear_btn = QPushButton("清空")
-        self.clear_btn.setFixedSize(50, 26)
-        self.clear_btn.setStyleSheet("""
+        header_btn_style = """
             QPushButton {
                 background: transparent;
                 color: #007AFF;
@@ -160,11 +1179,21 @@ class HistoryPanel(QWidget):
             QPushButton:pressed {
                 background: rgba(0, 122, 255, 0.2);
             }
-        """)
+        """
+        self.import_btn = QPushButton("导入")
+        self.export_btn = QPushButton("导出")
+        self.clear_btn = QPushButton("清空")
+        for btn in [self.import_btn, self.export_btn, self.clear_btn]:
+            btn.setFixedSize(50, 26)
+            btn.setStyleSheet(header_btn_style)
+        self.import_btn.clicked.connect(self.import_dialog)
+        self.export_btn.clicked.connect(self.export_dialog)
         self.clear_btn.clicked.connect(self.clear_history)
         
         header_layout.addWidget(title)
         header_layout.addStretch()
+        header_layout.addWidget(self.import_btn)
+        header_layout.addWidget(self.export_btn)
         header_layout.addWidget(self.clear_btn)
         
         # 滚动区域
@@ -213,31 +1242,129 @@ class HistoryPanel(QWidget):
             }
         """)
     
-    def add_message(self, text, is_user=True):
+    def add_message(self, text, is_user=True, timestamp=None, meta=None):
         """添加消息"""
-        now = datetime.now()
-        current_date = now.strftime("%Y年%m月%d日")
-        timestamp = now.strftime("%H:%M")
+        record = MessageRecord(text, is_user, (timestamp or datetime.now()).timestamp(), meta=meta)
+        bubble = self.render_message(record, pending=not is_user)
+        if not is_user:
+            self.pending_bubbles[record.uid] = bubble
+        
+        # 滚动到底部
+        QTimer.singleShot(50, self.scroll_to_bottom)
         
+        self.messages.append(record)
+        self.by_uid[record.uid] = record
+        self.message_added.emit(record)
+        return record
+
+    def render_message(self, record, pending=False):
+        """创建消息气泡（必要时先插入日期分隔符），返回气泡"""
         # 检查是否需要添加日期分隔符
-        if current_date != self.last_date:
-            separator = DateSeparator(current_date)
+        if record.date != self.last_date:
+            separator = DateSeparator(record.date)
             self.message_layout.insertWidget(self.message_layout.count() - 1, separator)
-            self.last_date = current_date
+            self.last_date = record.date
         
         # 添加消息气泡
-        bubble = MessageBubble(text, is_user, timestamp)
+        bubble = MessageBubble(record, pending)
         self.message_layout.insertWidget(self.message_layout.count() - 1, bubble)
-        
-        # 滚动到底部
+        return bubble
+
+    def iter_messages(self, start=None, end=None, role=None):
+        """按日期范围和角色筛选消息（start/end 为 datetime，role 为 'user' 或 'bot'）"""
+        start_epoch = start.timestamp() if start else None
+        end_epoch = end.timestamp() if end else None
+        for msg in self.messages:
+            if start_epoch is not None and msg.epoch < start_epoch:
+                continue
+            if end_epoch is not None and msg.epoch > end_epoch:
+                continue
+            if role == 'user' and not msg.is_user:
+                continue
+            if role == 'bot' and msg.is_user:
+                continue
+            yield msg
+
+    def export_messages(self, path, start=None, end=None, role=None):
+        """流式导出消息，格式由扩展名决定：.jsonl / .md / .parquet，返回导出条数"""
+        return write_messages(path, self.iter_messages(start, end, role))
+
+    def export_messages_async(self, path, start=None, end=None, role=None):
+        """在 GUI 线程上取筛选后的快照，序列化和写盘放到后台线程，完成后发 export_finished"""
+        snapshot = list(self.iter_messages(start, end, role))
+        self.export_btn.setEnabled(False)
+
+        def run():
+            try:
+                count = write_messages(path, snapshot)
+                self.export_finished.emit(path, count, "")
+            except Exception as e:
+                self.export_finished.emit(path, 0, str(e))
+
+        threading.Thread(target=run, daemon=True).start()
+        return len(snapshot)
+
+    def on_export_finished(self, path, count, error):
+        self.export_btn.setEnabled(True)
+        if error:
+            QMessageBox.warning(self, "导出失败", error)
+        else:
+            QMessageBox.information(self, "导出完成", f"已导出 {count} 条消息到 {path}")
+
+    def import_messages(self, path, render_limit=500):
+        """批量导入 JSONL 记录，只为最后 render_limit 条创建气泡，且只做一次布局"""
+        imported = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                epoch = datetime.fromisoformat(record['timestamp']).timestamp()
+                imported.append(MessageRecord(record['text'], bool(record['is_user']), epoch))
+
+        # 导入的记录可能早于已有消息：按时间归并，再重建可见气泡和日期分隔符
+        imported.sort(key=lambda msg: msg.epoch)
+        self.messages = list(heapq.merge(self.messages, imported, key=lambda msg: msg.epoch))
+        self.rerender(render_limit)
         QTimer.singleShot(50, self.scroll_to_bottom)
-        
-        self.messages.append({
-            'text': text,
-            'is_user': is_user,
-            'timestamp': now,
-            'date': current_date
-        })
+        return len(imported)
+
+    def rerender(self, render_limit=500):
+        """丢弃现有气泡，只为最后 render_limit 条消息重新创建，且只做一次布局"""
+        self.message_container.setUpdatesEnabled(False)
+        self.message_layout.setEnabled(False)
+        try:
+            self.clear_widgets()
+            for msg in self.messages[-render_limit:]:
+                self.render_message(msg)
+        finally:
+            self.message_layout.setEnabled(True)
+            self.message_container.setUpdatesEnabled(True)
+
+    def export_dialog(self):
+        """选择筛选条件和文件，在后台导出"""
+        options = ExportOptionsDialog(self.messages, self)
+        if options.exec_() != QDialog.Accepted:
+            return
+        path, _ = QFileDialog.getSaveFileName(
+            self, "导出对话", "history.jsonl",
+            "JSON Lines (*.jsonl);;Markdown (*.md);;Parquet (*.parquet)")
+        if not path:
+            return
+        start, end, role = options.filters()
+        self.export_messages_async(path, start, end, role)
+
+    def import_dialog(self):
+        """选择 JSONL 文件并导入"""
+        path, _ = QFileDialog.getOpenFileName(self, "导入对话", "", "JSON Lines (*.jsonl)")
+        if not path:
+            return
+        try:
+            count = self.import_messages(path)
+            QMessageBox.information(self, "导入完成", f"已导入 {count} 条消息")
+        except Exception as e:
+            QMessageBox.warning(self, "导入失败", str(e))
     
     def scroll_to_bottom(self):
         """滚动到底部"""
@@ -246,41 +1373,57 @@ class HistoryPanel(QWidget):
             scroll_bar = scroll_area.verticalScrollBar()
             scroll_bar.setValue(scroll_bar.maximum())
     
-    def clear_history(self):
-        """清空历史"""
-        # 清空所有消息
+    def clear_widgets(self):
+        """移除所有气泡和日期分隔符"""
         while self.message_layout.count() > 1:  # 保留最后的 stretch
             item = self.message_layout.takeAt(0)
             if item.widget():
                 item.widget().deleteLater()
-        
-        self.messages.clear()
+        self.pending_bubbles.clear()
         self.last_date = None
+
+    def clear_history(self):
+        """清空历史"""
+        self.clear_widgets()
+        self.messages.clear()
+        self.by_uid.clear()
+        self.keyword_index.clear()
+
+    def attach_metadata(self, uid, meta):
+        """记录后处理结果、换上渲染好的 HTML 并更新关键词索引；记录已被清空时返回 False
+
+        HTML 只交给气泡显示，不保存在记录里（约为原文的数倍大小）。
+        """
+        html = meta.pop('html', None)
+        bubble = self.pending_bubbles.pop(uid, None)
+        if bubble is not None and html is not None:
+            bubble.set_rich_text(html)
+        record = self.by_uid.get(uid)
+        if record is None or record.is_user:
+            return False
+        record.meta = dict(record.meta, **meta) if record.meta else meta
+        for keyword in meta.get('keywords', []):
+            self.keyword_index.setdefault(keyword, []).append(uid)
+        return True
+
+    def find_by_keyword(self, keyword):
+        """按关键词查找消息"""
+        return [self.by_uid[uid] for uid in self.keyword_index.get(keyword.lower(), []) if uid in self.by_uid]
     
     def toggle_visibility(self):
         """切换显示/隐藏"""
-        target_height = 400 if self.height() == 0 else 0
-        
-        self.animation = QPropertyAnimation(self, b"maximumHeight")
-        self.animation.setDuration(300)
-        self.animation.setStartValue(self.height())
-        self.animation.setEndValue(target_height)
-        self.animation.setEasingCurve(QEasingCurve.InOutQuad)
-        self.animation.start()
-        
-        if target_height > 0:
+        super().toggle_visibility()
+        if self.expanded:
             QTimer.singleShot(50, self.scroll_to_bottom)
 
-class TerminalPanel(QWidget):
+class TerminalPanel(CollapsiblePanel):
     """终端面板（集成到悬浮窗口）"""
     def __init__(self):
-        super().__init__()
+        super().__init__(200)
         self.init_ui()
     
     def init_ui(self):
-        self.setFixedHeight(0)  # 初始隐藏
-        
-        main_layout = QVBoxLayout(self)
+        main_layout = QVBoxLayout(self.content)
         main_layout.setContentsMargins(0, 0, 0, 0)
         main_layout.setSpacing(0)
         
@@ -355,17 +1498,255 @@ class TerminalPanel(QWidget):
     def clear_terminal(self):
         """清空终端"""
         self.terminal.clear()
-    
-    def toggle_visibility(self):
-        """切换显示/隐藏"""
-        target_height = 200 if self.height() == 0 else 0
-        
-        self.animation = QPropertyAnimation(self, b"maximumHeight")
-        self.animation.setDuration(300)
-        self.animation.setStartValue(self.height())
-        self.animation.setEndValue(target_height)
-        self.animation.setEasingCurve(QEasingCurve.InOutQuad)
-        self.animation.start()
+
+# 脚本调度优先级（数值越小越优先）
+PRIORITY_SEND = 0
+PRIORITY_PROBE = 1
+PRIORITY_BACKGROUND = 2
+
+class CancelToken:
+    """取消令牌 - 与一条消息绑定，消息结束或中止后其上的脚本回调全部失效"""
+    def __init__(self, message_id=None):
+        self.message_id = message_id
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TemplateError(ValueError):
+    """模板解析或渲染错误"""
+
+class PromptTemplate:
+    """预编译的提示词模板：{{变量}} 或 {{变量|默认值}}，解析一次，渲染时只做拼接
+
+    与 str.format 双写花括号的转义方式一致，{{{{ 和 }}}} 分别输出字面量 {{ 和 }}。
+    """
+    TOKEN_RE = re.compile(r"(\{\{\{\{|\}\}\}\})|\{\{\s*([A-Za-z_]\w*)\s*(?:\|([^}]*))?\}\}")
+
+    def __init__(self, name, source):
+        self.name = name
+        self.parts = []         # 字面量字符串或 (变量名, 默认值) 元组
+        self.variables = []
+        pos = 0
+        for match in self.TOKEN_RE.finditer(source):
+            self.add_literal(source[pos:match.start()])
+            escaped, var, default = match.groups()
+            if escaped:
+                self.parts.append(escaped[:2])
+            else:
+                self.parts.append((var, default))
+                if var not in self.variables:
+                    self.variables.append(var)
+            pos = match.end()
+        self.add_literal(source[pos:])
+
+    def add_literal(self, text):
+        if "{{" in text:
+            raise TemplateError(f"模板 {self.name} 中有无法解析的占位符（字面量 {{{{ 请写作 {{{{{{{{）")
+        if text:
+            self.parts.append(text)
+
+    def render(self, values):
+        out = []
+        for part in self.parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+            var, default = part
+            value = values.get(var, default)
+            if value is None:
+                raise TemplateError(f"模板 {self.name} 缺少变量 {var}")
+            out.append(str(value))
+        return "".join(out)
+
+class TemplateLibrary(QObject):
+    """提示词模板库 - 从目录加载 *.txt / *.md 模板，文件变化时热重载
+
+    输入栏中 "/模板名 key=value ... -- 其余文本" 会展开为模板，其余文本作为 {{input}}；
+    没有 -- 分隔时模板名之后的全部文本都是 {{input}}，不会把正文开头形如 a=b 的内容当成变量。
+    """
+    ARGS_RE = re.compile(r"\s*((?:[A-Za-z_]\w*=\S*\s+)*)--(?:\s+|$)")
+    def __init__(self, directory, terminal_panel):
+        super().__init__()
+        self.directory = directory
+        self.terminal_panel = terminal_panel
+        self.templates = {}
+        self.mtimes = {}
+        os.makedirs(directory, exist_ok=True)
+        self.watcher = QFileSystemWatcher([directory], self)
+        self.watcher.directoryChanged.connect(self.reload)
+        self.watcher.fileChanged.connect(self.reload)
+        self.reload()
+
+    def reload(self, *args):
+        """只重新编译修改过的模板文件"""
+        seen = set()
+        for entry in os.scandir(self.directory):
+            name, ext = os.path.splitext(entry.name)
+            if not entry.is_file() or ext.lower() not in ('.txt', '.md'):
+                continue
+            seen.add(name)
+            mtime = entry.stat().st_mtime
+            if self.mtimes.get(name) == mtime:
+                continue
+            try:
+                with open(entry.path, 'r', encoding='utf-8') as f:
+                    self.templates[name] = PromptTemplate(name, f.read().strip())
+                self.mtimes[name] = mtime
+                if entry.path not in self.watcher.files():
+                    self.watcher.addPath(entry.path)
+                self.terminal_panel.log(f"🧾 已加载模板: {name}")
+            except (OSError, TemplateError) as e:
+                self.terminal_panel.log(f"❌ 模板 {name} 加载失败: {e}")
+        for name in set(self.templates) - seen:
+            del self.templates[name]
+            del self.mtimes[name]
+
+    def render(self, name, values=None):
+        template = self.templates.get(name)
+        if template is None:
+            raise TemplateError(f"未知模板: {name}")
+        now = datetime.now()
+        merged = {
+            'date': now.strftime("%Y-%m-%d"),
+            'time': now.strftime("%H:%M"),
+            'input': "",
+        }
+        merged.update(values or {})
+        return template.render(merged)
+
+    def expand(self, text):
+        """展开斜杠命令；不是已知模板时原样返回"""
+        if not text.startswith("/"):
+            return text
+        head, _, rest = text[1:].partition(" ")
+        if head not in self.templates:
+            return text
+        values = {}
+        match = self.ARGS_RE.match(rest)
+        if match:
+            for token in match.group(1).split():
+                key, _, value = token.partition("=")
+                values[key] = value
+            rest = rest[match.end():]
+        values['input'] = rest.lstrip()
+        return self.render(head, values)
+
+class ProfileSlot:
+    """配置池中的一个浏览器配置及其健康状态"""
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+        self.in_use = 0
+        self.served = 0
+        self.throttled = 0
+        self.cooldown_until = 0.0
+
+    def is_healthy(self, now):
+        return self.cooldown_until <= now
+
+class ProfilePool:
+    """浏览器配置池 - N 个相互隔离的磁盘配置（各自的 Cookie 与缓存），用于账号分流
+
+    第 0 个配置沿用原有的 "MinimalLightBrowser" 与 browser_data 目录，已有登录状态不受影响；
+    其余配置放在同级目录 browser_data-1、browser_data-2 ……，互不嵌套。
+    """
+    def __init__(self, storage_root, size=1, strategy="round_robin", cooldown=600, parent=None):
+        self.storage_root = storage_root
+        self.strategy = strategy        # "round_robin" 或 "least_loaded"
+        self.cooldown = cooldown        # 被限流后的冷却时间（秒）
+        self.parent = parent
+        self.cursor = 0
+        self.slots = [self.create_slot(i) for i in range(max(1, size))]
+
+    def create_slot(self, index):
+        if index == 0:
+            name, path = "MinimalLightBrowser", self.storage_root
+        else:
+            name, path = f"MinimalLightBrowser-{index}", f"{os.path.normpath(self.storage_root)}-{index}"
+        os.makedirs(path, exist_ok=True)
+        profile = QWebEngineProfile(name, self.parent)
+        profile.setPersistentCookiesPolicy(QWebEngineProfile.ForcePersistentCookies)
+        profile.setPersistentStoragePath(path)
+        profile.setHttpCacheType(QWebEngineProfile.DiskHttpCache)
+        profile.setHttpCacheMaximumSize(200 * 1024 * 1024)
+        return ProfileSlot(name, profile)
+
+    def acquire(self, exclude=None):
+        """分配一个配置；冷却中的配置会被跳过，全部冷却时选最早恢复的"""
+        now = time.time()
+        candidates = [slot for slot in self.slots if slot.is_healthy(now) and slot is not exclude]
+        if not candidates:
+            candidates = [min(self.slots, key=lambda slot: slot.cooldown_until)]
+        if self.strategy == "least_loaded":
+            slot = min(candidates, key=lambda slot: (slot.in_use, slot.served))
+        else:
+            slot = None
+            for _ in range(len(self.slots)):
+                option = self.slots[self.cursor % len(self.slots)]
+                self.cursor += 1
+                if option in candidates:
+                    slot = option
+                    break
+            slot = slot or candidates[0]
+        slot.in_use += 1
+        return slot
+
+    def release(self, slot):
+        slot.in_use = max(0, slot.in_use - 1)
+
+    def report_success(self, slot):
+        slot.served += 1
+
+    def report_throttled(self, slot):
+        slot.throttled += 1
+        slot.cooldown_until = time.time() + self.cooldown
+
+    def status(self):
+        now = time.time()
+        return [
+            f"{slot.name}: 已服务 {slot.served}, 限流 {slot.throttled}"
+            + ("" if slot.is_healthy(now) else f", 冷却剩余 {slot.cooldown_until - now:.0f}s")
+            for slot in self.slots
+        ]
+
+class PayloadChannel(QObject):
+    """大段参数通道 - 经 QWebChannel 交给页面，调用脚本只携带 ID，不为每次调用生成新的脚本源码
+
+    WebChannel 不受站点 CSP 限制，附件批次的结果也经这里回报。
+    """
+    delivered = pyqtSignal(str, bool)   # (ID, 页面函数返回值)
+    attached = pyqtSignal(str, str)     # (附件批次, 'ok' / 'failed' / 'blocked')
+
+    def __init__(self, max_age=60.0):
+        super().__init__()
+        self.max_age = max_age
+        self.payloads = {}      # ID -> (内容, 登记时间)
+
+    def store(self, payload):
+        now = time.monotonic()
+        for payload_id, (_, stored) in list(self.payloads.items()):
+            if now - stored > self.max_age:
+                del self.payloads[payload_id]
+        payload_id = uuid.uuid4().hex
+        self.payloads[payload_id] = (payload, now)
+        return payload_id
+
+    def discard(self, payload_id):
+        self.payloads.pop(payload_id, None)
+
+    @pyqtSlot(str, result=str)
+    def take(self, payload_id):
+        entry = self.payloads.pop(payload_id, None)
+        return entry[0] if entry else ""
+
+    @pyqtSlot(str, bool)
+    def report(self, payload_id, ok):
+        self.delivered.emit(payload_id, ok)
+
+    @pyqtSlot(str, str)
+    def report_attached(self, batch, status):
+        self.attached.emit(batch, status)
 
 class BrowserView:
     """浏览器视图模块 - 封装浏览器视图和相关操作"""
@@ -374,6 +1755,72 @@ class BrowserView:
         self.web_view = QWebEngineView()
         self.web_view.setPage(QWebEnginePage(profile, self.web_view))
         self.web_view.loadFinished.connect(self.on_load_finished)
+        self.scripts = {}  # 脚本名 -> 源码，切换配置时重新注入
+        self.pending = {}  # 在途调用ID -> 发起时间，用于检测脚本超时
+        self.call_seq = 0
+        self.generation = 0
+        self.max_in_flight = 2
+        self.queue = []              # (优先级, 序号, 调用)
+        self.queued_kinds = {}       # 类别 -> 排队中的探测调用
+        self.inflight_kinds = set()
+        self.rtt = {}                # 类别 -> 最近的往返时间 (ms)
+        self.max_queue_depth = 0
+        self.coalesced = 0
+        self.profiler = None         # 性能分析器，开启时记录每次脚本往返
+        self.payload_channel = PayloadChannel()
+        self.payload_channel.delivered.connect(self.on_payload_delivered)
+        self.payload_callbacks = {}  # 载荷ID -> (回调, 取消令牌)
+        self.payload_channel.attached.connect(self.on_attach_reported)
+        self.attach_callbacks = {}   # 附件批次 -> 结果回调(状态)
+        self.channel = QWebChannel(self.web_view)
+        self.channel.registerObject("mlbPayloads", self.payload_channel)
+        self.web_view.page().setWebChannel(self.channel)
+        self.install_bridge()
+
+    def set_profile(self, profile):
+        """切换到另一个浏览器配置（新页面，重新注入脚本）"""
+        old_page = self.web_view.page()
+        self.web_view.setPage(QWebEnginePage(profile, self.web_view))
+        self.web_view.page().setWebChannel(self.channel)
+        old_page.deleteLater()
+        self.reset_pending()
+        for name, source in self.scripts.items():
+            self.insert_script(name, source)
+
+    def install_bridge(self):
+        """注入页面桥接脚本，每个文档只编译一次"""
+        self.install_script("mlb_bridge", PAGE_BRIDGE_JS)
+        qwebchannel = QFile(":/qtwebchannel/qwebchannel.js")
+        if qwebchannel.open(QFile.ReadOnly):
+            source = bytes(qwebchannel.readAll()).decode("utf-8")
+            qwebchannel.close()
+            self.install_script("mlb_channel", source + CHANNEL_INIT_JS)
+
+    def set_selectors(self, selectors):
+        """注入站点选择器配置（input / send / file / user / message / stop），优先于内置选择器"""
+        if selectors:
+            self.install_script("mlb_selectors", f"window.__mlbSelectors = {to_js_literal(selectors)};")
+
+    def install_script(self, name, source):
+        """在文档创建时注入脚本（同名脚本只注入一次）"""
+        if name in self.scripts:
+            return
+        self.scripts[name] = source
+        self.insert_script(name, source)
+
+    def insert_script(self, name, source):
+        scripts = self.web_view.page().scripts()
+        script = QWebEngineScript()
+        script.setName(name)
+        script.setSourceCode(source)
+        script.setInjectionPoint(QWebEngineScript.DocumentCreation)
+        script.setWorldId(QWebEngineScript.MainWorld)
+        script.setRunsOnSubFrames(False)
+        scripts.insert(script)
+
+    def enable_stream_hook(self):
+        """注入流式响应钩子，下次加载页面时生效"""
+        self.install_script("mlb_stream_hook", STREAM_HOOK_JS)
 
     def on_load_finished(self, ok):
         if ok:
@@ -399,36 +1846,272 @@ class BrowserView:
             else:
                 self.terminal_panel.log("⏳ 页面仍在加载中...")
                 QTimer.singleShot(2000, self.check_page_stability)
-        self.web_view.page().runJavaScript(js_check, handle_stability)
+        self.run_javascript(js_check, handle_stability, kind="stability", priority=PRIORITY_BACKGROUND)
 
     def load_url(self, url):
         self.web_view.setUrl(QUrl(url))
 
-    def run_javascript(self, js_code, callback=None):
-        if callback:
-            self.web_view.page().runJavaScript(js_code, callback)
-        else:
-            self.web_view.page().runJavaScript(js_code)
+    def run_javascript(self, js_code, callback=None, kind=None, token=None, priority=PRIORITY_PROBE):
+        """提交脚本到调度队列
 
-class FloatingChatWindow(QWidget):
-    """悬浮聊天窗口 - 独立的悬浮输入条（集成终端）"""
-    def __init__(self, on_send_callback, on_toggle_main, history_panel, terminal_panel):
-        super().__init__()
-        self.on_send_callback = on_send_callback
-        self.on_toggle_main = on_toggle_main
-        self.history_panel = history_panel
-        self.terminal_panel = terminal_panel
-        self.is_always_on_top = False
-        self.drag_position = None
-        self.init_ui()
+        kind: 调用类别；探测类调用（优先级不高于 PRIORITY_PROBE）同类只保留一个在途、一个排队，
+              排队中的旧调用被新调用覆盖
+        token: 取消令牌，取消后排队的调用不再执行、在途调用的回调被丢弃
+        priority: 数值越小越优先，用户发送使用 PRIORITY_SEND
+        """
+        if token is not None and token.cancelled:
+            return
+        coalesce = kind is not None and priority >= PRIORITY_PROBE
+        if coalesce and kind in self.queued_kinds:
+            job = self.queued_kinds[kind]
+            job.update(js=js_code, callback=callback, token=token)
+            self.coalesced += 1
+            return
+        job = {'kind': kind, 'js': js_code, 'callback': callback, 'token': token, 'coalesce': coalesce}
+        self.call_seq += 1
+        heapq.heappush(self.queue, (priority, self.call_seq, job))
+        if coalesce:
+            self.queued_kinds[kind] = job
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        self.dispatch()
 
-    def init_ui(self):
-        # 设置为无边框、置顶窗口
-        self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint | Qt.Tool)
-        self.setAttribute(Qt.WA_TranslucentBackground)
-        
-        # 主容器
+    def dispatch(self):
+        """在并发上限内按优先级发出排队的脚本"""
+        skipped = []
+        while self.queue and len(self.pending) < self.max_in_flight:
+            item = heapq.heappop(self.queue)
+            job = item[2]
+            if job['coalesce'] and self.queued_kinds.get(job['kind']) is job:
+                if job['kind'] in self.inflight_kinds:
+                    skipped.append(item)
+                    continue
+                del self.queued_kinds[job['kind']]
+            if job['token'] is not None and job['token'].cancelled:
+                continue
+            self.start_job(job)
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+
+    def start_job(self, job):
+        self.call_seq += 1
+        call_id = self.call_seq
+        generation = self.generation
+        started = time.monotonic()
+        self.pending[call_id] = started
+        if job['coalesce']:
+            self.inflight_kinds.add(job['kind'])
+
+        def done(result):
+            # 已超时或页面已重置的调用，丢弃迟到的结果
+            if self.pending.pop(call_id, None) is None or generation != self.generation:
+                return
+            self.inflight_kinds.discard(job['kind'])
+            elapsed = (time.monotonic() - started) * 1000
+            self.rtt.setdefault(job['kind'] or "script", deque(maxlen=100)).append(elapsed)
+            if self.profiler:
+                self.profiler.record_js(job['kind'] or "script", started, elapsed)
+            token = job['token']
+            if job['callback'] and (token is None or not token.cancelled):
+                job['callback'](result)
+            self.dispatch()
+        self.web_view.page().runJavaScript(job['js'], done)
+
+    def oldest_pending_age(self):
+        """最早一个未返回脚本调用已等待的秒数"""
+        if not self.pending:
+            return 0.0
+        return time.monotonic() - min(self.pending.values())
+
+    def reset_pending(self):
+        """丢弃所有未返回和排队中的脚本调用"""
+        self.generation += 1
+        self.payload_channel.payloads.clear()
+        self.payload_callbacks.clear()
+        self.pending.clear()
+        self.inflight_kinds.clear()
+        self.queue.clear()
+        self.queued_kinds.clear()
+
+    def metrics_summary(self):
+        """调度指标：队列峰值、合并次数和各类调用的往返时间"""
+        parts = [f"队列峰值 {self.max_queue_depth}", f"合并 {self.coalesced} 次"]
+        for kind, samples in sorted(self.rtt.items()):
+            if samples:
+                parts.append(f"{kind} {statistics.mean(samples):.0f} ms")
+        return ", ".join(parts)
+
+    def call(self, func_name, *args, callback=None, token=None, priority=PRIORITY_PROBE):
+        """调用桥接脚本中预注册的页面函数，参数以 JSON 传递"""
+        js_args = ", ".join(to_js_literal(arg) for arg in args)
+        js_code = f"window.__mlb ? window.__mlb.{func_name}({js_args}) : null"
+        self.run_javascript(js_code, callback, kind=func_name, token=token, priority=priority)
+
+    def call_with_payload(self, func_name, payload, *args, callback=None, token=None, priority=PRIORITY_PROBE):
+        """调用 func_name(payload, *args)，payload 经 WebChannel 传递，脚本源码只含 ID 和小参数
+
+        WebChannel 尚未就绪时退回普通 call。
+        """
+        payload_id = self.payload_channel.store(payload)
+
+        def started(result):
+            if result:
+                self.payload_callbacks[payload_id] = (callback, token)
+                return
+            self.payload_channel.discard(payload_id)
+            self.call(func_name, payload, *args, callback=callback, token=token, priority=priority)
+        self.call("withPayload", payload_id, func_name, list(args), callback=started, token=token,
+                  priority=priority)
+
+    def on_payload_delivered(self, payload_id, ok):
+        callback, token = self.payload_callbacks.pop(payload_id, (None, None))
+        if callback and (token is None or not token.cancelled):
+            callback(ok)
+
+    def attach_files(self, server, items, callback, token=None):
+        """把一批文件放入页面的文件输入控件，返回批次号；结束时调用一次 callback(是否成功)
+
+        items 同 AttachmentServer.register。页面从本地附件服务拉取内容；站点 CSP 禁止访问本机端口时
+        退回 attach_inline。批次在完成、失败或超时时释放。
+        """
+        batch, files, done_url = server.register(items)
+        entries = server.batches[batch]
+        finished = []
+
+        def finish(status):
+            if finished:
+                return
+            finished.append(status)
+            self.attach_callbacks.pop(batch, None)
+            server.release(batch)
+            if status == 'blocked':
+                self.terminal_panel.log("⚠️ 页面无法访问本地附件服务（可能受站点 CSP 限制），改为经 WebChannel 传送")
+                self.attach_inline(entries, done, token)
+                return
+            if status == 'timeout':
+                self.terminal_panel.log("⚠️ 附件上传超时")
+            done(status == 'ok')
+
+        def done(ok):
+            if token is None or not token.cancelled:
+                callback(ok)
+
+        def started(result):
+            if not result:
+                finish('failed')
+        self.attach_callbacks[batch] = finish
+        server.callbacks[batch] = lambda ok: finish('ok' if ok else 'failed')
+        self.call("attachUrls", files, batch, done_url, callback=started, token=token, priority=PRIORITY_SEND)
+        # 页面迟迟没有回报时不再等待，按 1 MB/s 估算超时
+        timeout = 30000 + sum(size for _, _, _, size in entries) // 1024
+        QTimer.singleShot(timeout, lambda: finish('timeout'))
+        return batch
+
+    def attach_inline(self, entries, callback, token=None):
+        """逐个把文件以 base64 经 WebChannel 交给 attachFile（文件需整体读入内存，每次只放入一个文件）"""
+        results = []
+
+        def next_file(ok=None):
+            if ok is not None:
+                results.append(ok)
+            if len(results) == len(entries):
+                callback(all(results))
+                return
+            source, name, mime, _ = entries[len(results)]
+            try:
+                if not isinstance(source, bytes):
+                    with open(source, 'rb') as f:
+                        source = f.read()
+            except OSError as e:
+                self.terminal_panel.log(f"❌ 读取附件失败: {e}")
+                next_file(False)
+                return
+            self.call_with_payload("attachFile", base64.b64encode(source).decode("ascii"), name, mime,
+                                   callback=next_file, token=token, priority=PRIORITY_SEND)
+        next_file()
+
+    def on_attach_reported(self, batch, status):
+        finish = self.attach_callbacks.get(batch)
+        if finish:
+            finish(status)
+
+def remove_quietly(path):
+    """删除文件；文件已不存在或无法删除时忽略"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class ChatInput(QTextEdit):
+    """聊天输入框 - 粘贴或拖入的文件、图片作为附件交给悬浮窗，其余内容按文本处理"""
+    attachments_received = pyqtSignal(object)   # QMimeData
+
+    @staticmethod
+    def has_local_files(source):
+        return source.hasUrls() and any(url.isLocalFile() for url in source.urls())
+
+    @staticmethod
+    def is_image_only(source):
+        """只有图片、没有文本：从网页或文档复制的内容常同时带图片和文本，这时按文本粘贴"""
+        return source.hasImage() and not (source.hasText() and source.text().strip())
+
+    @staticmethod
+    def is_attachment(source):
+        return ChatInput.has_local_files(source) or ChatInput.is_image_only(source)
+
+    def canInsertFromMimeData(self, source):
+        return self.is_attachment(source) or super().canInsertFromMimeData(source)
+
+    def insertFromMimeData(self, source):
+        if self.is_attachment(source):
+            self.attachments_received.emit(source)
+        else:
+            super().insertFromMimeData(source)
+
+class FloatingChatWindow(QWidget):
+    """悬浮聊天窗口 - 独立的悬浮输入条（集成终端）"""
+    def __init__(self, on_send_callback, on_toggle_main, history_panel, terminal_panel):
+        super().__init__()
+        self.on_send_callback = on_send_callback
+        self.on_toggle_main = on_toggle_main
+        self.history_panel = history_panel
+        self.terminal_panel = terminal_panel
+        self.is_always_on_top = False
+        self.drag_position = None
+        self.frame_probe = None
+        self.attachments = []   # (文件路径, 是否为临时文件)
+        self.init_ui()
+        self.history_panel.height_changed.connect(self.grow_by)
+        self.terminal_panel.height_changed.connect(self.grow_by)
+
+    def event(self, event):
+        """帧耗时探针：统计顶层窗口每次布局和重绘的耗时"""
+        if self.frame_probe is None or event.type() not in (QEvent.LayoutRequest, QEvent.UpdateRequest):
+            return super().event(event)
+        started = time.perf_counter()
+        result = super().event(event)
+        self.frame_probe.record(event.type() == QEvent.UpdateRequest, (time.perf_counter() - started) * 1000)
+        return result
+
+    def grow_by(self, delta):
+        """按底边锚定增减窗口高度，只改窗口几何，不同步激活整窗布局
+
+        主布局不约束窗口尺寸（SetNoConstraint），子控件 setFixedHeight 变矮时
+        不会被旧的最小高度截住，也不必每一步都重算最小尺寸并通知窗口系统。
+        """
+        geometry = self.geometry()
+        bottom = geometry.bottom()
+        geometry.setHeight(max(geometry.height() + delta, self.minimumHeight()))
+        geometry.moveBottom(bottom)
+        self.setGeometry(geometry)
+
+    def init_ui(self):
+        # 设置为无边框、置顶窗口
+        self.setWindowFlags(Qt.WindowStaysOnTopHint | Qt.FramelessWindowHint | Qt.Tool)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+        
+        # 主容器
         main_layout = QVBoxLayout(self)
+        main_layout.setSizeConstraint(QVBoxLayout.SetNoConstraint)   # 窗口高度由 grow_by 按差值维护
         main_layout.setContentsMargins(10, 10, 10, 10)
         main_layout.setSpacing(8)
         
@@ -480,6 +2163,24 @@ class FloatingChatWindow(QWidget):
             control_layout.addWidget(btn)
         
         control_layout.addStretch()
+
+        # 附件列表与上传进度
+        self.attachment_btn = QPushButton()
+        self.attachment_btn.setFlat(True)
+        self.attachment_btn.setMaximumWidth(260)
+        self.attachment_btn.setToolTip("点击清除附件")
+        self.attachment_btn.setStyleSheet(
+            "QPushButton { color: #007AFF; background: transparent; border: none; font-size: 10px; }")
+        self.attachment_btn.clicked.connect(self.clear_attachments)
+        self.attachment_btn.hide()
+        control_layout.addWidget(self.attachment_btn)
+
+        # 性能分析浮层（分析模式下显示）
+        self.profile_label = QLabel()
+        self.profile_label.setFont(QFont("Consolas", 8))
+        self.profile_label.setStyleSheet("color: #666; background: transparent; border: none;")
+        self.profile_label.hide()
+        control_layout.addWidget(self.profile_label)
         
         # 输入容器（气泡风格）
         input_container = QWidget()
@@ -495,7 +2196,8 @@ class FloatingChatWindow(QWidget):
         input_layout.setSpacing(8)
         
         # 输入框
-        self.chat_input = QTextEdit()
+        self.chat_input = ChatInput()
+        self.chat_input.attachments_received.connect(self.add_attachments)
         self.chat_input.setPlaceholderText("输入消息... (Enter发送, Shift+Enter换行)")
         self.chat_input.setMaximumHeight(120)
         self.chat_input.setMinimumHeight(36)
@@ -510,8 +2212,12 @@ class FloatingChatWindow(QWidget):
             }
         """)
         
-        # 监听文本变化以自动调整高度
-        self.chat_input.textChanged.connect(self.adjust_input_height)
+        # 监听文本变化以自动调整高度（防抖，粘贴大段文本时只计算一次）
+        self.height_timer = QTimer(self)
+        self.height_timer.setSingleShot(True)
+        self.height_timer.setInterval(30)
+        self.height_timer.timeout.connect(self.adjust_input_height)
+        self.chat_input.textChanged.connect(self.height_timer.start)
         
         # 发送按钮
         self.send_button = QPushButton("发送")
@@ -552,32 +2258,47 @@ class FloatingChatWindow(QWidget):
         self.settings_btn.clicked.connect(self.show_settings)
         self.pin_btn.clicked.connect(self.toggle_pin)
         
+        # 整个悬浮条都可以拖入文件
+        self.setAcceptDrops(True)
+
         # 设置初始大小和位置
         self.setMinimumWidth(600)
         self.adjustSize()
         self.move_to_screen_bottom()
 
+    def set_profile_overlay(self, text):
+        """更新性能分析浮层，text 为 None 时隐藏"""
+        if text is None:
+            self.profile_label.hide()
+        else:
+            self.profile_label.setText(text)
+            self.profile_label.show()
+
     def adjust_input_height(self):
-        """根据文本内容自动调整输入框高度"""
+        """根据文本内容自动调整输入框高度（只按差值调整窗口，不重算整窗布局）"""
         doc_height = self.chat_input.document().size().height()
         new_height = min(max(36, int(doc_height) + 10), 120)
+        delta = new_height - self.chat_input.height()
+        if not delta:
+            return
         self.chat_input.setFixedHeight(new_height)
-        self.adjustSize()
+        self.grow_by(delta)
 
     def move_to_screen_bottom(self):
         """将窗口移动到屏幕底部中央"""
-        screen = QApplication.desktop().screenGeometry()
-        x = (screen.width() - self.width()) // 2
-        y = screen.height() - self.height() - 50
+        screen = QApplication.screenAt(QCursor.pos()) or QApplication.primaryScreen()
+        area = screen.availableGeometry()
+        x = area.x() + (area.width() - self.width()) // 2
+        y = area.y() + area.height() - self.height() - 50
         self.move(x, y)
 
     def send_message(self):
-        """发送消息"""
+        """发送消息；回调返回 False（如模板错误）时保留输入，方便修改后重发"""
         text = self.chat_input.toPlainText().strip()
         if not text:
             return
-        self.on_send_callback(text)
-        self.chat_input.clear()
+        if self.on_send_callback(text):
+            self.chat_input.clear()
 
     def keyPressEvent(self, event):
         """处理键盘事件"""
@@ -652,6 +2373,50 @@ class FloatingChatWindow(QWidget):
             """)
         self.show()
 
+    def dragEnterEvent(self, event):
+        if ChatInput.is_attachment(event.mimeData()):
+            event.acceptProposedAction()
+
+    def dropEvent(self, event):
+        self.add_attachments(event.mimeData())
+        event.acceptProposedAction()
+
+    def add_attachments(self, source):
+        """收下拖入/粘贴的本地文件；剪贴板图片先写入临时 PNG 文件，不在内存中保留"""
+        paths = [url.toLocalFile() for url in source.urls() if url.isLocalFile()] if source.hasUrls() else []
+        paths = [path for path in paths if os.path.isfile(path)]
+        self.attachments.extend((path, False) for path in paths)
+        if not paths and ChatInput.is_image_only(source):
+            fd, path = tempfile.mkstemp(prefix="mlb-clip-", suffix=".png")
+            os.close(fd)
+            if source.imageData().save(path, "PNG"):
+                self.attachments.append((path, True))
+            else:
+                remove_quietly(path)
+        self.set_attachment_status(None)
+
+    def take_attachments(self):
+        """取走待发送的附件（发送时调用）"""
+        attachments, self.attachments = self.attachments, []
+        return attachments
+
+    def clear_attachments(self):
+        for path, temporary in self.take_attachments():
+            if temporary:
+                remove_quietly(path)
+        self.set_attachment_status(None)
+
+    def set_attachment_status(self, text):
+        """显示附件上传进度；text 为 None 时显示待发送附件列表"""
+        if text is None:
+            if not self.attachments:
+                self.attachment_btn.hide()
+                return
+            names = [os.path.basename(path) for path, _ in self.attachments]
+            text = f"📎 {len(names)} 个附件: " + ", ".join(names)
+        self.attachment_btn.setText(text if len(text) <= 60 else text[:57] + "...")
+        self.attachment_btn.show()
+
     def set_enabled(self, enabled):
         """启用/禁用输入"""
         self.chat_input.setEnabled(enabled)
@@ -675,90 +2440,357 @@ class FloatingChatWindow(QWidget):
             self.move(event.globalPos() - self.drag_position)
             event.accept()
 
-class ScreenshotHandler:
-    """截图和上传模块 - 优化版"""
-    def __init__(self, browser_view, terminal_panel):
-        self.browser_view = browser_view
+class FrameProbe(QObject):
+    """帧耗时探针 - 统计悬浮窗每帧的布局 + 绘制耗时和事件循环延迟，定期输出到终端"""
+    FRAME_BUDGET_MS = 16.0
+
+    def __init__(self, terminal_panel, report_interval=5000):
+        super().__init__()
+        self.terminal_panel = terminal_panel
+        self.frames = []
+        self.layout_ms = 0.0
+        self.max_lag_ms = 0.0
+        self.last_tick = time.perf_counter()
+
+        # 16 ms 精确定时器：实际间隔超出部分即为事件循环被阻塞的时间
+        self.ticker = QTimer(self)
+        self.ticker.setTimerType(Qt.PreciseTimer)
+        self.ticker.timeout.connect(self.tick)
+        self.ticker.start(int(self.FRAME_BUDGET_MS))
+        self.report_timer = QTimer(self)
+        self.report_timer.timeout.connect(self.report)
+        self.report_timer.start(report_interval)
+
+    def tick(self):
+        now = time.perf_counter()
+        lag = (now - self.last_tick) * 1000 - self.FRAME_BUDGET_MS
+        self.last_tick = now
+        if lag > self.max_lag_ms:
+            self.max_lag_ms = lag
+
+    def record(self, is_paint, elapsed_ms):
+        """布局耗时累积到下一次重绘，合计为一帧"""
+        if not is_paint:
+            self.layout_ms += elapsed_ms
+            return
+        self.frames.append(self.layout_ms + elapsed_ms)
+        self.layout_ms = 0.0
+
+    def report(self):
+        frames, self.frames = self.frames, []
+        max_lag, self.max_lag_ms = self.max_lag_ms, 0.0
+        if not frames:
+            return
+        frames.sort()
+        p95 = frames[min(len(frames) - 1, int(len(frames) * 0.95))]
+        over = sum(1 for ms in frames if ms > self.FRAME_BUDGET_MS)
+        flag = "✅" if p95 <= self.FRAME_BUDGET_MS else "⚠️"
+        self.terminal_panel.log(
+            f"🎞️ {flag} 帧耗时 p50 {frames[len(frames) // 2]:.1f} ms, p95 {p95:.1f} ms, "
+            f"最大 {frames[-1]:.1f} ms, 超预算 {over}/{len(frames)}, 事件循环最大延迟 {max(0.0, max_lag):.1f} ms")
+
+def process_usage(pid):
+    """进程累计 CPU 时间（秒）和常驻内存（MB），无法获取时返回 None"""
+    try:
+        import psutil
+        process = psutil.Process(pid)
+        times = process.cpu_times()
+        return times.user + times.system, process.memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        # Linux 回退：/proc/<pid>/stat 第 14、15 项为 utime、stime（时钟滴答），statm 第 2 项为常驻页数
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            resident = int(f.read().split()[1])
+        ticks = os.sysconf("SC_CLK_TCK")
+        return ((int(fields[11]) + int(fields[12])) / ticks,
+                resident * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024))
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+def render_process_usage(page):
+    """页面渲染进程的 (pid, 累计 CPU 秒, 常驻内存 MB)，无法获取时返回 None"""
+    pid = page.renderProcessPid() if hasattr(page, 'renderProcessPid') else 0
+    usage = process_usage(pid) if pid else None
+    return (pid, *usage) if usage else None
+
+class ProfilingApplication(QApplication):
+    """带事件计时的 QApplication - 仅在 --profile 时使用，普通运行没有额外开销"""
+    profiler = None
+
+    def notify(self, receiver, event):
+        profiler = self.profiler
+        if profiler is None or not profiler.active or event.type() == QEvent.DeferredDelete:
+            return super().notify(receiver, event)
+        # 分发前取名：处理过程中接收者可能被销毁
+        try:
+            name = profiler.describe(receiver, event)
+        except Exception:
+            return super().notify(receiver, event)
+        started = time.monotonic()
+        try:
+            return super().notify(receiver, event)
+        finally:
+            try:
+                profiler.record_event(name, started, time.monotonic())
+            except Exception:
+                pass    # 分析器自身的错误不能从 notify 中抛出
+
+class Profiler(QObject):
+    """性能分析模式 - 慢事件检测、Python 栈采样、脚本往返时间和渲染进程资源占用
+
+    结果导出为 Chrome trace JSON（chrome://tracing 或 Perfetto 可直接打开）。
+    """
+    EVENT_NAMES = None
+
+    def __init__(self, window, slow_ms=50, sample_interval=0.005, min_event_ms=1.0):
+        super().__init__()
+        self.window = window
+        self.terminal_panel = window.terminal_panel
+        self.slow_ms = slow_ms
+        self.sample_interval = sample_interval
+        self.min_event_ms = min_event_ms
+        self.active = False
+        self.sampler = None
+        self.main_thread_id = threading.get_ident()
+        self.trace = deque(maxlen=200000)    # Chrome trace 事件
+        self.samples = deque(maxlen=200000)  # (时间, 栈元组)
+        self.js_rtts = deque(maxlen=200)
+        self.slow_count = 0
+        self.last_usage = None
+        self.last_cpu = None
+        self.stats_timer = QTimer(self)
+        self.stats_timer.timeout.connect(self.sample_resources)
+        window.browser_view.profiler = self
+        if window.fanout:
+            for lane in window.fanout.lanes:
+                lane.browser_view.profiler = self
+        self.shortcut = QShortcut(QKeySequence("Ctrl+Shift+P"), window.floating_chat)
+        self.shortcut.activated.connect(self.toggle)
+
+    def toggle(self):
+        if self.active:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        if self.active:
+            return
+        self.active = True
+        self.trace.clear()
+        self.samples.clear()
+        self.slow_count = 0
+        self.last_usage = None
+        self.last_cpu = (time.monotonic(), time.process_time())
+        self.sampler = threading.Thread(target=self.sample_stacks, daemon=True)
+        self.sampler.start()
+        self.stats_timer.start(1000)
+        self.terminal_panel.log("🔬 性能分析已开启（Ctrl+Shift+P 停止并导出）")
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        self.stats_timer.stop()
+        self.sampler.join()
+        self.window.floating_chat.set_profile_overlay(None)
+        path = self.export()
+        self.terminal_panel.log(f"🔬 性能分析已停止，trace 已导出: {path}")
+
+    def sample_stacks(self):
+        """后台线程：定期采样 GUI 线程的 Python 调用栈"""
+        while self.active:
+            frame = sys._current_frames().get(self.main_thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.reverse()
+            self.samples.append((time.monotonic(), tuple(stack)))
+            time.sleep(self.sample_interval)
+
+    def describe(self, receiver, event):
+        if Profiler.EVENT_NAMES is None:
+            Profiler.EVENT_NAMES = {int(v): k for k, v in vars(QEvent).items() if isinstance(v, QEvent.Type)}
+        name = type(receiver).__name__
+        if receiver.objectName():
+            name += f"#{receiver.objectName()}"
+        return f"{name}.{Profiler.EVENT_NAMES.get(int(event.type()), int(event.type()))}"
+
+    def record_event(self, name, started, ended):
+        elapsed = (ended - started) * 1000
+        if elapsed < self.min_event_ms:
+            return
+        self.trace.append({'name': name, 'cat': 'qt', 'ph': 'X', 'ts': started * 1e6,
+                           'dur': elapsed * 1000, 'pid': 1, 'tid': 1})
+        if elapsed > self.slow_ms:
+            self.slow_count += 1
+            slot = self.busiest_frame(started, ended)
+            # 延后输出，避免在事件分发过程中修改终端
+            QTimer.singleShot(0, lambda: self.terminal_panel.log(
+                f"🐌 慢处理 {elapsed:.0f} ms: {name}" + (f" → {slot}" if slot else "")))
+
+    def busiest_frame(self, started, ended):
+        """慢事件期间采样最多的本程序函数（取栈中最深的一层），作为槽函数名"""
+        counts = Counter()
+        own_file = os.path.basename(__file__)
+        # 采样线程仍在追加，先整体复制（在 GIL 下一次完成）
+        for ts, stack in reversed(list(self.samples)):
+            if ts < started:
+                break
+            if ts > ended:
+                continue
+            for entry in reversed(stack):
+                if own_file in entry and not entry.startswith(("notify ", "record_event ")):
+                    counts[entry] += 1
+                    break
+        return counts.most_common(1)[0][0] if counts else None
+
+    def record_js(self, kind, started, elapsed):
+        self.js_rtts.append(elapsed)
+        if self.active:
+            self.trace.append({'name': kind, 'cat': 'js', 'ph': 'X', 'ts': started * 1e6,
+                               'dur': elapsed * 1000, 'pid': 1, 'tid': 2})
+
+    def sample_resources(self):
+        """每秒采样一次主进程与渲染进程的 CPU、内存，并刷新浮层"""
+        now = time.monotonic()
+        cpu = time.process_time()
+        main_cpu = (cpu - self.last_cpu[1]) / max(now - self.last_cpu[0], 1e-6) * 100
+        self.last_cpu = (now, cpu)
+        counters = {'main_cpu': round(main_cpu, 1)}
+
+        usage = render_process_usage(self.window.browser_view.web_view.page())
+        renderer = "渲染 -"
+        if usage:
+            pid, renderer_seconds, renderer_mb = usage
+            if self.last_usage and self.last_usage[0] == pid:
+                renderer_cpu = (renderer_seconds - self.last_usage[1]) / max(now - self.last_usage[2], 1e-6) * 100
+                counters['renderer_cpu'] = round(renderer_cpu, 1)
+                renderer = f"渲染 {renderer_cpu:.0f}% {renderer_mb:.0f}MB"
+            counters['renderer_mb'] = round(renderer_mb, 1)
+            self.last_usage = (pid, renderer_seconds, now)
+        self.trace.append({'name': 'resources', 'ph': 'C', 'ts': now * 1e6, 'pid': 1, 'args': counters})
+
+        js = f"JS {statistics.median(self.js_rtts):.0f}ms" if self.js_rtts else "JS -"
+        self.window.floating_chat.set_profile_overlay(
+            f"🔬 慢 {self.slow_count} | {js} | 主 {main_cpu:.0f}% | {renderer}")
+
+    def flame_events(self):
+        """把连续相同的栈采样合并为区间事件，在 trace 中呈现为火焰图"""
+        events = []
+        opened = []     # (栈帧, 开始时间)
+        last_ts = None
+        for ts, stack in self.samples:
+            common = 0
+            while common < len(opened) and common < len(stack) and opened[common][0] == stack[common]:
+                common += 1
+            while len(opened) > common:
+                frame, begin = opened.pop()
+                events.append({'name': frame, 'cat': 'python', 'ph': 'X', 'ts': begin * 1e6,
+                               'dur': (ts - begin) * 1e6, 'pid': 1, 'tid': 3})
+            opened.extend((frame, ts) for frame in stack[common:])
+            last_ts = ts
+        if last_ts is not None:
+            end = last_ts + self.sample_interval
+            for frame, begin in reversed(opened):
+                events.append({'name': frame, 'cat': 'python', 'ph': 'X', 'ts': begin * 1e6,
+                               'dur': (end - begin) * 1e6, 'pid': 1, 'tid': 3})
+        return events
+
+    def export(self):
+        directory = os.path.join(self.window.storage_path, "profiles")
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, datetime.now().strftime("trace-%Y%m%d-%H%M%S.json"))
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in ((1, "Qt 事件"), (2, "页面脚本"), (3, "Python 采样"))]
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': metadata + list(self.trace) + self.flame_events(),
+                       'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        return path
+
+class ScreenCaptureService:
+    """屏幕捕获模块 - 多显示器与高 DPI 感知，按屏幕缓存编码结果"""
+    def __init__(self, terminal_panel, target="window"):
         self.terminal_panel = terminal_panel
+        self.target = target            # "window": 悬浮条所在屏幕，"cursor": 鼠标所在屏幕
+        self.anchor_widget = None
+        self.cache = {}                 # 屏幕名 -> (画面摘要, PNG 字节)
+        self.saved_bytes = 0
+
+    def target_screen(self):
+        """选择要截取的屏幕"""
+        screen = None
+        if self.target == "window" and self.anchor_widget is not None:
+            screen = QApplication.screenAt(self.anchor_widget.frameGeometry().center())
+        if screen is None:
+            screen = QApplication.screenAt(QCursor.pos())
+        return screen or QApplication.primaryScreen()
 
-    def upload_screenshot(self, text, after_upload_callback):
-        """上传截图，不跳过截图步骤"""
-        screen = QApplication.primaryScreen()
-        pixmap = screen.grabWindow(0)
+    def capture(self):
+        """截取目标屏幕并按逻辑分辨率归一化，返回 PNG 字节（截取失败时为空）"""
+        return self.capture_with_digest()[1]
+
+    def capture_with_digest(self):
+        """同 capture，另返回画面像素的 blake2b 摘要（十六进制），供回复缓存作键"""
+        screen = self.target_screen()
+        geometry = screen.geometry()
+        # 桌面窗口跨越所有显示器，按目标屏幕的几何区域截取，否则多屏时会截到整个虚拟桌面
+        pixmap = screen.grabWindow(0, geometry.x(), geometry.y(), geometry.width(), geometry.height())
+        if pixmap.isNull():
+            # 无头显示或没有截屏权限时拿不到画面，本次发送不带截图
+            self.terminal_panel.log(f"⚠️ 无法截取 {screen.name()}，本次不附带截图")
+            return "", b""
+
+        # 高 DPI 屏幕按设备像素截图，缩放回逻辑尺寸再编码
+        device_size = pixmap.size()
+        if device_size.width() > geometry.width() or device_size.height() > geometry.height():
+            pixmap = pixmap.scaled(geometry.size(), Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            pixmap.setDevicePixelRatio(1.0)
+            saved = (device_size.width() * device_size.height() - pixmap.width() * pixmap.height()) * 4
+            self.saved_bytes += saved
+            self.terminal_panel.log(
+                f"📐 {screen.name()} 缩放 {device_size.width()}x{device_size.height()} → "
+                f"{pixmap.width()}x{pixmap.height()}，减少 {saved / 1048576:.1f} MB 像素数据")
+
+        # 画面未变化时直接复用该屏幕上次的编码结果
+        image = pixmap.toImage()
+        bits = image.constBits()
+        bits.setsize(image.byteCount())
+        digest = hashlib.blake2b(bits.asstring(), digest_size=16).digest()
+        cached = self.cache.get(screen.name())
+        if cached and cached[0] == digest:
+            self.terminal_panel.log(f"♻️ {screen.name()} 画面未变化，复用缓存截图")
+            return digest.hex(), cached[1]
 
         byte_array = QByteArray()
         buffer = QBuffer(byte_array)
         buffer.open(QIODevice.WriteOnly)
         pixmap.save(buffer, "PNG")
-        base64_image = byte_array.toBase64().data().decode()
-
-        # 优化后的文件上传脚本
-        js_image = f"""
-        (function() {{
-            try {{
-                const base64 = '{base64_image}';
-                const byteString = atob(base64);
-                const ab = new ArrayBuffer(byteString.length);
-                const ia = new Uint8Array(ab);
-                for (let i = 0; i < byteString.length; i++){{
-                    ia[i] = byteString.charCodeAt(i);
-                }}
-
-                const blob = new Blob([ab], {{type: 'image/png'}});
-                const file = new File([blob], 'screenshot.png', {{type: 'image/png'}});
-
-                // 扩展文件输入选择器列表
-                const fileSelectors = [
-                    'input[type="file"]',
-                    'input[accept*="image"]',
-                    'input[data-testid*="upload"]',
-                    'input[data-testid*="file"]',
-                    'input.semi-upload-input',
-                    'input[class*="upload"]',
-                    'input[class*="file"]',
-                    '.upload-button input',
-                    '[class*="attachment"] input',
-                    '[class*="file-input"]'
-                ];
-
-                let fileInput = null;
-                for (let selector of fileSelectors){{
-                    const elements = document.querySelectorAll(selector);
-                    if (elements.length > 0) {{
-                        // 找到第一个可见或存在的文件输入
-                        for (let el of elements) {{
-                            if (!el.disabled) {{
-                                fileInput = el;
-                                console.log('✅ 找到文件输入:', selector);
-                                break;
-                            }}
-                        }}
-                        if (fileInput) break;
-                    }}
-                }}
-                
-                if (!fileInput){{
-                    console.log('⚠️ 未找到文件输入，继续执行但不影响文字发送');
-                    // 不返回false，继续执行以确保文字发送
-                }}
-                
-                const dt = new DataTransfer();
-                dt.items.add(file);
-                fileInput.files = dt.files;
-                
-                // 触发多种事件确保上传生效
-                ['change', 'input'].forEach(eventType => {{
-                    fileInput.dispatchEvent(new Event(eventType, {{ bubbles: true, cancelable: true }}));
-                }});
-                
-                console.log('✅ 截图上传成功');
-                return true;
-            }} catch (error) {{
-                console.error('❌ 截图上传异常:', error);
-                return false;
-            }}
-        }})();
-        """
+        png = byte_array.data()
+        self.cache[screen.name()] = (digest, png)
+        self.terminal_panel.log(f"🖼️ 截取 {screen.name()}: {len(png) / 1024:.0f} KB PNG")
+        return digest.hex(), png
+
+class ScreenshotHandler:
+    """截图和上传模块 - 优化版"""
+    def __init__(self, browser_view, terminal_panel):
+        self.browser_view = browser_view
+        self.terminal_panel = terminal_panel
+        self.capture_service = ScreenCaptureService(terminal_panel)
+
+    def upload_screenshot(self, text, after_upload_callback, token=None, image=None):
+        """上传截图，不跳过截图步骤（image 为已截好的 PNG 字节时直接使用，空值表示截图失败）"""
+        png = self.capture_service.capture() if image is None else image
+        if not png:
+            QTimer.singleShot(0, lambda: token is not None and token.cancelled or after_upload_callback(text))
+            return
 
         def handle_result(result):
             if result:
@@ -766,13 +2798,348 @@ class ScreenshotHandler:
             else:
                 self.terminal_panel.log("⚠️ 截图上传过程已执行（可能未找到上传位置）")
             # 无论截图是否成功，都执行文字发送
-            QTimer.singleShot(1500, lambda: after_upload_callback(text))
+            QTimer.singleShot(1500, lambda: token is not None and token.cancelled or after_upload_callback(text))
+
+        self.browser_view.attach_files(AttachmentServer.shared(), [("screenshot.png", "image/png", png)],
+                                       handle_result, token)
+
+class RendererSupervisor(QObject):
+    """渲染进程守护 - 处理渲染进程崩溃、脚本超时和事件循环卡死，重载页面后重发未完成的消息
+
+    window 为主窗口或扇出通道，需提供 browser_view、response_monitor、terminal_panel、pending_message
+    以及 load_homepage / resend_pending_message / abort_pending_message。
+    """
+    def __init__(self, window, js_deadline=15.0, heartbeat_interval=3000, max_retries=3, watch_event_loop=True):
+        super().__init__()
+        self.window = window
+        self.watch_event_loop = watch_event_loop   # GUI 事件循环延迟只由主窗口的守护报告一次
+        self.js_deadline = js_deadline
+        self.heartbeat_interval = heartbeat_interval
+        self.max_retries = max_retries
+        self.retries = 0
+        self.recovering = False
+        self.failure_at = None
+        self.last_tick = time.monotonic()
+
+        web_view = window.browser_view.web_view
+        web_view.renderProcessTerminated.connect(self.on_render_terminated)
+        web_view.loadFinished.connect(self.on_load_finished)
+        window.response_monitor.reply_finished.connect(self.on_reply_finished)
+
+        self.heartbeat = QTimer(self)
+        self.heartbeat.timeout.connect(self.beat)
+        self.heartbeat.start(heartbeat_interval)
+
+    def beat(self):
+        """心跳：检查 GUI 事件循环延迟和未返回的脚本调用"""
+        now = time.monotonic()
+        lag = now - self.last_tick - self.heartbeat_interval / 1000
+        self.last_tick = now
+        if lag > 1.0 and self.watch_event_loop:
+            self.window.terminal_panel.log(f"🐢 GUI 事件循环延迟 {lag:.1f}s")
+        if self.recovering:
+            return
+
+        browser_view = self.window.browser_view
+        age = browser_view.oldest_pending_age()
+        if age > self.js_deadline:
+            self.recover(f"脚本 {age:.0f}s 未返回，渲染进程可能卡死")
+        elif not browser_view.pending:
+            # 空闲时发一次空脚本作为渲染进程心跳
+            browser_view.run_javascript("1", kind="heartbeat", priority=PRIORITY_BACKGROUND)
+
+    def on_render_terminated(self, status, exit_code):
+        if status == QWebEnginePage.NormalTerminationStatus:
+            return
+        self.recover(f"渲染进程异常退出 (状态 {int(status)}, 退出码 {exit_code})")
+
+    def recover(self, reason):
+        """停止监控、丢弃未返回的调用并重载页面；超过重试次数则放弃当前消息"""
+        if self.recovering:
+            return
+        self.retries += 1
+        self.recovering = True
+        self.failure_at = time.monotonic()
+        self.window.terminal_panel.log(f"🚑 {reason}，开始恢复 ({self.retries}/{self.max_retries})")
+
+        self.window.response_monitor.stop()
+        self.window.browser_view.reset_pending()
+        if self.retries > self.max_retries:
+            self.window.terminal_panel.log("❌ 恢复失败次数过多，放弃当前消息")
+            self.window.abort_pending_message()
+            self.retries = 0
+        backoff = min(1000 * 2 ** max(0, self.retries - 1), 30000)
+        QTimer.singleShot(backoff, self.window.load_homepage)
+
+    def on_load_finished(self, ok):
+        if not self.recovering:
+            return
+        self.recovering = False
+        if not ok:
+            self.recover("恢复时页面加载失败")
+            return
+        elapsed = time.monotonic() - self.failure_at
+        self.window.terminal_panel.log(f"♻️ 页面已恢复，用时 {elapsed:.1f}s")
+        if self.window.pending_message:
+            QTimer.singleShot(2000, self.window.resend_pending_message)
+
+    def on_reply_finished(self, text):
+        self.retries = 0
+
+class CompletionStrategy:
+    """回复完成判定策略基类：每次轮询收到页面信号，返回是否判定完成"""
+    name = "base"
+
+    def reset(self):
+        pass
+
+    def update(self, probe, now):
+        raise NotImplementedError
+
+class StableLengthStrategy(CompletionStrategy):
+    """无停止按钮且回复长度连续多次不变"""
+    name = "stable_length"
+
+    def __init__(self, readings=3):
+        self.readings = readings
+
+    def reset(self):
+        self.last_length = 0
+        self.stable_count = 0
+
+    def update(self, probe, now):
+        length = probe.get('replyLength', 0)
+        if probe.get('stopVisible') or not probe.get('hasBot') or length == 0:
+            self.stable_count = 0
+            return False
+        if length == self.last_length:
+            self.stable_count += 1
+        else:
+            self.stable_count = 0
+            self.last_length = length
+        return self.stable_count >= self.readings
+
+class StopButtonStrategy(CompletionStrategy):
+    """停止按钮出现过且已消失"""
+    name = "stop_button"
+
+    def reset(self):
+        self.seen_stop = False
+
+    def update(self, probe, now):
+        if probe.get('stopVisible'):
+            self.seen_stop = True
+            return False
+        return self.seen_stop and probe.get('hasBot') and probe.get('replyLength', 0) > 0
+
+class StreamClosedStrategy(CompletionStrategy):
+    """本轮打开过的流式响应已全部关闭（需要注入流式响应钩子）"""
+    name = "stream_closed"
+
+    def reset(self):
+        self.baseline = None
+
+    def update(self, probe, now):
+        closed = probe.get('closedStreams', -1)
+        if closed < 0:
+            return False
+        if self.baseline is None:
+            self.baseline = closed
+        return (probe.get('openStreams', 0) == 0 and closed > self.baseline
+                and probe.get('hasBot') and probe.get('replyLength', 0) > 0)
+
+class QuiescenceStrategy(CompletionStrategy):
+    """回复节点在一段时间内没有任何 DOM 变化"""
+    name = "quiescence"
+
+    def __init__(self, idle_ms=2500):
+        self.idle_ms = idle_ms
+
+    def update(self, probe, now):
+        return (not probe.get('stopVisible') and probe.get('hasBot')
+                and probe.get('replyLength', 0) > 0 and probe.get('idleMs', 0) >= self.idle_ms)
+
+class EndMarkerStrategy(CompletionStrategy):
+    """回复结束后出现的标记元素（如"重新生成"按钮）数量增加"""
+    name = "end_marker"
+
+    def __init__(self, selector):
+        self.selector = selector
+
+    def reset(self):
+        self.baseline = None
+
+    def update(self, probe, now):
+        count = probe.get('markerCount', 0)
+        if self.baseline is None:
+            self.baseline = count
+            return False
+        return count > self.baseline and probe.get('hasBot') and probe.get('replyLength', 0) > 0
+
+COMPLETION_STRATEGIES = {
+    'stable_length': StableLengthStrategy,
+    'stop_button': StopButtonStrategy,
+    'stream_closed': StreamClosedStrategy,
+    'quiescence': QuiescenceStrategy,
+    'end_marker': EndMarkerStrategy,
+}
+
+# 各站点（按 origin）的判定策略：第一个负责决策，其余只做影子评估以积累精度和延迟数据
+SITE_COMPLETION_STRATEGIES = {
+    'https://www.doubao.com': [
+        'stable_length', 'stop_button', 'quiescence', 'stream_closed',
+        ('end_marker', {'selector': 'button[data-testid*="regenerate"], button[aria-label*="重新生成"]'}),
+    ],
+    'default': ['stable_length', 'stop_button', 'quiescence'],
+}
+
+# 页面错误/提示节点中出现这些内容时视为当前账号被限流（回复正文不参与判断）
+THROTTLE_PATTERNS = ("请求过于频繁", "操作太频繁", "稍后再试", "rate limit", "too many requests")
+
+def throttle_reason(signal):
+    """解析页面 throttleSignal 的结果，被限流时返回原因描述，否则返回 None"""
+    if not signal:
+        return None
+    if signal.get('responses'):
+        return f"HTTP 429 × {signal['responses']}"
+    if signal.get('notice'):
+        return f"提示「{signal['notice'][:40]}」"
+    return None
+
+# 直接从网络回复流组装回复正文、并以流结束作为完成信号的站点（opt-in）；
+# 本轮未捕获到流式响应（或流中没有可识别的文本）时回退为从 DOM 取正文和判定
+NETWORK_CAPTURE_ORIGINS = set()
+
+def site_origin(url):
+    """返回 URL 的 origin（scheme://host[:port]）"""
+    qurl = QUrl(url)
+    origin = f"{qurl.scheme()}://{qurl.host()}"
+    if qurl.port() != -1:
+        origin += f":{qurl.port()}"
+    return origin
+
+def site_strategy_specs(url):
+    return SITE_COMPLETION_STRATEGIES.get(site_origin(url), SITE_COMPLETION_STRATEGIES['default'])
+
+def site_needs_stream_hook(url):
+    """站点是否需要注入流式响应钩子"""
+    return (site_origin(url) in NETWORK_CAPTURE_ORIGINS
+            or any(spec == 'stream_closed' for spec in site_strategy_specs(url)))
+
+def build_strategy(spec):
+    name, kwargs = (spec, {}) if isinstance(spec, str) else spec
+    return COMPLETION_STRATEGIES[name](**kwargs)
+
+class CompletionEngine:
+    """回复完成判定引擎 - 按站点选择策略，并统计每个策略的精度和延迟
+
+    精度：策略触发时的回复长度等于稳定后的最终长度即为准确，否则为过早判定；
+    延迟：从回复最后一次变化到策略触发的时间。
+    决策策略触发后进入稳定期：继续采集一段时间，让较慢的影子策略也有机会触发，
+    并以稳定期结束时的长度作为最终长度结算。
+    """
+    SETTLE_SECONDS = 8.0
+
+    def __init__(self):
+        self.strategies = []
+        self.marker_selector = None
+        self.network_capture = False
+        self.origin = None
+        self.stats = {}   # (origin, 策略名) -> {'fired', 'premature', 'latency'}
+        self.fired = {}
+        self.last_change = 0.0
+        self.last_length = 0
+        self.settling = False
+        self.settle_deadline = 0.0
+        self.final_length = 0
+
+    def reset(self, url):
+        origin = site_origin(url)
+        if origin != self.origin:
+            self.origin = origin
+            self.strategies = [build_strategy(spec) for spec in site_strategy_specs(url)]
+            self.marker_selector = next(
+                (s.selector for s in self.strategies if isinstance(s, EndMarkerStrategy)), None)
+        self.network_capture = origin in NETWORK_CAPTURE_ORIGINS
+        for strategy in self.strategies:
+            strategy.reset()
+        self.fired = {}
+        self.last_change = time.perf_counter()
+        self.last_length = 0
+        self.settling = False
+
+    def observe(self, probe):
+        now = time.perf_counter()
+        length = probe.get('replyLength', 0)
+        if self.settling and not (probe.get('hasBot') and length):
+            return   # 稳定期内页面暂时取不到回复，不当作回复变短
+        if length != self.last_length:
+            self.last_length = length
+            self.last_change = now
+        for strategy in self.strategies:
+            if strategy.name not in self.fired and strategy.update(probe, now):
+                self.fired[strategy.name] = (now, length)
+
+    def is_complete(self):
+        return bool(self.strategies) and self.strategies[0].name in self.fired
+
+    def begin_settle(self, final_length):
+        """决策完成，进入稳定期；final_length 为决策时取回的全文长度"""
+        self.settling = True
+        self.settle_deadline = time.perf_counter() + self.SETTLE_SECONDS
+        self.final_length = final_length
+
+    def settle_due(self):
+        """稳定期已到，或所有策略都已触发"""
+        return (time.perf_counter() >= self.settle_deadline
+                or all(s.name in self.fired for s in self.strategies))
+
+    def finalize(self):
+        """稳定期结束时结算各策略的表现，最终长度取稳定期内观察到的长度"""
+        if not self.settling:
+            return False
+        self.settling = False
+        final_length = max(self.final_length, self.last_length)
+        for name, (fired_at, length) in self.fired.items():
+            stat = self.stats.setdefault((self.origin, name), {'fired': 0, 'premature': 0, 'latency': 0.0})
+            stat['fired'] += 1
+            if length < final_length:
+                stat['premature'] += 1
+            else:
+                stat['latency'] += max(0.0, fired_at - self.last_change)
+        return True
 
-        self.browser_view.run_javascript(js_image, handle_result)
+    def last_summary(self):
+        parts = []
+        for strategy in self.strategies:
+            fired = self.fired.get(strategy.name)
+            if fired is None:
+                parts.append(f"{strategy.name} 未触发")
+            elif fired[1] < max(self.final_length, self.last_length):
+                parts.append(f"{strategy.name} 过早")
+            else:
+                parts.append(f"{strategy.name} {fired[0] - self.last_change:.1f}s")
+        return ", ".join(parts)
+
+    def report(self):
+        """各站点各策略的累计精度与平均延迟"""
+        lines = []
+        for (origin, name), stat in sorted(self.stats.items()):
+            accurate = stat['fired'] - stat['premature']
+            precision = accurate / stat['fired'] if stat['fired'] else 0.0
+            latency = stat['latency'] / accurate if accurate else 0.0
+            lines.append(f"{origin} {name}: 精度 {precision:.0%} ({stat['fired']} 次), 平均延迟 {latency:.1f}s")
+        return lines
 
-class ResponseMonitor:
+class ResponseMonitor(QObject):
     """回复监控模块 - 优化版"""
+    reply_delta = pyqtSignal(str)       # 回复新增内容（仅在有接收者时计算）
+    reply_replaced = pyqtSignal(str)    # 已推送的内容被页面改写，参数为当前全文
+    reply_finished = pyqtSignal(str)    # 回复完成，参数为完整回复
+    user_message_detected = pyqtSignal(bool)  # 用户消息检测结束，参数表示是否在页面上找到
+
     def __init__(self, browser_view, terminal_panel, floating_chat, history_panel):
+        super().__init__()
         self.browser_view = browser_view
         self.terminal_panel = terminal_panel
         self.floating_chat = floating_chat
@@ -781,75 +3148,48 @@ class ResponseMonitor:
         self.waiting_logged = False
         self.user_check_count = 0
         self.last_reply_length = 0
-        self.stable_count = 0
+        self.streamed_length = 0
+        self.streamed_text = ""
+        self.final_attempts = 0
+        self.net_done = False
+        self.current_user_message = None
+        self.token = CancelToken()
+        self.completion = CompletionEngine()
+        self.settle_timer = QTimer(self)
+        self.settle_timer.timeout.connect(self.settle_tick)
+
+    def begin(self, message_id):
+        """开始一条新消息：作废上一条消息的所有脚本回调"""
+        self.token.cancel()
+        self.token = CancelToken(message_id)
+
+    def stop(self):
+        """停止监控并丢弃本轮状态，之后到达的回调不再生效"""
+        self.token.cancel()
+        if self.timer:
+            self.timer.stop()
+        self.end_settle()
+        self.waiting_logged = False
+        self.user_check_count = 0
+        self.last_reply_length = 0
+        self.streamed_length = 0
+        self.streamed_text = ""
+        self.final_attempts = 0
+        self.net_done = False
         self.current_user_message = None
 
-    def check_user_message_appeared(self, text):
-        """优化的用户消息检测"""
+    def check_user_message_appeared(self, text, page_text=None):
+        """优化的用户消息检测；page_text 为页面上实际显示的文字（长文本改为附件发送时是说明文字），
+        历史记录保存完整的 text"""
         self.current_user_message = text
+        probe_text = text if page_text is None else page_text
+        token = self.token
         
-        # 更安全的文本转义
-        safe_text = (text.replace("\\", "\\\\")
-                         .replace("'", "\\'")
-                         .replace('"', '\\"')
-                         .replace("\n", "\\n"))
-
-        # 优化后的检测脚本
-        js = """
-        (function() {{
-            try {{
-                const searchText = '{text}';
-                
-                // 扩展选择器列表
-                const possibleSelectors = [
-                    '[data-role="user-message"]',
-                    '[class*="user"]',
-                    '[class*="role-user"]',
-                    '[class*="msg-bubble"]',
-                    '[class*="message"]',
-                    '[data-testid*="message"]',
-                    'div[class*="chat"] > div',
-                    '.markdown-body',
-                    'p', 'span', 'div'
-                ];
-
-                let found = false;
-                
-                // 方法1: 通过选择器查找
-                for (let sel of possibleSelectors) {{
-                    const els = document.querySelectorAll(sel);
-                    for (let el of els) {{
-                        const txt = el.textContent.trim();
-                        if (txt && txt.includes(searchText.substring(0, 50))) {{
-                            console.log('✅ 找到用户消息(选择器):', sel);
-                            found = true;
-                            break;
-                        }}
-                    }}
-                    if (found) break;
-                }}
-                
-                // 方法2: 如果方法1失败，使用全局搜索
-                if (!found) {{
-                    const bodyText = document.body.textContent;
-                    if (bodyText.includes(searchText.substring(0, 50))) {{
-                        console.log('✅ 找到用户消息(全局搜索)');
-                        found = true;
-                    }}
-                }}
-                
-                return found;
-            }} catch (error) {{
-                console.error('❌ 检测用户消息异常:', error);
-                return false;
-            }}
-        }})();
-        """.format(text=safe_text[:100])  # 只取前100个字符进行匹配
-
         def handle(result):
             if result:
                 self.terminal_panel.log("✅ 用户消息已出现在页面上")
-                if self.current_user_message:
+                self.user_message_detected.emit(True)
+                if self.current_user_message and self.history_panel:
                     self.history_panel.add_message(self.current_user_message, is_user=True)
                 self.terminal_panel.log("🔍 开始监测豆包回复状态…")
                 self.start_monitoring()
@@ -857,165 +3197,1634 @@ class ResponseMonitor:
                 self.user_check_count += 1
                 if self.user_check_count < 15:  # 增加重试次数到15次
                     self.terminal_panel.log(f"⏳ 等待用户消息出现... ({self.user_check_count}/15)")
-                    QTimer.singleShot(800, lambda: self.check_user_message_appeared(text))
+                    QTimer.singleShot(800, lambda: token.cancelled or self.check_user_message_appeared(text, page_text))
                 else:
                     self.terminal_panel.log("⚠️ 消息可能已发送，但未在页面检测到（开始监测回复）")
+                    self.user_message_detected.emit(False)
                     # 即使没检测到用户消息，也添加到历史并开始监测回复
-                    if self.current_user_message:
+                    if self.current_user_message and self.history_panel:
                         self.history_panel.add_message(self.current_user_message, is_user=True)
                     self.start_monitoring()
 
-        self.browser_view.run_javascript(js, handle)
+        # 只取前100个字符进行匹配
+        self.browser_view.call("hasUserMessage", probe_text[:100], callback=handle, token=token)
 
-    def check_response_complete(self):
-        """检查回复是否完成"""
-        js = """
-        (function() {
-            try {
-                // 检查是否有停止按钮
-                const stopBtn = document.querySelector(
-                    'button[data-testid*="stop"], ' +
-                    'button[aria-label*="停止"], ' +
-                    'button[class*="stop"], ' +
-                    'button[class*="abort"]'
-                );
-                if (stopBtn && stopBtn.offsetParent !== null) {
-                    return { complete: false, reason: 'has_stop_button', replyLength: 0 };
-                }
+    def check_response_complete(self, with_text=False):
+        """采集回复状态，交给判定策略决定是否完成"""
+        def handle(probe):
+            if with_text and not (probe and probe.get('hasBot') and 'replyText' in probe):
+                self.final_text_missing()
+                return
+            if not probe:
+                return
 
-                // 查找消息列表
-                const msgSelectors = [
-                    'div[data-testid="message_text_content"]',
-                    'div.msg-bubble',
-                    'div[class*="message-content"]',
-                    'div[class*="markdown-body"]',
-                    'div[class*="chat-message"]',
-                    '.markdown-body',
-                    '[class*="assistant"] > div',
-                    '[data-role*="assistant"]'
-                ];
-                
-                let msgs = [];
-                for (let sel of msgSelectors) {
-                    const found = document.querySelectorAll(sel);
-                    if (found && found.length > 0) {
-                        msgs = Array.from(found);
-                        break;
-                    }
-                }
-                
-                if (msgs.length === 0) {
-                    return { complete: false, reason: 'no_messages', replyLength: 0 };
-                }
+            # 已推送长度以页面返回的 UTF-16 长度为准，与下次请求的 since 同一单位
+            self.streamed_length = probe.get('streamedLength', self.streamed_length)
+            reply_delta = probe.get('replyDelta')
+            if reply_delta:
+                self.streamed_text += reply_delta
+                self.reply_delta.emit(reply_delta)
+            elif 'replyReplace' in probe:
+                self.streamed_text = probe['replyReplace']
+                self.reply_replaced.emit(probe['replyReplace'])
 
-                // 获取最后一条消息
-                const lastMsg = msgs[msgs.length - 1];
-                const text = lastMsg.textContent.trim();
-                const len = text.length;
-                
-                // 判断是否是机器人消息
-                const cls = lastMsg.className || '';
-                const role = lastMsg.getAttribute('data-role') || '';
-                const isBot = cls.includes('assistant') || 
-                             cls.includes('bot') || 
-                             cls.includes('markdown-body') ||
-                             role.includes('assistant');
-
-                if (!isBot) {
-                    return { complete: false, reason: 'no_bot_reply', replyLength: 0 };
-                }
+            if 'replyText' in probe:
+                self.finish_reply(probe['replyText'])
+                return
 
-                return { complete: true, reason: 'ok', replyLength: len, replyText: text };
-            } catch (error) {
-                console.error('❌ 检查回复异常:', error);
-                return { complete: false, reason: 'error', replyLength: 0 };
-            }
-        })();
-        """
-        
-        def handle(result):
-            if not result:
+            self.completion.observe(probe)
+            if probe.get('netDone'):
+                # 本轮回复流已关闭：正文就是流中拼出的全文，不再等 DOM 判定策略
+                if self.timer:
+                    self.timer.stop()
+                if not self.net_done:
+                    self.net_done = True
+                    self.terminal_panel.log(f"🌐 回复流已结束（{probe.get('replyLength', 0)} 字符），取回流式正文")
+                self.check_response_complete(with_text=True)
                 return
-                
-            if not result.get('complete', False):
-                reason = result.get('reason', 'unknown')
-                if reason == 'has_stop_button':
-                    if not self.waiting_logged:
+
+            if not probe.get('hasBot'):
+                if not self.waiting_logged:
+                    if probe.get('stopVisible'):
                         self.terminal_panel.log("💬 正在回复中…")
-                        self.waiting_logged = True
-                elif reason == 'no_bot_reply':
-                    if not self.waiting_logged:
+                    else:
                         self.terminal_panel.log("⏳ 等待机器人回复...")
-                        self.waiting_logged = True
+                    self.waiting_logged = True
                 return
 
-            current_len = result.get('replyLength', 0)
-            reply_text = result.get('replyText', '')
-            
-            if current_len > 0:
-                if current_len == self.last_reply_length:
-                    self.stable_count += 1
-                    self.terminal_panel.log(f"⏳ 回复稳定检测: {current_len} 字符 ({self.stable_count}/3)")
-                    
-                    if self.stable_count >= 3:
-                        if self.timer:
-                            self.timer.stop()
-                        
-                        self.terminal_panel.log("=" * 50)
-                        self.terminal_panel.log("🤖 豆包回复完成:")
-                        self.terminal_panel.log(f"字数: {current_len}")
-                        self.terminal_panel.log("-" * 50)
-                        self.terminal_panel.log(reply_text[:200] + "..." if len(reply_text) > 200 else reply_text)
-                        self.terminal_panel.log("=" * 50)
-                        
-                        # 添加到历史记录
-                        self.history_panel.add_message(reply_text, is_user=False)
-                        
-                        # 重置状态并启用输入
-                        self.floating_chat.set_enabled(True)
-                        self.floating_chat.focus_input()
-                        self.waiting_logged = False
-                        self.user_check_count = 0
-                        self.last_reply_length = 0
-                        self.stable_count = 0
-                        self.current_user_message = None
-                else:
-                    self.stable_count = 0
-                    self.last_reply_length = current_len
-                    self.terminal_panel.log(f"📝 回复更新: {current_len} 字符")
-                    
-        self.browser_view.run_javascript(js, handle)
+            current_len = probe.get('replyLength', 0)
+            if current_len != self.last_reply_length:
+                self.last_reply_length = current_len
+                self.terminal_panel.log(f"📝 回复更新: {current_len} 字符")
+
+            if self.completion.is_complete():
+                # 判定完成后停止轮询，再取回一次全文
+                if self.timer:
+                    self.timer.stop()
+                self.check_response_complete(with_text=True)
+
+        # 没有流式订阅者时不取增量
+        since = self.streamed_length if self.receivers(self.reply_delta) > 0 else -1
+        self.browser_view.call("checkResponse", with_text, since, self.completion.marker_selector,
+                               self.completion.network_capture, callback=handle, token=self.token)
+
+    MAX_FINAL_ATTEMPTS = 3
+
+    def final_text_missing(self):
+        """判定完成后取全文失败（页面重绘、脚本异常）：有已推送的文本就用它，否则恢复轮询重试"""
+        self.final_attempts += 1
+        if self.streamed_text and self.final_attempts >= self.MAX_FINAL_ATTEMPTS:
+            self.terminal_panel.log("⚠️ 无法取回回复全文，使用已推送的内容")
+            self.finish_reply(self.streamed_text)
+            return
+        self.terminal_panel.log(f"⚠️ 取回回复全文失败，继续轮询 ({self.final_attempts})")
+        if self.timer and not self.token.cancelled:
+            self.timer.start()
+
+    def settle_tick(self):
+        """稳定期轮询：只喂给判定引擎，让影子策略继续评估"""
+        if self.completion.settle_due():
+            self.end_settle()
+            return
+        # 与决策时取正文的来源一致（网络流或 DOM），长度才可比
+        self.browser_view.call("checkResponse", False, -1, self.completion.marker_selector,
+                               self.completion.network_capture,
+                               callback=lambda probe: probe and self.completion.observe(probe),
+                               token=self.settle_token, priority=PRIORITY_BACKGROUND)
+
+    def end_settle(self):
+        """结束稳定期并结算策略统计（新消息开始时提前结算）"""
+        self.settle_timer.stop()
+        if self.completion.finalize():
+            self.terminal_panel.log("📏 判定策略: " + self.completion.last_summary())
+
+    def finish_reply(self, reply_text):
+        """回复完成：记录日志和历史，恢复输入"""
+        self.completion.begin_settle(len(reply_text))
+        self.settle_token = self.token
+        self.settle_timer.start(1500)
+        self.terminal_panel.log("=" * 50)
+        self.terminal_panel.log("🤖 豆包回复完成:")
+        self.terminal_panel.log(f"字数: {len(reply_text)}")
+        self.terminal_panel.log("-" * 50)
+        self.terminal_panel.log(reply_text[:200] + "..." if len(reply_text) > 200 else reply_text)
+        self.terminal_panel.log("=" * 50)
+
+        # 添加到历史记录（扇出模式下由协调器统一写入）
+        if self.history_panel:
+            self.history_panel.add_message(reply_text, is_user=False)
+
+        # 重置状态并启用输入
+        if self.floating_chat:
+            self.floating_chat.set_enabled(True)
+            self.floating_chat.focus_input()
+        self.waiting_logged = False
+        self.user_check_count = 0
+        self.last_reply_length = 0
+        self.streamed_length = 0
+        self.streamed_text = ""
+        self.final_attempts = 0
+        self.net_done = False
+        self.current_user_message = None
+        self.reply_finished.emit(reply_text)
 
     def start_monitoring(self):
         """开始监控回复"""
         if self.timer and self.timer.isActive():
             self.timer.stop()
+        self.end_settle()
         
+        self.completion.reset(self.browser_view.web_view.url().toString())
         self.timer = QTimer()
         self.timer.timeout.connect(self.check_response_complete)
         self.timer.start(1500)  # 缩短检测间隔到1.5秒
         
         self.terminal_panel.log("⌛ 等待回复中…")
         self.waiting_logged = False
-class MinimalLightBrowser(QMainWindow):
-    """主窗口类 - 负责整体窗口布局和协调各个模块"""
-    def __init__(self):
+        self.streamed_length = 0
+        self.streamed_text = ""
+        self.final_attempts = 0
+        self.net_done = False
+
+CODE_BLOCK_RE = re.compile(r"```([\w+#.-]*)[^\n]*\n(.*?)```", re.S)
+ASCII_WORD_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+CJK_RUN_RE = re.compile(r"[\u4e00-\u9fff]{2,}")
+STOP_WORDS = {
+    'the', 'and', 'for', 'with', 'that', 'this', 'are', 'you', 'not', 'can', 'from',
+    '我们', '你的', '可以', '一个', '这个', '如果', '以及', '需要', '进行', '没有'
+}
+# 未标注语言的代码块按特征片段猜测语言
+LANGUAGE_HINTS = [
+    ('python', ('def ', 'import ', 'print(', 'self.', 'elif ')),
+    ('javascript', ('function ', 'const ', 'let ', '=>', 'console.')),
+    ('java', ('public class', 'System.out', 'private ', 'void ')),
+    ('cpp', ('#include', 'std::', 'cout <<')),
+    ('sql', ('SELECT ', 'FROM ', 'WHERE ', 'INSERT INTO')),
+    ('bash', ('#!/bin/', 'echo ', 'sudo ', '$ ')),
+    ('html', ('<div', '<html', '</')),
+    ('json', ('{"', '": ')),
+]
+
+def detect_language(code):
+    """根据特征片段猜测代码语言"""
+    best, best_score = None, 0
+    for language, hints in LANGUAGE_HINTS:
+        score = sum(code.count(hint) for hint in hints)
+        if score > best_score:
+            best, best_score = language, score
+    return best
+
+class SiteLog:
+    """给日志加上站点前缀，扇出模式下区分各站点的输出"""
+    def __init__(self, terminal_panel, name):
+        self.terminal_panel = terminal_panel
+        self.prefix = f"[{name}] "
+
+    def log(self, message):
+        self.terminal_panel.log(self.prefix + message)
+
+class SiteLane(QObject):
+    """扇出通道 - 一个站点一个独立视图、选择器配置和回复监控
+
+    profile_source 返回当前应使用的浏览器配置，每次发送前取一次，配置轮换后通道随之切换；
+    通道提供与主窗口相同的 browser_view / response_monitor / pending_message 等接口，
+    由自己的 RendererSupervisor 守护渲染进程。
+    """
+    finished = pyqtSignal(object, str)  # (通道, 回复)
+    failed = pyqtSignal(object)
+
+    def __init__(self, name, spec, profile_source, terminal_panel):
         super().__init__()
-        self.setup_storage()
-        
-        # 创建组件
-        self.history_panel = HistoryPanel()
+        self.name = name
+        self.url = spec['url']
+        self.profile_source = profile_source
+        self.log = SiteLog(terminal_panel, name)
+        self.terminal_panel = self.log
+        self.browser_view = BrowserView(profile_source(), self.log)
+        self.browser_view.set_selectors(spec.get('selectors'))
+        if site_needs_stream_hook(self.url):
+            self.browser_view.enable_stream_hook()
+        self.screenshot_handler = ScreenshotHandler(self.browser_view, self.log)
+        self.monitor = ResponseMonitor(self.browser_view, self.log, None, None)
+        self.response_monitor = self.monitor
+        self.monitor.reply_finished.connect(lambda text: self.finished.emit(self, text))
+        self.started = None
+        self.latency = None
+        self.reply = None
+        self.pending = None             # 进行中的 (文本, 截图)
+        self.awaiting_load = False      # 切换配置后等页面加载完再发送
+        self.state = 'idle'             # idle / running / done / failed
+        self.latencies = deque(maxlen=20)
+        self.wins = 0
+        self.browser_view.web_view.loadFinished.connect(self.on_load_finished)
+        self.supervisor = RendererSupervisor(self, watch_event_loop=False)
+        self.load_homepage()
+
+    @property
+    def pending_message(self):
+        return self.pending[0] if self.pending and self.state == 'running' else None
+
+    def load_homepage(self):
+        self.browser_view.load_url(self.url)
+
+    def send(self, text, image):
+        self.monitor.stop()
+        self.monitor.begin(uuid.uuid4().hex)
+        self.started = time.monotonic()
+        self.latency = None
+        self.state = 'running'
+        self.pending = (text, image)
+        profile = self.profile_source()
+        if profile is not self.browser_view.web_view.page().profile():
+            self.log.log("🔀 浏览器配置已轮换，重新加载后发送")
+            self.browser_view.set_profile(profile)
+            self.awaiting_load = True
+            self.load_homepage()
+            return
+        self.upload()
+
+    def upload(self):
+        text, image = self.pending
+        self.screenshot_handler.upload_screenshot(text, self.send_text, self.monitor.token, image)
+
+    def on_load_finished(self, ok):
+        if not self.awaiting_load or self.state != 'running':
+            return
+        self.awaiting_load = False
+        if not ok:
+            self.abort_pending_message()
+            return
+        token = self.monitor.token
+        QTimer.singleShot(1500, lambda: token.cancelled or self.upload())
+
+    def resend_pending_message(self):
+        """渲染进程恢复后重发（保留原始开始时间，延迟统计包含恢复耗时）"""
+        if not self.pending_message:
+            return
+        self.log.log("🔁 重新发送未完成的消息")
+        self.monitor.stop()
+        self.monitor.begin(uuid.uuid4().hex)
+        self.upload()
+
+    def abort_pending_message(self):
+        if self.state != 'running':
+            return
+        self.monitor.stop()
+        self.state = 'failed'
+        self.failed.emit(self)
+
+    def send_text(self, text):
+        token = self.monitor.token
+
+        def handle(result):
+            if not result:
+                self.log.log("❌ 文字发送失败")
+                self.state = 'failed'
+                self.failed.emit(self)
+                return
+            QTimer.singleShot(1000, lambda: token.cancelled or self.monitor.check_user_message_appeared(text))
+        if len(text) >= MinimalLightBrowser.LARGE_PROMPT_CHARS:
+            self.browser_view.call_with_payload("sendText", text, True, callback=handle, token=token,
+                                                priority=PRIORITY_SEND)
+        else:
+            self.browser_view.call("sendText", text, False, callback=handle, token=token,
+                                   priority=PRIORITY_SEND)
+
+    def cancel(self):
+        if self.state == 'running':
+            self.monitor.stop()
+            self.state = 'failed'
+
+class FanoutCoordinator(QObject):
+    """多站点扇出 - 同一提示词并行发往多个站点
+
+    first: 最先完成的回复立即写入历史，其余站点继续运行只用于延迟统计；
+    all:   等所有站点完成（或超时）后按站点分别写入历史。
+    """
+    def __init__(self, window, site_names, mode="first", deadline=180):
+        super().__init__()
+        self.window = window
+        self.terminal_panel = window.terminal_panel
+        self.mode = mode
+        self.deadline = deadline
+        self.round = 0
+        self.delivered = False
+        self.lanes = []
+        sites = self.load_sites(window)
+        for name in site_names:
+            if name not in sites:
+                self.terminal_panel.log(f"❌ 未知站点: {name}（可在 sites.json 中配置）")
+                continue
+            lane = SiteLane(name, sites[name], lambda: window.profile, self.terminal_panel)
+            lane.finished.connect(self.on_lane_finished)
+            lane.failed.connect(self.on_lane_failed)
+            self.lanes.append(lane)
+        self.terminal_panel.log(f"🔀 扇出模式 ({mode}): " + ", ".join(lane.name for lane in self.lanes))
+
+    @property
+    def home_lane(self):
+        """加载首页的 home 通道（没有则为 None）"""
+        return next((lane for lane in self.lanes if lane.name == 'home'), None)
+
+    @staticmethod
+    def load_sites(window):
+        """内置 home 站点为当前首页，其余站点从 browser_data/sites.json 读取（站点名 -> {url, selectors}）
+
+        整个文件不是对象时忽略，个别站点配置无效时跳过该站点并记录原因。
+        """
+        sites = {'home': {'url': window.home_url}}
+        try:
+            with open(os.path.join(window.storage_path, "sites.json"), 'r', encoding='utf-8') as f:
+                specs = json.load(f)
+        except OSError:
+            return sites
+        except ValueError as e:
+            window.terminal_panel.log(f"❌ sites.json 解析失败: {e}")
+            return sites
+        if not isinstance(specs, dict):
+            window.terminal_panel.log("❌ sites.json 应为 站点名 -> 配置 的对象")
+            return sites
+        for name, spec in specs.items():
+            url = spec.get('url') if isinstance(spec, dict) else None
+            if not isinstance(url, str) or QUrl(url).scheme() not in ("http", "https"):
+                window.terminal_panel.log(f"❌ 站点 {name} 缺少有效的 url，已跳过")
+                continue
+            if not isinstance(spec.get('selectors') or {}, dict):
+                window.terminal_panel.log(f"❌ 站点 {name} 的 selectors 必须为对象，已跳过")
+                continue
+            sites[name] = spec
+        return sites
+
+    def send(self, text, image=None):
+        for lane in self.lanes:
+            lane.cancel()
+        self.round += 1
+        self.delivered = False
+        if image is None:
+            image = self.window.screenshot_handler.capture_service.capture()
+        self.window.history_panel.add_message(text, is_user=True)
+        for lane in self.lanes:
+            lane.send(text, image)
+        current = self.round
+        QTimer.singleShot(self.deadline * 1000, lambda: current == self.round and self.on_deadline())
+
+    def on_lane_finished(self, lane, text):
+        if lane.state != 'running':
+            return
+        lane.state = 'done'
+        lane.reply = text
+        lane.latency = time.monotonic() - lane.started
+        lane.latencies.append(lane.latency)
+        lane.log.log(f"🏁 回复完成，用时 {lane.latency:.1f}s")
+        if self.mode == 'first' and not self.delivered:
+            lane.wins += 1
+            self.deliver([lane])
+        self.check_round()
+
+    def on_lane_failed(self, lane):
+        self.check_round()
+
+    def on_deadline(self):
+        for lane in self.lanes:
+            if lane.state == 'running':
+                lane.log.log(f"⏱️ 超过 {self.deadline}s 未完成，放弃")
+                lane.cancel()
+        self.check_round()
+
+    def check_round(self):
+        if any(lane.state == 'running' for lane in self.lanes):
+            return
+        done = [lane for lane in self.lanes if lane.state == 'done']
+        if not self.delivered:
+            if done:
+                done.sort(key=lambda lane: lane.latency)
+                done[0].wins += 1
+                self.deliver(done)
+            else:
+                self.delivered = True
+                self.terminal_panel.log("❌ 所有站点均未返回回复")
+                self.window.abort_pending_message()
+        self.log_latencies()
+
+    def deliver(self, lanes):
+        """写入历史（每条回复各自提交后处理）并按普通回复完成的流程通知其他模块"""
+        self.delivered = True
+        history = self.window.history_panel
+        for lane in lanes:
+            history.add_message(lane.reply, is_user=False, meta={'site': lane.name})
+        self.window.floating_chat.set_enabled(True)
+        self.window.floating_chat.focus_input()
+        if len(lanes) == 1:
+            combined = lanes[0].reply
+        else:
+            combined = "\n\n".join(f"### {lane.name}\n\n{lane.reply}" for lane in lanes)
+        self.window.response_monitor.reply_finished.emit(combined)
+
+    def log_latencies(self):
+        """对比各站点本轮和近期平均延迟"""
+        parts = []
+        ranked = sorted(self.lanes, key=lambda lane: statistics.mean(lane.latencies) if lane.latencies else float('inf'))
+        for lane in ranked:
+            current = f"{lane.latency:.1f}s" if lane.latency is not None else "失败"
+            average = f"{statistics.mean(lane.latencies):.1f}s" if lane.latencies else "-"
+            parts.append(f"{lane.name} {current} (均值 {average}, 胜出 {lane.wins})")
+        self.terminal_panel.log("📊 站点延迟: " + " | ".join(parts))
+        if ranked and ranked[0].latencies:
+            self.terminal_panel.log(f"🚀 当前最快: {ranked[0].name}")
+
+class ProfileWorkers(QObject):
+    """配置池工作视图 - 主视图之外，配置池中每个其余配置各开一个后台视图
+
+    自动化接口的请求在主视图忙时分给空闲且未在冷却中的工作视图，多个账号并行发送，
+    吞吐随配置数量扩展；被限流的工作视图按配置池的冷却时间暂停接单。
+    """
+    DEADLINE = 180  # 单条消息超时（秒）
+
+    def __init__(self, window, automation):
+        super().__init__()
+        self.window = window
+        self.automation = automation
+        self.pool = window.profile_pool
+        self.lanes = []
+        for _ in range(len(self.pool.slots) - 1):
+            slot = self.pool.acquire(exclude=window.profile_slot)
+            if slot is window.profile_slot or any(lane.slot is slot for lane in self.lanes):
+                self.pool.release(slot)
+                continue
+            lane = SiteLane(slot.name, {'url': window.home_url}, lambda slot=slot: slot.profile,
+                            window.terminal_panel)
+            lane.slot = slot
+            lane.job = None             # (消息ID, 文本)
+            lane.finished.connect(self.on_lane_finished)
+            lane.failed.connect(self.on_lane_failed)
+            lane.monitor.reply_delta.connect(lambda delta, lane=lane: self.publish(lane, "delta", delta))
+            lane.monitor.reply_replaced.connect(lambda text, lane=lane: self.publish(lane, "replace", text))
+            self.lanes.append(lane)
+        if self.lanes:
+            window.terminal_panel.log("👥 工作视图: " + ", ".join(lane.name for lane in self.lanes))
+
+    def idle_lane(self):
+        """空闲且健康的工作视图，优先选服务次数少的"""
+        now = time.time()
+        idle = [lane for lane in self.lanes if lane.job is None and lane.slot.is_healthy(now)]
+        return min(idle, key=lambda lane: lane.slot.served) if idle else None
+
+    def send(self, lane, msg_id, text):
+        lane.job = (msg_id, text)
+        lane.send(text, None)
+        QTimer.singleShot(self.DEADLINE * 1000,
+                          lambda: lane.job and lane.job[0] == msg_id and self.on_deadline(lane))
+
+    def on_deadline(self, lane):
+        lane.log.log(f"⏱️ 超过 {self.DEADLINE}s 未完成，放弃")
+        lane.cancel()
+        self.on_lane_failed(lane, "timeout")
+
+    def publish(self, lane, event, data):
+        if lane.job:
+            self.automation.publish(lane.job[0], event, data)
+
+    def on_lane_finished(self, lane, text):
+        if lane.state != 'running' or lane.job is None:
+            return
+        lane.state = 'done'
+        lane.browser_view.call("throttleSignal", list(THROTTLE_PATTERNS),
+                               callback=lambda signal: self.on_throttle_checked(lane, text, signal),
+                               priority=PRIORITY_BACKGROUND)
+
+    def on_throttle_checked(self, lane, text, signal):
+        (msg_id, prompt), lane.job = lane.job, None
+        reason = throttle_reason(signal)
+        if reason:
+            self.pool.report_throttled(lane.slot)
+            lane.log.log(f"🚦 限流信号: {reason}，进入冷却，请求重新排队")
+            self.automation.requeue(msg_id, prompt)
+            return
+        self.pool.report_success(lane.slot)
+        lane.log.log(f"🏁 回复完成，用时 {time.monotonic() - lane.started:.1f}s")
+        self.window.history_panel.add_message(prompt, is_user=True, meta={'profile': lane.name})
+        self.window.history_panel.add_message(text, is_user=False, meta={'profile': lane.name})
+        self.automation.finish(msg_id, "done", text)
+
+    def on_lane_failed(self, lane, reason="send_failed"):
+        if lane.job is None:
+            return
+        (msg_id, _), lane.job = lane.job, None
+        self.automation.finish(msg_id, "error", reason)
+
+def markdown_to_html(text):
+    """Markdown 转为富文本 HTML（在工作进程中运行，不需要 QApplication）"""
+    document = QTextDocument()
+    document.setDefaultFont(QFont("Microsoft YaHei", 10))
+    document.setMarkdown(text)
+    return document.toHtml()
+
+def postprocess_reply(text, top_keywords=8):
+    """解析回复（在工作进程中运行）：提取代码块、识别语言、统计关键词，并把 Markdown 渲染为 HTML"""
+    code_blocks = []
+    for match in CODE_BLOCK_RE.finditer(text):
+        code = match.group(2)
+        code_blocks.append({
+            'language': match.group(1).lower() or detect_language(code),
+            'code': code
+        })
+
+    prose = CODE_BLOCK_RE.sub(" ", text)
+    counts = Counter(word.lower() for word in ASCII_WORD_RE.findall(prose))
+    for run in CJK_RUN_RE.findall(prose):
+        counts.update(run[i:i + 2] for i in range(len(run) - 1))
+    keywords = [word for word, _ in counts.most_common(top_keywords * 3)
+                if word not in STOP_WORDS][:top_keywords]
+
+    return {
+        'code_blocks': code_blocks,
+        'languages': sorted({block['language'] for block in code_blocks if block['language']}),
+        'keywords': keywords,
+        'headings': re.findall(r"^#{1,6}\s+(.+)$", text, re.M),
+        'length': len(text),
+        'html': markdown_to_html(text)
+    }
+
+def file_digest(path, chunk_size=1 << 20):
+    """文件内容的 blake2b 摘要（十六进制），读取失败时返回 None"""
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+class ReplyCache:
+    """回复缓存 - 以规范化提示词 + 页面/截图/附件标识为键，TTL 过期 + LRU 淘汰，持久化到磁盘
+
+    磁盘格式为追加写的 JSON Lines，每次写入只追加一行；启动时或日志行数远超条目数时整体压缩一次。
+    """
+    def __init__(self, path, ttl, max_entries=500):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()    # 键 -> (回复, 写入时间, 原始耗时秒)
+        self.log_lines = 0              # 磁盘日志当前行数
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.load()
+
+    @staticmethod
+    def make_key(text, context=None):
+        """context 为页面、截图和附件的标识（字节串）：同一提示词只在画面和附件内容都相同时复用回复"""
+        normalized = " ".join(unicodedata.normalize("NFKC", text).split())
+        h = hashlib.blake2b(normalized.encode("utf-8"), digest_size=16)
+        h.update(b"\0" + (context or b""))
+        return h.hexdigest()
+
+    def load(self):
+        """逐行读取，跳过损坏或字段不对的行（例如写到一半退出），之后压缩日志"""
+        try:
+            f = open(self.path, 'r', encoding='utf-8')
+        except OSError:
+            return
+        now = time.time()
+        with f:
+            for line in f:
+                try:
+                    key, reply, stored, cost = json.loads(line)
+                    if not isinstance(key, str) or not isinstance(reply, str):
+                        continue
+                    stored, cost = float(stored), float(cost)
+                except (ValueError, TypeError):
+                    continue
+                self.entries.pop(key, None)
+                if now - stored < self.ttl:
+                    self.entries[key] = (reply, stored, cost)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        try:
+            self.compact()
+        except OSError:
+            pass
+
+    def compact(self):
+        """按当前条目重写日志：先写临时文件再替换，避免中途退出留下损坏的缓存"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for key, (reply, stored, cost) in self.entries.items():
+                f.write(json.dumps([key, reply, stored, cost], ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self.log_lines = len(self.entries)
+
+    def append(self, key, reply, stored, cost):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps([key, reply, stored, cost], ensure_ascii=False) + "\n")
+        self.log_lines += 1
+
+    def get(self, key):
+        """命中返回 (回复, 原始耗时)，未命中或已过期返回 None"""
+        entry = self.entries.get(key)
+        if entry and time.time() - entry[1] >= self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self.saved_seconds += entry[2]
+        return entry[0], entry[2]
+
+    def put(self, key, reply, cost):
+        stored = time.time()
+        self.entries[key] = (reply, stored, cost)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        try:
+            if self.log_lines >= 2 * self.max_entries:
+                self.compact()
+            else:
+                self.append(key, reply, stored, cost)
+        except OSError:
+            pass
+
+    def summary(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0.0
+        return (f"命中率 {ratio:.0f}% ({self.hits}/{total}), 累计节省 {self.saved_seconds:.1f}s, "
+                f"条目 {len(self.entries)}/{self.max_entries}")
+
+class ReplyPostProcessor(QObject):
+    """回复后处理模块 - 在进程池中解析回复，结果通过信号回到 GUI 线程"""
+    processed = pyqtSignal(int, dict)   # 记录 uid, 解析结果
+    failed = pyqtSignal(int, str)       # 记录 uid, 错误描述
+
+    def __init__(self, max_workers=2):
+        super().__init__()
+        self.max_workers = max_workers
+        self.executor = None
+
+    def submit(self, uid, text):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        future = self.executor.submit(postprocess_reply, text)
+        # 回调运行在执行器的管理线程中，信号会自动排队到 GUI 线程
+        future.add_done_callback(lambda f: self.on_done(uid, f))
+
+    def on_done(self, uid, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            if isinstance(error, BrokenProcessPool):
+                self.executor = None    # 工作进程异常退出后进程池不可再用，下次提交时重建
+            self.failed.emit(uid, f"{type(error).__name__}: {error}")
+            return
+        self.processed.emit(uid, future.result())
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+class CronTrigger:
+    """五段式 cron 表达式（分 时 日 月 周），支持 *、*/n、a-b、a-b/n 和逗号列表"""
+    RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 6)]
+
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"cron 表达式需要 5 段: {expression}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (
+            self.parse_field(field, low, high) for field, (low, high) in zip(fields, self.RANGES))
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def parse_field(field, low, high):
+        values = set()
+        for part in field.split(","):
+            spec, _, step = part.partition("/")
+            if spec == "*":
+                start, end = low, high
+            elif "-" in spec:
+                start, end = (int(v) for v in spec.split("-", 1))
+            else:
+                start = end = int(spec)
+            if step and spec != "*" and "-" not in spec:
+                end = high
+            values.update(range(start, end + 1, int(step or 1)))
+        if high == 6 and 7 in values:   # 7 也表示周日
+            values.add(0)
+        if not values or min(values) < low or max(values) > (7 if high == 6 else high):
+            raise ValueError(f"cron 字段超出范围: {field}")
+        return values
+
+    def day_matches(self, t):
+        day_ok = t.day in self.days
+        weekday_ok = (t.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        return day_ok or weekday_ok     # 日和周都有限制时满足其一即可（与 cron 一致）
+
+    def next_after(self, after):
+        """返回严格晚于 after 的下一次触发时间（按天/小时跳跃，最多向后查找约 5 年）"""
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"cron 表达式没有可触发的时间: {self.expression}")
+
+class ScheduledJob:
+    """定时任务定义：every（秒）或 cron 触发，提示词可直接给出或引用模板"""
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.prompt = spec.get('prompt', '')
+        self.template = spec.get('template')
+        self.vars = spec.get('vars') or {}
+        self.every = float(spec['every']) if spec.get('every') is not None else None
+        self.cron = CronTrigger(spec['cron']) if spec.get('cron') else None
+        if not (self.every or self.cron) or not (self.prompt or self.template):
+            raise ValueError(f"任务 {self.name} 缺少触发条件或提示词")
+        if self.every is not None and self.every <= 0:
+            raise ValueError(f"任务 {self.name} 的 every 必须为正数")
+        if not isinstance(self.vars, dict):
+            raise ValueError(f"任务 {self.name} 的 vars 必须为对象")
+        self.misfire = spec.get('misfire', 'run_once')     # run_once: 补跑一次；skip: 跳过错过的触发
+        self.misfire_grace = float(spec.get('misfire_grace', 300))
+        self.max_retries = int(spec.get('max_retries', 2))
+        self.output = spec.get('output')                   # 结果文件路径，默认 job_results/<任务名>/
+        # 构造时先算一次触发时间：永远不会触发的 cron（如 2 月 31 日）和超出日期范围的 every
+        # 在这里抛出 ValueError / OverflowError，不会留到调度循环里
+        self.first_run = self.next_after(datetime.now())
+
+    def next_after(self, after):
+        if self.cron:
+            return self.cron.next_after(after)
+        return after + timedelta(seconds=self.every)
+
+class JobScheduler(QObject):
+    """定时提示词任务 - 定义读取 jobs.json，下次触发时间、待执行队列和指标持久化到 job_state.json
+
+    到期的任务进入队列，在窗口空闲时经 on_send_message 发送（同样会截图上传），
+    回复写入结果文件；发送失败按指数退避重试。
+    """
+    def __init__(self, window, storage_path, tick_interval=5000, retry_delay=30):
+        super().__init__()
+        self.window = window
+        self.terminal_panel = window.terminal_panel
+        self.jobs_path = os.path.join(storage_path, "jobs.json")
+        self.state_path = os.path.join(storage_path, "job_state.json")
+        self.results_path = os.path.join(storage_path, "job_results")
+        self.retry_delay = retry_delay
+        self.jobs = {}
+        self.next_runs = {}     # 任务名 -> 下次触发时间（epoch 秒）
+        self.queue = []         # [任务名, 到期时间, 已重试次数, 最早可执行时间]
+        self.metrics = {}       # 任务名 -> {'runs', 'failures', 'total_time', 'last_time', 'total_wait'}
+        self.current = None
+        self.started_at = None
+        self.jobs_signature = None
+        # 同时监视目录：jobs.json 启动后才创建，或被编辑器以"写临时文件再改名"方式保存时，
+        # 文件监视会失效，由目录变化触发并重新登记
+        self.watcher = QFileSystemWatcher([storage_path], self)
+        self.watcher.directoryChanged.connect(self.on_jobs_changed)
+        self.watcher.fileChanged.connect(self.on_jobs_changed)
+        self.load_state()
+        self.load_jobs()
+        window.response_monitor.reply_finished.connect(self.on_reply_finished)
+        window.send_failed.connect(self.on_send_failed)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.tick)
+        self.timer.start(tick_interval)
+        QTimer.singleShot(0, self.tick)
+
+    def on_jobs_changed(self, *args):
+        """目录中任何文件变化都会触发，只有 jobs.json 的修改时间或大小变化时才重新加载"""
+        try:
+            stat = os.stat(self.jobs_path)
+            signature = (stat.st_mtime, stat.st_size)
+        except OSError:
+            signature = None
+        if signature != self.jobs_signature:
+            self.load_jobs()
+
+    def load_jobs(self):
+        try:
+            stat = os.stat(self.jobs_path)
+            self.jobs_signature = (stat.st_mtime, stat.st_size)
+            with open(self.jobs_path, 'r', encoding='utf-8') as f:
+                specs = json.load(f)
+        except OSError:
+            self.jobs_signature = None
+            return
+        except ValueError as e:
+            self.terminal_panel.log(f"❌ jobs.json 解析失败: {e}")
+            return
+        finally:
+            if os.path.exists(self.jobs_path) and self.jobs_path not in self.watcher.files():
+                self.watcher.addPath(self.jobs_path)
+        if not isinstance(specs, list):
+            self.terminal_panel.log("❌ jobs.json 应为任务数组")
+            return
+        jobs = {}
+        for spec in specs:
+            try:
+                job = ScheduledJob(spec)
+            except (KeyError, ValueError, TypeError, AttributeError, OverflowError) as e:
+                name = spec.get('name') if isinstance(spec, dict) else None
+                self.terminal_panel.log(f"❌ 定时任务 {name} 无效，已跳过: {e}")
+                continue
+            jobs[job.name] = job
+        self.jobs = jobs
+        for name, job in jobs.items():
+            if name not in self.next_runs:
+                self.next_runs[name] = job.first_run.timestamp()
+        for name in set(self.next_runs) - set(jobs):
+            del self.next_runs[name]
+        self.queue = [entry for entry in self.queue if entry[0] in jobs]
+        self.terminal_panel.log(f"🗓️ 已加载 {len(jobs)} 个定时任务，待执行 {len(self.queue)} 个")
+        self.save_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(state, dict):
+            return
+        self.next_runs = {name: due for name, due in (state.get('next_runs') or {}).items()
+                          if isinstance(due, (int, float))}
+        self.metrics = state.get('metrics') or {}
+        queue = list(state.get('queue') or [])
+        if state.get('current'):
+            # 上次退出时正在执行的任务放回队首
+            queue.insert(0, state['current'])
+        # 丢弃格式不对的条目；任务名是否存在在 pump 中检查（jobs.json 可能稍后才加载成功）
+        self.queue = [entry for entry in queue
+                      if isinstance(entry, list) and len(entry) == 4 and isinstance(entry[0], str)]
+
+    def save_state(self):
+        state = {'next_runs': self.next_runs, 'queue': self.queue, 'metrics': self.metrics,
+                 'current': self.current}
+        tmp_path = self.state_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            self.terminal_panel.log(f"⚠️ 任务状态保存失败: {e}")
+
+    def tick(self):
+        """检查到期任务（含错过的触发），空闲时发送队首任务"""
+        now = time.time()
+        changed = False
+        for name, job in self.jobs.items():
+            due = self.next_runs.get(name)
+            if due is None or due > now:
+                continue
+            if now - due > job.misfire_grace:
+                if job.misfire == 'skip':
+                    self.terminal_panel.log(f"⏭️ 任务 {name} 错过触发时间，跳过")
+                else:
+                    self.terminal_panel.log(f"⏰ 任务 {name} 错过触发时间，补跑一次")
+                    self.enqueue(name, due)
+            else:
+                self.enqueue(name, due)
+            # 错过的多次触发只算一次，下次触发从现在起计算
+            try:
+                self.next_runs[name] = job.next_after(datetime.fromtimestamp(max(due, now))).timestamp()
+            except (ValueError, OverflowError) as e:
+                self.terminal_panel.log(f"❌ 任务 {name} 无法计算下次触发时间，已停用: {e}")
+                del self.next_runs[name]
+            changed = True
+        if changed:
+            self.save_state()
+        self.pump()
+
+    def enqueue(self, name, due):
+        if any(entry[0] == name for entry in self.queue) or (self.current and self.current[0] == name):
+            return      # 同一任务尚未执行完时不重复排队
+        self.queue.append([name, due, 0, 0])
+
+    def pump(self):
+        if self.current or not self.queue:
+            return
+        window = self.window
+        if not window.floating_chat.send_button.isEnabled() or window.pending_message:
+            return
+        automation = window.automation_server
+        if automation and automation.current_id:
+            return
+        now = time.time()
+        # 跳过 jobs.json 中已不存在（或尚未加载成功）的任务
+        for index, entry in enumerate(self.queue):
+            if entry[0] in self.jobs and entry[3] <= now:
+                break
+        else:
+            return
+        entry = self.queue.pop(index)
+        job = self.jobs[entry[0]]
+        try:
+            text = window.templates.render(job.template, job.vars) if job.template else job.prompt
+        except TemplateError as e:
+            self.terminal_panel.log(f"❌ 任务 {job.name} 模板错误: {e}")
+            self.save_state()
+            return
+        self.current = entry
+        self.started_at = time.time()
+        self.save_state()
+        self.terminal_panel.log(f"🗓️ 执行定时任务 {job.name}（第 {entry[2] + 1} 次尝试）")
+        window.on_send_message(text)
+
+    def on_reply_finished(self, text):
+        if not self.current:
+            QTimer.singleShot(0, self.pump)
+            return
+        name, due, attempt, _ = self.current
+        self.current = None
+        elapsed = time.time() - self.started_at
+        metrics = self.job_metrics(name)
+        metrics['runs'] += 1
+        metrics['total_time'] += elapsed
+        metrics['last_time'] = elapsed
+        metrics['total_wait'] += max(0.0, self.started_at - due)
+        path = self.write_result(self.jobs.get(name), name, text)
+        self.terminal_panel.log(
+            f"🗓️ 任务 {name} 完成: 耗时 {elapsed:.1f}s, 排队 {self.started_at - due:.1f}s, "
+            f"平均 {metrics['total_time'] / metrics['runs']:.1f}s, 成功 {metrics['runs']} 失败 {metrics['failures']} → {path}")
+        self.save_state()
+        QTimer.singleShot(0, self.pump)
+
+    def on_send_failed(self):
+        if not self.current:
+            QTimer.singleShot(0, self.pump)
+            return
+        name, due, attempt, _ = self.current
+        self.current = None
+        job = self.jobs.get(name)
+        if job and attempt < job.max_retries:
+            delay = self.retry_delay * 2 ** attempt
+            self.queue.insert(0, [name, due, attempt + 1, time.time() + delay])
+            self.terminal_panel.log(f"🔁 任务 {name} 发送失败，{delay}s 后重试")
+        else:
+            self.job_metrics(name)['failures'] += 1
+            self.terminal_panel.log(f"❌ 任务 {name} 重试 {attempt} 次后仍失败，放弃本次执行")
+        self.save_state()
+        QTimer.singleShot(0, self.pump)
+
+    def job_metrics(self, name):
+        return self.metrics.setdefault(name, {'runs': 0, 'failures': 0, 'total_time': 0.0,
+                                              'last_time': 0.0, 'total_wait': 0.0})
+
+    def write_result(self, job, name, text):
+        """结果按任务写入 Markdown 文件，文件名为执行时间"""
+        directory = job.output if job and job.output else os.path.join(self.results_path, name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, datetime.now().strftime("%Y%m%d-%H%M%S") + ".md")
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        except OSError as e:
+            self.terminal_panel.log(f"⚠️ 任务结果写入失败: {e}")
+        return path
+
+class AutomationServer(QObject):
+    """本地自动化接口 - 在工作线程中运行 HTTP 服务，消息在 GUI 线程按客户端轮询排队发送
+
+    POST /send 须带 X-Client-Id 请求头（调用方自定的客户端标识，同一标识的消息共用一个队列，
+    不同标识之间轮流发送；所有调用方都来自 127.0.0.1，无法按地址区分），缺少时返回 400
+    POST /send {"text": ...} 或 {"template": 模板名, "vars": {...}}  -> {"id": 消息ID}
+    GET  /stream/<id>         -> SSE 推送 delta（追加）/ replace（全文替换）/ done / error 事件
+    GET  /history             -> 历史消息列表
+    """
+    wake = pyqtSignal()
+    history_requested = pyqtSignal(object)  # 工作线程请求历史快照，参数为接收结果的 queue.Queue
+    STREAM_RETENTION = 120                  # 已结束但无人读取的事件流保留秒数
+
+    def __init__(self, window, port):
+        super().__init__()
+        self.window = window
+        self.port = port
+        self.lock = threading.Lock()
+        self.client_queues = OrderedDict()  # 客户端ID -> deque[(消息ID, 文本)]
+        self.streams = {}                   # 消息ID -> queue.Queue
+        self.finished_at = {}               # 消息ID -> 结束时间，用于清理无人读取的事件流
+        self.retry_jobs = deque()           # 被限流后重新排队的消息，优先发送
+        self.current_id = None
+        self.httpd = None
+        self.workers = None
+        if len(window.profile_pool.slots) > 1:
+            self.workers = ProfileWorkers(window, self)
+        self.wake.connect(self.pump)
+        self.history_requested.connect(self.on_history_requested)
+        window.response_monitor.reply_delta.connect(self.on_reply_delta)
+        window.response_monitor.reply_replaced.connect(self.on_reply_replaced)
+        window.response_monitor.reply_finished.connect(self.on_reply_finished)
+        window.send_failed.connect(self.on_send_failed)
+
+    def start(self):
+        """在后台线程启动 HTTP 服务（仅监听本机）"""
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", self.port), AutomationRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.automation = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.window.terminal_panel.log(f"🔌 自动化接口已启动: http://127.0.0.1:{self.port}")
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd = None
+
+    def submit(self, client_id, text):
+        """工作线程调用：入队并唤醒 GUI 线程"""
+        msg_id = uuid.uuid4().hex
+        with self.lock:
+            self.prune_streams()
+            self.client_queues.setdefault(client_id, deque()).append((msg_id, text))
+            self.streams[msg_id] = queue.Queue()
+        self.wake.emit()
+        return msg_id
+
+    def next_job(self):
+        """按客户端轮询取下一条消息，保证多个客户端公平排队"""
+        with self.lock:
+            if self.retry_jobs:
+                return self.retry_jobs.popleft()
+            for client_id, pending in self.client_queues.items():
+                if pending:
+                    job = pending.popleft()
+                    self.client_queues.move_to_end(client_id)
+                    return job
+        return None
+
+    def pump(self):
+        """GUI 线程：主视图空闲时发给主视图，否则分给空闲的工作视图，直到没有空闲视图或队列为空"""
+        while True:
+            lane = None
+            if self.current_id or not self.window.floating_chat.send_button.isEnabled():
+                lane = self.workers.idle_lane() if self.workers else None
+                if lane is None:
+                    return
+            job = self.next_job()
+            if not job:
+                return
+            msg_id, text = job
+            self.publish(msg_id, "queued", msg_id)
+            if lane:
+                self.workers.send(lane, msg_id, text)
+                continue
+            self.current_id = msg_id
+            self.window.on_send_message(text)
+
+    def requeue(self, msg_id, text):
+        """工作视图被限流：消息放回队首，由其他视图重发"""
+        with self.lock:
+            self.retry_jobs.append((msg_id, text))
+        QTimer.singleShot(0, self.pump)
+
+    def publish(self, msg_id, event, data):
+        stream = self.streams.get(msg_id)
+        if stream:
+            stream.put((event, data))
+
+    def prune_streams(self):
+        """丢弃结束已久仍无人读取的事件流（调用方持有 lock）"""
+        expired = time.monotonic() - self.STREAM_RETENTION
+        for msg_id, finished in list(self.finished_at.items()):
+            if finished < expired:
+                del self.finished_at[msg_id]
+                self.streams.pop(msg_id, None)
+
+    def finish(self, msg_id, event, data):
+        """推送结束事件并继续发送排队的请求"""
+        self.publish(msg_id, event, data)
+        with self.lock:
+            if msg_id in self.streams:
+                self.finished_at[msg_id] = time.monotonic()
+            self.prune_streams()
+        QTimer.singleShot(0, self.pump)
+
+    def finish_current(self, event, data):
+        if not self.current_id:
+            # 其他来源（手动输入、定时任务）的消息结束后，继续发送排队的请求
+            QTimer.singleShot(0, self.pump)
+            return
+        msg_id, self.current_id = self.current_id, None
+        self.finish(msg_id, event, data)
+
+    def on_reply_delta(self, delta):
+        if self.current_id:
+            self.publish(self.current_id, "delta", delta)
+
+    def on_reply_replaced(self, text):
+        if self.current_id:
+            self.publish(self.current_id, "replace", text)
+
+    def on_reply_finished(self, text):
+        self.finish_current("done", text)
+
+    def on_send_failed(self):
+        self.finish_current("error", "send_failed")
+
+    def on_history_requested(self, result):
+        """GUI 线程：生成历史快照交给等待中的工作线程"""
+        result.put([msg.to_dict() for msg in self.window.history_panel.messages])
+
+    def history_snapshot(self, timeout=5):
+        """工作线程调用：历史记录归 GUI 线程所有，经信号在 GUI 线程取快照；超时返回 None"""
+        result = queue.Queue()
+        self.history_requested.emit(result)
+        try:
+            return result.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class AutomationRequestHandler(BaseHTTPRequestHandler):
+    """自动化接口请求处理（运行在服务线程中）"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        automation = self.server.automation
+        if self.path != "/send":
+            self.send_json(404, {'error': 'not_found'})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            if payload.get('template'):
+                name, values = payload['template'], payload.get('vars') or {}
+                if not isinstance(name, str) or not isinstance(values, dict):
+                    raise TemplateError("template 须为字符串，vars 须为对象")
+                text = automation.window.templates.render(name, values)
+            else:
+                text = str(payload.get('text', '')).strip()
+        except TemplateError as e:
+            self.send_json(400, {'error': 'template', 'detail': str(e)})
+            return
+        except (ValueError, AttributeError, TypeError):
+            self.send_json(400, {'error': 'invalid_json'})
+            return
+        if not text:
+            self.send_json(400, {'error': 'empty_text'})
+            return
+        client_id = self.headers.get("X-Client-Id", "").strip()
+        if not client_id:
+            self.send_json(400, {'error': 'missing_client_id'})
+            return
+        self.send_json(202, {'id': automation.submit(client_id, text)})
+
+    def do_GET(self):
+        automation = self.server.automation
+        if self.path == "/history":
+            snapshot = automation.history_snapshot()
+            if snapshot is None:
+                self.send_json(503, {'error': 'busy'})
+            else:
+                self.send_json(200, snapshot)
+        elif self.path.startswith("/stream/"):
+            self.stream_events(automation, self.path[len("/stream/"):])
+        else:
+            self.send_json(404, {'error': 'not_found'})
+
+    def stream_events(self, automation, msg_id):
+        """以 SSE 推送某条消息的回复事件，直到完成或出错"""
+        stream = automation.streams.get(msg_id)
+        if stream is None:
+            self.send_json(404, {'error': 'unknown_id'})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        try:
+            while True:
+                try:
+                    event, data = stream.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                chunk = f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+                self.wfile.write(chunk.encode("utf-8"))
+                self.wfile.flush()
+                if event in ("done", "error"):
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        with automation.lock:
+            automation.streams.pop(msg_id, None)
+            automation.finished_at.pop(msg_id, None)
+
+class AttachmentServer(QObject):
+    """本地附件服务 - 页面通过 fetch 从本机 HTTP 端口按块读取文件，文件不会整体读入 Python 内存
+
+    GET /f/<批次>/<序号>  -> 文件内容（分块发送）
+    GET /done/<批次>?ok=1 -> 页面通知该批次已放入文件输入控件（页面没有 WebChannel 时使用）
+
+    站点 CSP 的 connect-src 不允许访问 127.0.0.1 时页面拉取不到文件，
+    BrowserView.attach_files 据此退回经 WebChannel 传 base64 的旧路径。
+    """
+    progress = pyqtSignal(str, int, int)    # (批次, 序号, 已发送字节)
+    finished = pyqtSignal(str, bool)        # (批次, 是否成功)
+    CHUNK_SIZE = 256 * 1024
+    shared_instance = None
+
+    def __init__(self):
+        super().__init__()
+        self.batches = {}       # 批次 -> [(路径或内存中的字节, 文件名, MIME, 大小)]
+        self.callbacks = {}     # 批次 -> 完成回调(是否成功)
+        self.httpd = None
+        self.finished.connect(self.on_finished)
+
+    @classmethod
+    def shared(cls):
+        """主窗口和扇出通道共用的附件服务，首次使用时启动，程序退出时停止"""
+        if cls.shared_instance is None:
+            cls.shared_instance = cls()
+            cls.shared_instance.start()
+            QApplication.instance().aboutToQuit.connect(cls.shared_instance.stop)
+        return cls.shared_instance
+
+    def start(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), AttachmentRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.attachments = self
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd = None
+
+    def register(self, items):
+        """登记一批文件，返回 (批次, 给页面的文件描述列表, 完成通知 URL)
+
+        items 中每项为文件路径，或内存中的 (文件名, MIME, 字节)（截图、长文本等）。
+        """
+        batch = uuid.uuid4().hex    # 随机批次号同时作为访问凭据
+        base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        entries = []
+        for item in items:
+            if isinstance(item, tuple):
+                name, mime, data = item
+                entries.append((data, name, mime, len(data)))
+                continue
+            name = os.path.basename(item)
+            mime = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            entries.append((item, name, mime, os.path.getsize(item)))
+        self.batches[batch] = entries
+        files = [{'url': f"{base}/f/{batch}/{i}", 'name': name, 'mime': mime}
+                 for i, (_, name, mime, _) in enumerate(entries)]
+        return batch, files, f"{base}/done/{batch}"
+
+    def release(self, batch):
+        self.batches.pop(batch, None)
+        self.callbacks.pop(batch, None)
+
+    def on_finished(self, batch, ok):
+        callback = self.callbacks.pop(batch, None)
+        if callback:
+            callback(ok)
+
+class AttachmentRequestHandler(BaseHTTPRequestHandler):
+    """附件服务请求处理（运行在服务线程中）"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_cors_headers(self):
+        # 聊天页面是 https 站点，需要允许跨源和访问本机网络
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Access-Control-Allow-Private-Network", "true")
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self.send_cors_headers()
+        self.send_header("Access-Control-Allow-Methods", "GET")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        server = self.server.attachments
+        url = urlparse(self.path)
+        parts = url.path.strip("/").split("/")
+        if len(parts) == 2 and parts[0] == "done" and parts[1] in server.batches:
+            self.send_response(204)
+            self.send_cors_headers()
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            server.finished.emit(parts[1], parse_qs(url.query).get('ok', ['0'])[0] == '1')
+            return
+        entries = server.batches.get(parts[1]) if len(parts) == 3 and parts[0] == "f" else None
+        if not entries or not parts[2].isdigit() or int(parts[2]) >= len(entries):
+            self.send_error(404)
+            return
+        index = int(parts[2])
+        source, _, mime, size = entries[index]
+        self.send_response(200)
+        self.send_cors_headers()
+        self.send_header("Content-Type", mime)
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        sent = 0
+        try:
+            with (io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')) as f:
+                while True:
+                    chunk = f.read(AttachmentServer.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+                    server.progress.emit(parts[1], index, sent)
+        except (OSError, ConnectionError):
+            self.close_connection = True
+
+class MockChatServer:
+    """离线模拟聊天站点 - 复刻选择器所针对的 DOM 结构，按可配置的速率流式输出回复"""
+    def __init__(self, token_rate=20.0, reply_tokens=120):
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.httpd = None
+
+    @property
+    def url(self):
+        port = self.httpd.server_address[1]
+        return f"http://127.0.0.1:{port}/?rate={self.token_rate}&tokens={self.reply_tokens}"
+
+    def start(self, port=0):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), MockChatRequestHandler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd = None
+
+class MockChatRequestHandler(BaseHTTPRequestHandler):
+    """模拟站点请求处理：GET 返回单页应用，POST /api/chat 以 SSE 流式返回回复"""
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/api/chat":
+            self.send_error(404)
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            text, attachments = str(request.get('text', '')), list(request.get('attachments') or [])
+        except (ValueError, AttributeError, TypeError):
+            text, attachments = "", []
+        params = parse_qs(url.query)
+        rate = max(1.0, float(params.get('rate', ['20'])[0]))
+        tokens = max(1, int(params.get('tokens', ['120'])[0]))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        # 页面按 JS 字符串长度（UTF-16 码元）计数
+        prefix = f"收到 {len(text.encode('utf-16-le')) // 2} 个字符。"
+        if attachments:
+            prefix += "附件: " + ", ".join(map(str, attachments)) + "。"
+        # 每 10 个 token 夹一个增补平面字符（UTF-16 代理对），覆盖 Python / JS 长度不一致的情形
+        pieces = [prefix] + [f" token{i}" + (" 🚀" if i % 10 == 0 else "") for i in range(1, tokens + 1)]
+        pieces.append('\n\n```python\nprint("mock reply done")\n```')
+        try:
+            for piece in pieces:
+                event = {'choices': [{'delta': {'content': piece}}]}
+                self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(1.0 / rate)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        body = MOCK_CHAT_HTML.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class BenchmarkRunner(QObject):
+    """端到端基准测试 - 依次发送提示词，统计 send_text → ResponseMonitor 各阶段延迟与 CPU / 内存
+
+    CPU 与内存同时报告本进程和页面渲染进程（回复解析、DOM 序列化都在渲染进程中）；渲染进程中途重启时
+    跨越重启的那一轮不计渲染 CPU。
+
+    prompt_chars 可为多个长度：每个长度各跑 rounds 轮，报告按长度列出发送耗时，用于对比大文本通道。
+    compare_net 为 True 时先以页面 DOM、再以网络回复流取正文各跑一遍，报告两种方式的完成延迟与 CPU。
+    """
+    SOURCE_LABELS = {'dom': "DOM 取正文", 'net': "网络流取正文"}
+
+    def __init__(self, window, rounds, prompt_chars=200, quit_when_done=True, compare_net=False):
+        super().__init__()
+        self.window = window
+        self.rounds = rounds
+        self.prompt_sizes = list(prompt_chars) if isinstance(prompt_chars, (list, tuple)) else [prompt_chars]
+        self.sources = ['dom', 'net'] if compare_net else [None]
+        self.origin = site_origin(window.home_url)
+        self.quit_when_done = quit_when_done
+        self.samples = []
+        self.current = None
+        self.started = False
+        window.message_sent.connect(self.on_sent)
+        window.send_failed.connect(self.on_failed)
+        window.response_monitor.user_message_detected.connect(self.on_detected)
+        window.response_monitor.reply_finished.connect(self.on_finished)
+        window.browser_view.web_view.loadFinished.connect(self.on_loaded)
+
+    def on_loaded(self, ok):
+        if ok and not self.started:
+            self.started = True
+            self.cpu_start = time.process_time()
+            self.renderer_start = self.renderer_usage()
+            QTimer.singleShot(1000, self.next_round)
+
+    def next_round(self):
+        per_source = self.rounds * len(self.prompt_sizes)
+        if len(self.samples) >= per_source * len(self.sources):
+            self.report()
+            return
+        index = len(self.samples) + 1
+        chars = self.prompt_sizes[len(self.samples) // self.rounds % len(self.prompt_sizes)]
+        source = self.sources[len(self.samples) // per_source]
+        if source == 'net':
+            NETWORK_CAPTURE_ORIGINS.add(self.origin)
+        elif source == 'dom':
+            NETWORK_CAPTURE_ORIGINS.discard(self.origin)
+        prompt = f"基准测试 #{index} " + "测" * max(0, chars - 10)
+        self.current = {'start': time.perf_counter(), 'chars': chars, 'source': source,
+                        'cpu': time.process_time(), 'renderer': self.renderer_usage()}
+        self.window.on_send_message(prompt)
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.current['start']) * 1000
+
+    def renderer_usage(self):
+        return render_process_usage(self.window.browser_view.web_view.page())
+
+    def renderer_cpu_since(self, start):
+        """start 以来渲染进程的 CPU 秒数；取不到或渲染进程已换过时返回 None"""
+        usage = self.renderer_usage()
+        if not start or not usage or usage[0] != start[0]:
+            return None
+        return usage[1] - start[1]
+
+    def end_round(self):
+        sample, self.current = self.current, None
+        sample['cpu'] = time.process_time() - sample['cpu']
+        sample['renderer_cpu'] = self.renderer_cpu_since(sample.pop('renderer'))
+        self.samples.append(sample)
+        QTimer.singleShot(500, self.next_round)
+
+    def on_sent(self, text):
+        if self.current is not None:
+            self.current['send'] = self.elapsed_ms()
+
+    def on_detected(self, found):
+        if self.current is not None:
+            self.current['detect'] = self.elapsed_ms()
+
+    def on_finished(self, text):
+        if self.current is None:
+            return
+        self.current['complete'] = self.elapsed_ms()
+        self.end_round()
+
+    def on_failed(self):
+        if self.current is None:
+            return
+        self.current['failed'] = True
+        self.end_round()
+
+    def report(self):
+        lines = [f"📈 基准测试完成: {len(self.samples)} 轮"]
+        for key, label in [('send', "发送延迟"), ('detect', "检测延迟"), ('complete', "完成延迟")]:
+            values = sorted(sample[key] for sample in self.samples if key in sample)
+            if not values:
+                continue
+            p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+            lines.append(f"  {label}: 中位数 {statistics.median(values):.0f} ms, p95 {p95:.0f} ms")
+        if len(self.prompt_sizes) > 1:
+            for chars in self.prompt_sizes:
+                sends = [sample['send'] for sample in self.samples if sample['chars'] == chars and 'send' in sample]
+                if sends:
+                    lines.append(f"  {chars} 字符: 发送中位数 {statistics.median(sends):.0f} ms, "
+                                 f"最大 {max(sends):.0f} ms ({len(sends)} 轮)")
+        if len(self.sources) > 1:
+            for source in self.sources:
+                done = [sample for sample in self.samples if sample['source'] == source and 'complete' in sample]
+                if done:
+                    cpu = statistics.mean(sample['cpu'] for sample in done) * 1000
+                    renderer = [sample['renderer_cpu'] for sample in done if sample['renderer_cpu'] is not None]
+                    renderer_cpu = f", 渲染进程 CPU {statistics.mean(renderer) * 1000:.0f} ms/轮" if renderer else ""
+                    lines.append(f"  {self.SOURCE_LABELS[source]}: 完成中位数 "
+                                 f"{statistics.median(sample['complete'] for sample in done):.0f} ms, "
+                                 f"本进程 CPU {cpu:.0f} ms/轮{renderer_cpu} ({len(done)} 轮)")
+        failed = sum(1 for sample in self.samples if sample.get('failed'))
+        if failed:
+            lines.append(f"  失败: {failed} 轮")
+        lines.extend("  " + line for line in self.window.response_monitor.completion.report())
+        lines.append("  脚本调度: " + self.window.browser_view.metrics_summary())
+        lines.append(f"  CPU (本进程): {time.process_time() - self.cpu_start:.2f} s")
+        memory = memory_usage_mb()
+        if memory is not None:
+            rss, peak = memory
+            lines.append(f"  {'峰值 RSS' if peak else 'RSS'}: {rss:.1f} MB")
+        renderer_cpu = self.renderer_cpu_since(self.renderer_start)
+        if renderer_cpu is not None:
+            lines.append(f"  CPU (渲染进程): {renderer_cpu:.2f} s")
+        renderer = self.renderer_usage()
+        if renderer:
+            lines.append(f"  渲染进程 RSS: {renderer[2]:.1f} MB")
+        for line in lines:
+            self.window.terminal_panel.log(line)
+            print(line)
+        if self.quit_when_done:
+            QTimer.singleShot(0, QApplication.quit)
+
+def memory_usage_mb():
+    """本进程内存 (MB, 是否为峰值)：优先取当前常驻内存，只能取到 ru_maxrss 时返回峰值；无法获取时返回 None"""
+    usage = process_usage(os.getpid())
+    if usage is not None:
+        return usage[1], False
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss 在 macOS 上单位为字节，在 Linux 等系统上为 KB
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024), True
+
+class MinimalLightBrowser(QMainWindow):
+    """主窗口类 - 负责整体窗口布局和协调各个模块"""
+    DEFAULT_HOME_URL = "https://www.doubao.com/chat/25474120854203650"
+    LARGE_PROMPT_CHARS = 20 * 1024      # 超过该长度走大文本快速通道
+    ATTACH_PROMPT_CHARS = int(os.environ.get("MLB_ATTACH_PROMPT_CHARS", 0)) or None  # 超过该长度改为以 txt 附件发送，None 表示关闭
+    PROFILE_POOL_SIZE = int(os.environ.get("MLB_PROFILES", 1))  # 隔离配置数量
+    PROFILE_POOL_STRATEGY = "round_robin"                      # 或 "least_loaded"
+    AUTOMATION_PORT = int(os.environ.get("MLB_API_PORT", 0)) or None  # 本地自动化接口端口，None 表示关闭
+    REPLY_CACHE_TTL = float(os.environ.get("MLB_REPLY_CACHE_TTL", 0)) or None  # 回复缓存有效期（秒），None 表示关闭
+    REPLY_CACHE_SIZE = 500
+    FRAME_PROBE = bool(os.environ.get("MLB_FRAME_PROBE"))              # 输出悬浮窗帧耗时统计
+    FANOUT_SITES = [name for name in os.environ.get("MLB_FANOUT", "").split(",") if name]  # 扇出站点，空表示关闭
+    FANOUT_MODE = "first"                                             # 或 "all"
+    PROFILE_MODE = bool(os.environ.get("MLB_PROFILE"))                 # 启动时开启性能分析
+    send_failed = pyqtSignal()
+    message_sent = pyqtSignal(str)      # 文字已填入页面并触发发送
+
+    def __init__(self, home_url=None):
+        super().__init__()
+        self.home_url = home_url or self.DEFAULT_HOME_URL
+        self.setup_storage()
+        
+        # 创建组件
+        self.history_panel = HistoryPanel()
         self.terminal_panel = TerminalPanel()
         self.browser_view = BrowserView(self.profile, self.terminal_panel)
         self.screenshot_handler = ScreenshotHandler(self.browser_view, self.terminal_panel)
         
         # 创建悬浮窗口
         self.floating_chat = FloatingChatWindow(
-            self.on_send_message,
+            self.on_user_input,
             self.toggle_main_window,
             self.history_panel,
             self.terminal_panel
         )
+        self.screenshot_handler.capture_service.anchor_widget = self.floating_chat
+        if self.FRAME_PROBE:
+            self.floating_chat.frame_probe = FrameProbe(self.terminal_panel)
         
         # 创建回复监控器
         self.response_monitor = ResponseMonitor(
@@ -1024,9 +4833,64 @@ class MinimalLightBrowser(QMainWindow):
             self.floating_chat,
             self.history_panel
         )
+
+        # 回复后处理（进程池）
+        self.post_processor = ReplyPostProcessor()
+        self.response_monitor.reply_finished.connect(self.on_reply_finished)
+        self.post_processor.processed.connect(self.on_reply_processed)
+        self.post_processor.failed.connect(self.on_reply_process_failed)
+        self.history_panel.message_added.connect(self.on_history_message)
+        app.aboutToQuit.connect(self.post_processor.shutdown)
         
+        # 提示词模板库
+        self.templates = TemplateLibrary(self.templates_path, self.terminal_panel)
+
+        # 附件服务（首次发送附件时启动）
+        self.attachment_server = None
+        self.attachment_upload = None
+
+        # 回复缓存（可选）
+        self.reply_cache = None
+        self.pending_cache_key = None
+        self.sent_at = None
+        self.serving_cached = False
+        if self.REPLY_CACHE_TTL:
+            self.reply_cache = ReplyCache(os.path.join(self.storage_path, "reply_cache.jsonl"),
+                                          self.REPLY_CACHE_TTL, self.REPLY_CACHE_SIZE)
+            self.terminal_panel.log(f"📦 回复缓存已启用: {len(self.reply_cache.entries)} 条，有效期 {self.REPLY_CACHE_TTL:.0f}s")
+
+        # 多站点扇出（可选）
+        self.fanout = None
+        if self.FANOUT_SITES:
+            self.fanout = FanoutCoordinator(self, self.FANOUT_SITES, self.FANOUT_MODE)
+
+        # 性能分析（需要 ProfilingApplication）
+        self.profiler = None
+        if isinstance(app, ProfilingApplication):
+            self.profiler = Profiler(self)
+            app.profiler = self.profiler
+            app.aboutToQuit.connect(self.profiler.stop)
+            if self.PROFILE_MODE:
+                self.profiler.start()
+
+        # 渲染进程守护
+        self.pending_message = None
+        self.pending_attachments = []
+        self.supervisor = RendererSupervisor(self)
+
         self.init_ui()
+        if site_needs_stream_hook(self.home_url):
+            self.browser_view.enable_stream_hook()
         self.load_homepage()
+
+        # 本地自动化接口（可选）
+        self.automation_server = None
+        if self.AUTOMATION_PORT:
+            self.automation_server = AutomationServer(self, self.AUTOMATION_PORT)
+            self.automation_server.start()
+
+        # 定时任务（browser_data/jobs.json）
+        self.scheduler = JobScheduler(self, self.storage_path)
         
         # 显示悬浮窗口
         self.floating_chat.show()
@@ -1037,11 +4901,25 @@ class MinimalLightBrowser(QMainWindow):
     def setup_storage(self):
         self.storage_path = os.path.join(os.getcwd(), "browser_data")
         os.makedirs(self.storage_path, exist_ok=True)
-        self.profile = QWebEngineProfile("MinimalLightBrowser", self)
-        self.profile.setPersistentCookiesPolicy(QWebEngineProfile.ForcePersistentCookies)
-        self.profile.setPersistentStoragePath(self.storage_path)
-        self.profile.setHttpCacheType(QWebEngineProfile.DiskHttpCache)
-        self.profile.setHttpCacheMaximumSize(200 * 1024 * 1024)
+        self.profile_pool = ProfilePool(self.storage_path, self.PROFILE_POOL_SIZE,
+                                        self.PROFILE_POOL_STRATEGY, parent=self)
+        self.profile_slot = self.profile_pool.acquire()
+        self.profile = self.profile_slot.profile
+        self.templates_path = os.path.join(self.storage_path, "templates")
+
+    def rotate_profile(self):
+        """当前配置被限流：进入冷却并切换到下一个健康配置"""
+        self.profile_pool.report_throttled(self.profile_slot)
+        self.terminal_panel.log(f"🧊 {self.profile_slot.name} 疑似被限流，进入冷却")
+        slot = self.profile_pool.acquire(exclude=self.profile_slot)
+        self.profile_pool.release(self.profile_slot)
+        if slot is self.profile_slot:
+            return
+        self.profile_slot = slot
+        self.profile = slot.profile
+        self.browser_view.set_profile(slot.profile)
+        self.terminal_panel.log(f"🔀 切换到配置 {slot.name}")
+        self.load_homepage()
 
     def init_ui(self):
         self.setWindowTitle("Minimal Light Browser")
@@ -1060,18 +4938,27 @@ class MinimalLightBrowser(QMainWindow):
         font = QFont("Microsoft YaHei", 10)
         app.setFont(font)
 
-        # 只显示浏览器视图
+        # 只显示浏览器视图（扇出模式下每个站点一个标签页）
         central_widget = QWidget()
         layout = QVBoxLayout(central_widget)
-        layout.addWidget(self.browser_view.web_view)
+        if self.fanout:
+            tabs = QTabWidget()
+            if not self.fanout.home_lane:
+                tabs.addTab(self.browser_view.web_view, "首页")
+            for lane in self.fanout.lanes:
+                tabs.addTab(lane.browser_view.web_view, lane.name)
+            layout.addWidget(tabs)
+        else:
+            layout.addWidget(self.browser_view.web_view)
         layout.setContentsMargins(0, 0, 0, 0)
         
         self.setCentralWidget(central_widget)
 
     def load_homepage(self):
-        home_url = "https://www.doubao.com/chat/25474120854203650"
-        self.browser_view.load_url(home_url)
-        self.terminal_panel.log("🌐 已加载首页：" + home_url)
+        if self.fanout and self.fanout.home_lane:
+            return  # 首页由扇出的 home 通道加载，主视图不再重复加载
+        self.browser_view.load_url(self.home_url)
+        self.terminal_panel.log("🌐 已加载首页：" + self.home_url)
 
     def toggle_main_window(self):
         """切换主窗口的大小（最小/正常）"""
@@ -1084,88 +4971,301 @@ class MinimalLightBrowser(QMainWindow):
             self.resize(1200, 800)
             self.activateWindow()
 
-    def on_send_message(self, text):
-        self.terminal_panel.log(f"📤 发送消息：{text}")
+    def on_reply_finished(self, text):
+        """回复完成后更新配置健康状态和回复缓存（后处理由 on_history_message 提交）"""
+        self.end_pending_message()
+        if self.serving_cached:
+            self.serving_cached = False
+            return
+        self.terminal_panel.log("⚙️ 脚本调度: " + self.browser_view.metrics_summary())
+        cache_key, self.pending_cache_key = self.pending_cache_key, None
+        cost = time.monotonic() - self.sent_at if self.sent_at else 0.0
+        slot = self.profile_slot
+        self.browser_view.call("throttleSignal", list(THROTTLE_PATTERNS),
+                               callback=lambda signal: self.on_throttle_checked(signal, slot, cache_key, text, cost),
+                               priority=PRIORITY_BACKGROUND)
+
+    def on_throttle_checked(self, signal, slot, cache_key, text, cost):
+        """根据页面的 429 响应和错误提示判断是否被限流，未限流的回复才计入健康状态和缓存"""
+        reason = throttle_reason(signal)
+        if reason:
+            self.terminal_panel.log(f"🚦 限流信号: {reason}")
+            if slot is self.profile_slot:
+                self.rotate_profile()
+            return
+        self.profile_pool.report_success(slot)
+        if cache_key and text:
+            self.reply_cache.put(cache_key, text, cost)
+
+    def cache_context(self, attachments, screen_digest):
+        """回复缓存键中的上下文：页面地址（去掉查询和片段）、扇出站点、截图画面摘要、附件内容摘要"""
+        url = self.browser_view.web_view.url().adjusted(QUrl.RemoveQuery | QUrl.RemoveFragment)
+        parts = [url.toString()]
+        if self.fanout:
+            parts.append(",".join(lane.name for lane in self.fanout.lanes))
+        parts.append(screen_digest)
+        for path, _ in attachments or []:
+            parts.append(file_digest(path) or f"{path}:?")
+        return "|".join(parts).encode("utf-8")
+
+    def serve_cached_reply(self, text, reply, cost):
+        """缓存命中：不经过页面，直接写入历史"""
+        self.terminal_panel.log(f"⚡ 命中回复缓存，跳过发送（原耗时 {cost:.1f}s）")
+        self.terminal_panel.log("📦 回复缓存: " + self.reply_cache.summary())
+        self.end_pending_message()
+        self.serving_cached = True
+        self.history_panel.add_message(text, is_user=True)
+        self.history_panel.add_message(reply, is_user=False, meta={'cached': True})
+        self.message_sent.emit(text)
+        # 保持与正常流程一致的异步完成语义
+        QTimer.singleShot(0, lambda: self.response_monitor.reply_finished.emit(reply))
+
+    def on_history_message(self, record):
+        """每条新增的回复（含缓存命中、扇出各站点、工作视图）都提交后处理"""
+        if not record.is_user:
+            self.post_processor.submit(record.uid, record.text)
+
+    def on_reply_processed(self, uid, meta):
+        if not self.history_panel.attach_metadata(uid, meta):
+            return
+        parts = [f"代码块 {len(meta['code_blocks'])}"]
+        if meta['languages']:
+            parts.append("语言 " + "/".join(meta['languages']))
+        if meta['keywords']:
+            parts.append("关键词 " + "、".join(meta['keywords'][:5]))
+        self.terminal_panel.log("🧩 后处理完成: " + ", ".join(parts))
+
+    def on_reply_process_failed(self, uid, error):
+        # 气泡保持纯文本显示
+        self.history_panel.pending_bubbles.pop(uid, None)
+        self.terminal_panel.log(f"⚠️ 回复后处理失败，按纯文本显示: {error}")
+
+    def on_user_input(self, text):
+        """悬浮输入栏提交：先展开斜杠命令模板，带上拖入/粘贴的附件；返回是否已发送"""
+        try:
+            text = self.templates.expand(text)
+        except TemplateError as e:
+            self.terminal_panel.log(f"❌ 模板错误: {e}")
+            return False
+        self.on_send_message(text, self.floating_chat.take_attachments())
+        return True
+
+    def on_send_message(self, text, attachments=None):
+        preview = text if len(text) <= 200 else f"{text[:200]}...（共 {len(text)} 字符）"
+        self.terminal_panel.log(f"📤 发送消息：{preview}")
+        # 附件归属于待完成的消息，直到消息结束才删除临时文件（重发时沿用同一列表）
+        attachments = attachments or []
+        if self.pending_attachments is not attachments:
+            self.release_attachments(self.pending_attachments)
+        self.pending_attachments = attachments
+        self.pending_cache_key = None
+        # 先截图再查缓存：画面摘要参与缓存键，画面变化后不会拿到针对旧画面的回复；
+        # 截好的图随后直接上传，不重复截取
+        screen_digest, image = self.screenshot_handler.capture_service.capture_with_digest()
+        if self.reply_cache:
+            key = ReplyCache.make_key(text, self.cache_context(attachments, screen_digest))
+            hit = self.reply_cache.get(key)
+            if hit:
+                self.serve_cached_reply(text, *hit)
+                return
+            self.pending_cache_key = key
+            self.terminal_panel.log("📦 回复缓存未命中: " + self.reply_cache.summary())
+        self.sent_at = time.monotonic()
+        self.pending_message = text
         self.floating_chat.set_enabled(False)
-        self.screenshot_handler.upload_screenshot(text, self.send_text)
+        if self.fanout:
+            if attachments:
+                self.terminal_panel.log("⚠️ 扇出模式暂不支持附件，仅发送文字")
+                self.release_attachments(attachments)
+            self.fanout.send(text, image)
+            return
+        self.response_monitor.begin(uuid.uuid4().hex)
+        after_screenshot = self.send_text
+        if attachments:
+            after_screenshot = lambda text: self.upload_attachments(text, attachments)
+        self.screenshot_handler.upload_screenshot(text, after_screenshot, self.response_monitor.token, image)
+
+    def upload_attachments(self, text, attachments):
+        """附件经本地附件服务并行上传到页面，全部放入后再发送文字"""
+        if self.attachment_server is None:
+            self.attachment_server = AttachmentServer.shared()
+            self.attachment_server.progress.connect(self.on_attachment_progress)
+        upload = {'text': text, 'attachments': attachments, 'started': time.monotonic(),
+                  'token': self.response_monitor.token}
+        batch = self.browser_view.attach_files(self.attachment_server, [path for path, _ in attachments],
+                                               lambda ok: self.on_attachments_uploaded(upload, ok), upload['token'])
+        sizes = [size for _, _, _, size in self.attachment_server.batches[batch]]
+        upload.update(batch=batch, sizes=sizes, sent=[0] * len(sizes))
+        self.attachment_upload = upload
+        self.terminal_panel.log(f"📎 上传 {len(sizes)} 个附件，共 {sum(sizes) / 1048576:.1f} MB")
+
+    def on_attachment_progress(self, batch, index, sent):
+        upload = self.attachment_upload
+        if not upload or upload['batch'] != batch:
+            return
+        upload['sent'][index] = sent
+        parts = []
+        for (path, _), done, size in zip(upload['attachments'], upload['sent'], upload['sizes']):
+            parts.append(f"{os.path.basename(path)} {done * 100 // max(size, 1)}%")
+        self.floating_chat.set_attachment_status("📎 " + ", ".join(parts))
+
+    def on_attachments_uploaded(self, upload, ok):
+        if self.attachment_upload is not upload:
+            return
+        self.attachment_upload = None
+        self.floating_chat.set_attachment_status(None)
+        elapsed = time.monotonic() - upload['started']
+        if ok:
+            self.terminal_panel.log(f"✅ 附件上传成功，用时 {elapsed:.1f}s")
+        else:
+            self.terminal_panel.log("⚠️ 附件上传失败，继续发送文字")
+        if not upload['token'].cancelled:
+            QTimer.singleShot(1500, lambda: upload['token'].cancelled or self.send_text(upload['text']))
+
+    def release_attachments(self, attachments):
+        """删除剪贴板图片生成的临时文件（可重复调用）"""
+        for path, temporary in attachments:
+            if temporary:
+                remove_quietly(path)
+
+    def end_pending_message(self):
+        """消息结束（完成、命中缓存、失败或放弃）：清除待重发状态并释放附件"""
+        self.pending_message = None
+        self.release_attachments(self.pending_attachments)
+        self.pending_attachments = []
 
     def send_text(self, text):
-        escaped = text.replace("\\", "\\\\").replace("'", "\\'").replace("\n", "\\n")
-        js_text = f"""
-        (function() {{
-            const selectors = [
-                'textarea[data-testid="chat_input_input"]',
-                'textarea.semi-input-textarea',
-                'textarea[placeholder*="发消息"]',
-                'textarea',
-                '[contenteditable="true"]',
-                '.chat-input',
-                '[class*="input"] textarea'
-            ];
-            let ta = null;
-            for (let sel of selectors) {{
-                const el = document.querySelector(sel);
-                if (el) {{
-                    ta = el;
-                    console.log('✅ 找到输入框:', sel);
-                    break;
-                }}
-            }}
-            if (!ta) {{
-                console.log('❌ 未找到输入框');
-                return false;
-            }}
-            ta.focus();
-            const nativeSetter = Object.getOwnPropertyDescriptor(HTMLTextAreaElement.prototype, 'value').set;
-            const inputEvt = new Event('input', {{ bubbles: true, composed: true }});
-            const setValue = value => {{
-                nativeSetter.call(ta, value);
-                ta.dispatchEvent(inputEvt);
-            }};
-            setValue('{escaped}');
-            ['input','change','keyup','keydown'].forEach(evt => {{
-                ta.dispatchEvent(new Event(evt, {{ bubbles: true, composed: true }}));
-            }});
-            setTimeout(() => {{
-                const sendSelectors = [
-                    'button[type="submit"]',
-                    'button[class*="send"]',
-                    '.send-button',
-                    'button[aria-label*="发送"]',
-                    'button[data-testid*="send"]',
-                    'button.semi-button'
-                ];
-                let btn = null;
-                for (let sel of sendSelectors) {{
-                    const el = document.querySelector(sel);
-                    if (el) {{
-                        btn = el;
-                        console.log('✅ 找到发送按钮:', sel);
-                        break;
-                    }}
-                }}
-                if (btn) {{
-                    btn.click();
-                    console.log('✅ 点击发送按钮');
-                }} else {{
-                    console.log('❌ 未找到发送按钮');
-                }}
-            }}, 300);
-            return true;
-        }})();
-        """
+        if self.ATTACH_PROMPT_CHARS and len(text) >= self.ATTACH_PROMPT_CHARS:
+            self.send_text_as_attachment(text)
+            return
+
+        large = len(text) >= self.LARGE_PROMPT_CHARS
+        started = time.perf_counter()
+
         def handle(result):
-            if result:
-                self.terminal_panel.log("✅ 文字发送成功")
-                self.response_monitor.user_check_count = 0
-                QTimer.singleShot(1000, lambda: self.response_monitor.check_user_message_appeared(text))
-            else:
-                self.terminal_panel.log("❌ 文字发送失败，重新启用输入框")
-                self.floating_chat.set_enabled(True)
-        self.browser_view.run_javascript(js_text, handle)
+            elapsed = (time.perf_counter() - started) * 1000
+            if large:
+                self.terminal_panel.log(f"⏱️ 大文本发送耗时: {elapsed:.0f} ms ({len(text)} 字符)")
+            self.after_text_sent(result, text)
+        if large:
+            # 大文本经 WebChannel 传递，不生成包含全文的脚本
+            self.browser_view.call_with_payload("sendText", text, True, callback=handle,
+                                                token=self.response_monitor.token, priority=PRIORITY_SEND)
+        else:
+            self.browser_view.call("sendText", text, False, callback=handle,
+                                   token=self.response_monitor.token, priority=PRIORITY_SEND)
+
+    def send_text_as_attachment(self, text):
+        """超长文本以 txt 附件上传，输入框只发送简短说明"""
+        self.terminal_panel.log(f"📎 文本过长 ({len(text)} 字符)，改为附件发送")
+        note = "请阅读附件 prompt.txt 中的完整内容并回答。"
+        token = self.response_monitor.token
+
+        def handle(result):
+            if not result:
+                self.terminal_panel.log("⚠️ 附件上传失败，回退为直接粘贴")
+                QTimer.singleShot(0, lambda: self.browser_view.call_with_payload(
+                    "sendText", text, True, callback=lambda ok: self.after_text_sent(ok, text),
+                    token=token, priority=PRIORITY_SEND))
+                return
+            QTimer.singleShot(1500, lambda: self.browser_view.call(
+                "sendText", note, False, callback=lambda ok: self.after_text_sent(ok, text, note),
+                token=token, priority=PRIORITY_SEND))
+
+        self.browser_view.attach_files(AttachmentServer.shared(),
+                                       [("prompt.txt", "text/plain", text.encode("utf-8"))], handle, token)
+
+    def after_text_sent(self, result, text, page_text=None):
+        """文字填入页面后的处理；text 为完整提示词，page_text 为实际填入输入框的文字（默认同 text）"""
+        if result:
+            self.terminal_panel.log("✅ 文字发送成功")
+            self.message_sent.emit(text)
+            self.response_monitor.user_check_count = 0
+            token = self.response_monitor.token
+            QTimer.singleShot(1000, lambda: token.cancelled
+                              or self.response_monitor.check_user_message_appeared(text, page_text))
+        else:
+            self.terminal_panel.log("❌ 文字发送失败，重新启用输入框")
+            self.end_pending_message()
+            self.floating_chat.set_enabled(True)
+            self.send_failed.emit()
+
+    def resend_pending_message(self):
+        """页面恢复后重新发送未完成的消息"""
+        if not self.pending_message:
+            return
+        attachments = self.pending_attachments
+        missing = [path for path, _ in attachments if not os.path.isfile(path)]
+        if missing:
+            self.terminal_panel.log("⚠️ 以下附件已不存在，重发时不再附带: "
+                                    + ", ".join(os.path.basename(path) for path in missing))
+            attachments[:] = [item for item in attachments if item[0] not in missing]
+        suffix = f"（含 {len(attachments)} 个附件）" if attachments else ""
+        self.terminal_panel.log("🔁 重新发送未完成的消息" + suffix)
+        self.on_send_message(self.pending_message, attachments)
+
+    def abort_pending_message(self):
+        """放弃未完成的消息并恢复输入"""
+        self.end_pending_message()
+        self.floating_chat.set_enabled(True)
+        self.send_failed.emit()
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    window = MinimalLightBrowser()
+    parser = argparse.ArgumentParser(description="MinimalLightBrowser")
+    parser.add_argument("--mock", action="store_true", help="使用本地模拟聊天站点代替真实网站")
+    parser.add_argument("--mock-rate", type=float, default=20.0, help="模拟站点每秒输出的 token 数")
+    parser.add_argument("--mock-tokens", type=int, default=120, help="模拟站点每条回复的 token 数")
+    parser.add_argument("--net-capture", action="store_true", help="回复正文直接取自网络流式响应，流结束即完成（未捕获到时回退为页面 DOM）")
+    parser.add_argument("--profiles", type=int, default=None, help="隔离浏览器配置数量（账号分流）")
+    parser.add_argument("--profile-strategy", choices=["round_robin", "least_loaded"], default=None)
+    parser.add_argument("--bench", type=int, default=0, metavar="N", help="运行 N 轮端到端基准测试后退出")
+    parser.add_argument("--bench-chars", default="200", metavar="CHARS",
+                        help="基准测试提示词长度，可用逗号分隔多个长度对比发送耗时（如 200,20000,100000,200000）")
+    parser.add_argument("--bench-net-compare", action="store_true",
+                        help="基准测试分别以页面 DOM 和网络回复流取正文各跑一遍，对比完成延迟与 CPU")
+    parser.add_argument("--attach-prompt-chars", type=int, default=None, metavar="N",
+                        help="超过 N 字符的提示词改为以 txt 附件发送")
+    parser.add_argument("--fanout", default=None, metavar="SITES",
+                        help="同一提示词并行发往多个站点（逗号分隔，home 为首页，其余见 sites.json）")
+    parser.add_argument("--fanout-mode", choices=["first", "all"], default=None)
+    parser.add_argument("--profile", action="store_true",
+                        help="性能分析模式：慢事件检测、栈采样，Ctrl+Shift+P 停止并导出 Chrome trace")
+    parser.add_argument("--frame-probe", action="store_true", help="统计悬浮窗帧耗时")
+    parser.add_argument("--reply-cache", type=float, default=None, metavar="TTL",
+                        help="启用回复缓存，TTL 为有效期（秒）")
+    args, qt_args = parser.parse_known_args()
+
+    if args.profile or MinimalLightBrowser.PROFILE_MODE:
+        MinimalLightBrowser.PROFILE_MODE = True
+        app = ProfilingApplication(sys.argv[:1] + qt_args)
+    else:
+        app = QApplication(sys.argv[:1] + qt_args)
+    home_url = None
+    if args.mock:
+        mock_server = MockChatServer(args.mock_rate, args.mock_tokens)
+        home_url = mock_server.start()
+    if args.net_capture or args.bench_net_compare:
+        NETWORK_CAPTURE_ORIGINS.add(site_origin(home_url or MinimalLightBrowser.DEFAULT_HOME_URL))
+    if args.profiles:
+        MinimalLightBrowser.PROFILE_POOL_SIZE = args.profiles
+    if args.profile_strategy:
+        MinimalLightBrowser.PROFILE_POOL_STRATEGY = args.profile_strategy
+    if args.reply_cache:
+        MinimalLightBrowser.REPLY_CACHE_TTL = args.reply_cache
+    if args.attach_prompt_chars:
+        MinimalLightBrowser.ATTACH_PROMPT_CHARS = args.attach_prompt_chars
+    if args.frame_probe:
+        MinimalLightBrowser.FRAME_PROBE = True
+    if args.fanout:
+        MinimalLightBrowser.FANOUT_SITES = [name for name in args.fanout.split(",") if name]
+    if args.fanout_mode:
+        MinimalLightBrowser.FANOUT_MODE = args.fanout_mode
+    window = MinimalLightBrowser(home_url)
+    if args.bench:
+        try:
+            sizes = [int(chars) for chars in args.bench_chars.split(",") if chars.strip()]
+        except ValueError:
+            parser.error("--bench-chars 须为逗号分隔的整数")
+        benchmark = BenchmarkRunner(window, args.bench, sizes, compare_net=args.bench_net_compare)
     # 不在这里显示主窗口，因为在 __init__ 中已经默认隐藏
     sys.exit(app.exec_())
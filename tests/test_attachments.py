@@ -0,0 +1,88 @@
+"""附件上传：页面从本地附件服务拉取内存中的文件；站点 CSP 禁止访问本机端口时退回 WebChannel 传送
+
+运行: python -m pytest -q tests/test_attachments.py
+无显示环境下以 offscreen 平台运行。
+"""
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtCore import QUrl  # noqa: E402
+from PyQt5.QtWebEngineWidgets import QWebEngineProfile  # noqa: E402
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+import main  # noqa: E402
+from main import AttachmentServer, BrowserView  # noqa: E402
+
+PAGE = """<!DOCTYPE html><html><head><meta charset="utf-8">{csp}</head>
+<body><input type="file" id="upload"></body></html>"""
+CSP = """<meta http-equiv="Content-Security-Policy" content="connect-src 'self'">"""
+
+
+def spin(app, done, timeout):
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    return done()
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = QApplication.instance() or QApplication(["test"])
+    main.app = app          # 保持引用，QApplication 被回收后无法再创建 WebEngine 页面
+    server = AttachmentServer.shared()
+    yield app
+    server.stop()
+    AttachmentServer.shared_instance = None
+
+
+@pytest.fixture(scope="module")
+def profile(app):
+    return QWebEngineProfile(app)        # 无痕配置，不占用其他测试使用的默认配置
+
+
+def load_page(app, profile, csp):
+    logs = []
+    view = BrowserView(profile, SimpleNamespace(log=logs.append))
+    loaded = []
+    view.web_view.loadFinished.connect(loaded.append)
+    view.web_view.setHtml(PAGE.format(csp=CSP if csp else ""), QUrl("https://chat.example/"))
+    assert spin(app, lambda: loaded, 30)
+    spin(app, lambda: False, 0.5)       # 等 WebChannel 就绪
+    return view, logs
+
+
+def attach(app, view, items):
+    results, picked, served = [], [], []
+    server = AttachmentServer.shared()
+    server.progress.connect(lambda batch, index, sent: served.append(sent))
+    view.attach_files(server, items, results.append)
+    assert spin(app, lambda: results, 30)
+    view.web_view.page().runJavaScript(
+        "Array.from(document.getElementById('upload').files).map(f => f.name + ':' + f.size).join(',')",
+        picked.append)
+    assert spin(app, lambda: picked, 10)
+    server.progress.disconnect()
+    return results[0], picked[0], served
+
+
+@pytest.mark.parametrize("csp", [False, True], ids=["open", "csp"])
+def test_in_memory_file_reaches_input(app, profile, csp):
+    view, logs = load_page(app, profile, csp)
+    data = "长文本".encode("utf-8") * 1000
+    ok, picked, served = attach(app, view, [("prompt.txt", "text/plain", data)])
+    assert ok
+    assert picked == f"prompt.txt:{len(data)}"
+    if csp:
+        assert not served                               # 页面访问不到本机端口
+        assert any("CSP" in line for line in logs)
+    else:
+        assert served and served[-1] == len(data)
+        assert not any("CSP" in line for line in logs)
+    assert not AttachmentServer.shared().batches        # 批次已释放
@@ -0,0 +1,146 @@
+"""自动化接口端到端测试：完整窗口 + 离线模拟聊天站点（--mock 所用的同一页面）
+
+运行: python -m pytest -q tests/test_automation_api.py
+无显示环境下以 offscreen 平台运行；每条消息要经过用户消息检测和回复轮询，整个文件约 30 s。
+"""
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+import main  # noqa: E402
+from main import MinimalLightBrowser, MockChatServer  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def spin(app, done, timeout):
+    """在主线程处理 Qt 事件，直到 done() 为真或超时"""
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    return done()
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp("automation"))     # browser_data 写到临时目录
+    app = QApplication.instance() or QApplication(["test"])
+    main.app = app
+    mock = MockChatServer(token_rate=200, reply_tokens=15)
+    port = free_port()
+    original_port = MinimalLightBrowser.AUTOMATION_PORT
+    MinimalLightBrowser.AUTOMATION_PORT = port
+    loaded = []
+    window = MinimalLightBrowser(mock.start())
+    window.browser_view.web_view.loadFinished.connect(loaded.append)
+    try:
+        assert spin(app, lambda: loaded, 30), "模拟页面未加载"
+        spin(app, lambda: False, 1)     # 等桥接脚本和 WebChannel 就绪
+        yield app, f"http://127.0.0.1:{port}", window
+    finally:
+        MinimalLightBrowser.AUTOMATION_PORT = original_port
+        window.automation_server.stop()
+        window.floating_chat.close()
+        window.close()
+        mock.stop()
+        os.chdir(cwd)
+
+
+def post_send(base, payload, client_id=None):
+    headers = {"Content-Type": "application/json"}
+    if client_id:
+        headers["X-Client-Id"] = client_id
+    request = urllib.request.Request(base + "/send", data=json.dumps(payload).encode("utf-8"), headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def read_stream(base, msg_id, events):
+    with urllib.request.urlopen(f"{base}/stream/{msg_id}", timeout=120) as resp:
+        event = None
+        for raw in resp:
+            line = raw.decode("utf-8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                events.append((event, json.loads(line[len("data: "):]), time.monotonic()))
+                if event in ("done", "error"):
+                    return
+
+
+def test_send_requires_client_id(api):
+    app, base, _ = api
+    assert post_send(base, {'text': "hi"}) == (400, {'error': 'missing_client_id'})
+
+
+def test_clients_are_served_round_robin_with_deltas(api):
+    """w 占用页面时 a 连发两条、b 发一条：按客户端轮流发送，顺序为 w, a1, b1, a2；
+    每条消息的增量拼起来等于最终回复，回复中的 emoji 不会让后续推送退化为全文替换"""
+    app, base, _ = api
+    streams = {}
+    threads = []
+
+    def client():
+        for name, client_id in [("w", "w"), ("a1", "a"), ("a2", "a"), ("b1", "b")]:
+            status, body = post_send(base, {'text': f"消息 {name}"}, client_id)
+            assert status == 202
+            events = streams[name] = []
+            thread = threading.Thread(target=read_stream, args=(base, body['id'], events), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+    submitter = threading.Thread(target=client, daemon=True)
+    submitter.start()
+    assert spin(app, lambda: not submitter.is_alive() and not any(t.is_alive() for t in threads), 120)
+
+    finished = {}
+    for name, events in streams.items():
+        kinds = [kind for kind, _, _ in events]
+        assert kinds[0] == "queued" and kinds[-1] == "done", (name, kinds)
+        assert "replace" not in kinds, name
+        text = "".join(data for kind, data, _ in events if kind == "delta")
+        done = events[-1][1]
+        assert text == done
+        assert "🚀" in done and "mock reply done" in done
+        finished[name] = events[-1][2]
+    assert sorted(finished, key=finished.get) == ["w", "a1", "b1", "a2"]
+
+
+def test_long_prompt_sent_as_attachment_keeps_full_text(api, monkeypatch):
+    """超长文本改为 prompt.txt 附件发送：页面上只有说明文字，历史记录和检测结果仍对应完整提示词"""
+    app, base, window = api
+    monkeypatch.setattr(window, "ATTACH_PROMPT_CHARS", 500)
+    detected = []
+    window.response_monitor.user_message_detected.connect(detected.append)
+    prompt = "长提示词 " + "x" * 600
+    status, body = post_send(base, {'text': prompt}, "long")
+    assert status == 202
+    events = []
+    reader = threading.Thread(target=read_stream, args=(base, body['id'], events), daemon=True)
+    reader.start()
+    assert spin(app, lambda: not reader.is_alive(), 60)
+    window.response_monitor.user_message_detected.disconnect(detected.append)
+    assert events[-1][0] == "done"
+    assert detected == [True]
+    user_texts = [record.text for record in window.history_panel.messages if record.is_user]
+    assert user_texts[-1] == prompt
@@ -0,0 +1,131 @@
+"""回复完成判定：各策略对页面信号序列的反应，以及引擎的站点选择、决策和精度/延迟统计
+
+运行: python -m pytest -q tests/test_completion.py
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+import main  # noqa: E402
+from main import (CompletionEngine, EndMarkerStrategy, QuiescenceStrategy, StableLengthStrategy,  # noqa: E402
+                  StopButtonStrategy, StreamClosedStrategy)
+
+
+def reply(length, **signals):
+    return dict(hasBot=True, replyLength=length, **signals)
+
+
+def run(strategy, probes):
+    """依次喂入信号，返回每次 update 的结果"""
+    strategy.reset()
+    return [bool(strategy.update(probe, 0.0)) for probe in probes]
+
+
+def test_stable_length():
+    strategy = StableLengthStrategy(readings=2)
+    probes = [reply(10), reply(10), reply(20), reply(20), reply(20)]
+    assert run(strategy, probes) == [False, False, False, False, True]
+
+
+def test_stable_length_waits_for_stop_button():
+    strategy = StableLengthStrategy(readings=1)
+    probes = [reply(10, stopVisible=True), reply(10, stopVisible=True), reply(10), reply(10)]
+    assert run(strategy, probes) == [False, False, False, True]
+
+
+def test_stable_length_ignores_empty_reply():
+    assert run(StableLengthStrategy(readings=1), [{'hasBot': False}] * 3 + [reply(0)] * 3) == [False] * 6
+
+
+def test_stop_button_must_appear_first():
+    strategy = StopButtonStrategy()
+    assert run(strategy, [reply(5), reply(5)]) == [False, False]
+    assert run(strategy, [reply(5, stopVisible=True), reply(8)]) == [False, True]
+
+
+def test_stream_closed_counts_from_baseline():
+    """上一轮留下的已关闭流不算数；没有流钩子（closedStreams 缺失）时不触发"""
+    strategy = StreamClosedStrategy()
+    probes = [reply(5, openStreams=1, closedStreams=3), reply(9, openStreams=0, closedStreams=4)]
+    assert run(strategy, probes) == [False, True]
+    assert run(strategy, [reply(5, openStreams=0, closedStreams=3)] * 2) == [False, False]
+    assert run(strategy, [reply(5)] * 2) == [False, False]
+
+
+def test_quiescence():
+    strategy = QuiescenceStrategy(idle_ms=1000)
+    probes = [reply(5, idleMs=999), reply(5, idleMs=1000, stopVisible=True), reply(5, idleMs=1000)]
+    assert run(strategy, probes) == [False, False, True]
+
+
+def test_end_marker_needs_new_marker():
+    strategy = EndMarkerStrategy("button.regenerate")
+    assert run(strategy, [reply(5, markerCount=2), reply(5, markerCount=2), reply(5, markerCount=3)]) == [
+        False, False, True]
+    assert run(strategy, [reply(5, markerCount=3), reply(0, markerCount=4)]) == [False, False]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(main.time, "perf_counter", lambda: now[0])
+    return now
+
+
+def test_engine_selects_strategies_by_site():
+    engine = CompletionEngine()
+    engine.reset("https://www.doubao.com/chat/123")
+    names = [strategy.name for strategy in engine.strategies]
+    assert names[0] == "stable_length" and "end_marker" in names
+    assert engine.marker_selector
+    engine.reset("https://example.org/")
+    assert [strategy.name for strategy in engine.strategies] == ["stable_length", "stop_button", "quiescence"]
+    assert engine.marker_selector is None
+
+
+def test_engine_decides_on_first_strategy_and_settles(clock):
+    """影子策略先触发不算完成；稳定期内回复继续变长时，先前触发的策略记为过早"""
+    engine = CompletionEngine()
+    engine.reset("https://example.org/")
+    engine.observe(reply(10, stopVisible=True))
+    clock[0] += 1
+    engine.observe(reply(20, idleMs=3000))          # quiescence 触发（影子），stop_button 也触发
+    assert not engine.is_complete()
+    for _ in range(3):
+        clock[0] += 1
+        engine.observe(reply(20))
+    assert engine.is_complete()                     # stable_length 第三次读数不变
+    engine.begin_settle(20)
+    assert engine.settle_due()                      # 三个策略都已触发，不必等满稳定期
+    assert engine.finalize()
+    assert not engine.finalize()                    # 只结算一次
+    stats = engine.stats
+    assert {name for _, name in stats} == {"stable_length", "stop_button", "quiescence"}
+    assert all(stat['premature'] == 0 for stat in stats.values())
+    assert stats[("https://example.org", "stable_length")]['latency'] == pytest.approx(3.0)
+    assert stats[("https://example.org", "quiescence")]['latency'] == pytest.approx(0.0)
+
+
+def test_engine_marks_premature(clock):
+    engine = CompletionEngine()
+    engine.reset("https://example.org/")
+    engine.observe(reply(10, stopVisible=True))
+    engine.observe(reply(10))                       # stop_button 触发时只有 10
+    for _ in range(3):
+        clock[0] += 1
+        engine.observe(reply(10))
+    engine.begin_settle(10)
+    clock[0] += 1
+    engine.observe({'hasBot': False})               # 稳定期内暂时取不到回复，不当作变短
+    engine.observe(reply(25))                       # 稳定期内又变长
+    clock[0] += CompletionEngine.SETTLE_SECONDS
+    assert engine.settle_due()
+    engine.finalize()
+    stat = engine.stats[("https://example.org", "stop_button")]
+    assert (stat['fired'], stat['premature']) == (1, 1)
+    assert "stop_button 过早" in engine.last_summary()
+    assert "quiescence 未触发" in engine.last_summary()
+    assert any("stable_length: 精度 0%" in line for line in engine.report())
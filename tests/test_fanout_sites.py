@@ -0,0 +1,53 @@
+"""扇出站点配置：sites.json 整体或个别条目无效时跳过并记录，不影响其余站点
+
+运行: python -m pytest -q tests/test_fanout_sites.py
+"""
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from main import FanoutCoordinator  # noqa: E402
+
+HOME = "https://www.doubao.com/chat/"
+
+
+def load(tmp_path, content):
+    (tmp_path / "sites.json").write_text(content, encoding='utf-8')
+    logs = []
+    window = SimpleNamespace(home_url=HOME, storage_path=str(tmp_path),
+                             terminal_panel=SimpleNamespace(log=logs.append))
+    return FanoutCoordinator.load_sites(window), logs
+
+
+def test_missing_file_gives_home_only(tmp_path):
+    window = SimpleNamespace(home_url=HOME, storage_path=str(tmp_path), terminal_panel=None)
+    assert FanoutCoordinator.load_sites(window) == {'home': {'url': HOME}}
+
+
+@pytest.mark.parametrize("content", ['[{"url": "https://a.example"}]', '"sites"', '42', 'null', '{bad json'])
+def test_whole_file_invalid(tmp_path, content):
+    sites, logs = load(tmp_path, content)
+    assert sites == {'home': {'url': HOME}}
+    assert len(logs) == 1 and "sites.json" in logs[0]
+
+
+def test_bad_entries_skipped(tmp_path):
+    good = {'url': "https://b.example/chat", 'selectors': {'input': "textarea"}}
+    sites, logs = load(tmp_path, json.dumps({
+        'no_url': {'selectors': {}},
+        'not_object': "https://a.example",
+        'null': None,
+        'url_not_string': {'url': 42},
+        'relative': {'url': "chat.example/"},
+        'bad_selectors': {'url': "https://c.example", 'selectors': ["textarea"]},
+        'good': good,
+    }))
+    assert sites == {'home': {'url': HOME}, 'good': good}
+    assert len(logs) == 6
+    for name in ('no_url', 'not_object', 'null', 'url_not_string', 'relative', 'bad_selectors'):
+        assert any(f"站点 {name} " in line for line in logs), name
@@ -0,0 +1,66 @@
+"""悬浮窗高度：面板展开/折叠和输入框增高/缩回后按底边锚定，并恢复原来的几何
+
+运行: python -m pytest -q tests/test_floating_window.py
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+import main  # noqa: E402
+from main import FloatingChatWindow, HistoryPanel, TerminalPanel  # noqa: E402
+
+
+def settle(app, seconds=0.1):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        app.processEvents()
+
+
+@pytest.fixture
+def window():
+    app = QApplication.instance() or QApplication(["test"])
+    main.app = app
+    history = HistoryPanel()
+    for index in range(50):
+        history.add_message(f"消息 {index} " + "内容 " * 20, is_user=index % 2 == 0)
+    window = FloatingChatWindow(lambda text: True, lambda: None, history, TerminalPanel())
+    window.show()
+    window.move_to_screen_bottom()
+    window.adjust_input_height()
+    settle(app)
+    yield app, window
+    window.close()
+
+
+def test_panel_toggle_keeps_bottom_and_restores(window):
+    app, window = window
+    start = window.geometry()
+    for panel in (window.history_panel, window.terminal_panel):
+        panel.toggle_visibility()
+        settle(app, 0.5)
+        expanded = window.geometry()
+        assert expanded.height() == start.height() + panel.expanded_height
+        assert expanded.bottom() == start.bottom()
+        panel.toggle_visibility()
+        settle(app, 0.5)
+        assert window.geometry() == start
+
+
+def test_input_grow_and_shrink_restores(window):
+    app, window = window
+    start = window.geometry()
+    window.chat_input.setPlainText("\n".join(["line"] * 8))
+    window.adjust_input_height()
+    settle(app)
+    grown = window.geometry()
+    assert grown.height() > start.height() and grown.bottom() == start.bottom()
+    window.chat_input.clear()
+    window.adjust_input_height()
+    settle(app)
+    assert window.geometry() == start
@@ -0,0 +1,120 @@
+"""历史记录导出/导入：JSONL 往返、按时间归并、筛选导出、Markdown 与 Parquet 格式
+
+运行: python -m pytest -q tests/test_history_io.py
+"""
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+import main  # noqa: E402
+from main import DateSeparator, HistoryPanel, MessageBubble, MessageRecord, write_messages  # noqa: E402
+
+BASE = datetime(2026, 3, 1, 9, 30, 15, 123456).timestamp()
+DAY = 86400
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = QApplication.instance() or QApplication(["test"])
+    main.app = app
+    return app
+
+
+def sample():
+    return [
+        MessageRecord("问题 1\n第二行 \"引号\" 😀", True, BASE),
+        MessageRecord("```python\nprint(1)\n```", False, BASE + 5),
+        MessageRecord("问题 2", True, BASE + DAY),
+        MessageRecord("回答 2", False, BASE + DAY + 5),
+    ]
+
+
+def fields(messages):
+    return [(msg.text, msg.is_user, msg.epoch) for msg in messages]
+
+
+def test_jsonl_round_trip(app, tmp_path):
+    path = str(tmp_path / "history.jsonl")
+    assert write_messages(path, iter(sample())) == 4
+    panel = HistoryPanel()
+    assert panel.import_messages(path) == 4
+    assert fields(panel.messages) == fields(sample())
+    assert panel.by_uid == {}                   # 导入的记录不进入后处理索引
+
+
+def test_import_merges_chronologically(app, tmp_path):
+    path = str(tmp_path / "history.jsonl")
+    records = sample()
+    write_messages(path, [records[0], records[2]])
+    panel = HistoryPanel()
+    panel.messages = [records[1], records[3]]
+    panel.import_messages(path)
+    assert [msg.text for msg in panel.messages] == [msg.text for msg in records]
+
+
+def test_import_renders_only_the_tail(app, tmp_path):
+    path = str(tmp_path / "history.jsonl")
+    write_messages(path, sample())
+    panel = HistoryPanel()
+    panel.import_messages(path, render_limit=3)
+    app.processEvents()
+    widgets = [panel.message_layout.itemAt(i).widget() for i in range(panel.message_layout.count())]
+    bubbles = [w for w in widgets if isinstance(w, MessageBubble)]
+    assert [bubble.record.text for bubble in bubbles] == [msg.text for msg in sample()[1:]]
+    assert sum(isinstance(w, DateSeparator) for w in widgets) == 2
+
+
+def test_filtered_export(app, tmp_path):
+    panel = HistoryPanel()
+    panel.messages = sample()
+    path = str(tmp_path / "bot.jsonl")
+    assert panel.export_messages(path, role='bot') == 2
+    start = datetime.fromtimestamp(BASE + DAY - 60)
+    assert [msg.text for msg in panel.iter_messages(start=start)] == ["问题 2", "回答 2"]
+    end = datetime.fromtimestamp(BASE + 1)
+    assert [msg.text for msg in panel.iter_messages(end=end, role='user')] == ["问题 1\n第二行 \"引号\" 😀"]
+    with open(path, encoding='utf-8') as f:
+        assert [json.loads(line)['is_user'] for line in f] == [False, False]
+
+
+def test_async_export(app, tmp_path):
+    panel = HistoryPanel()
+    panel.messages = sample()
+    finished = []
+    panel.on_export_finished = lambda *args: finished.append(args)     # 不弹出消息框
+    panel.export_finished.disconnect()
+    panel.export_finished.connect(panel.on_export_finished)
+    path = str(tmp_path / "async.jsonl")
+    assert panel.export_messages_async(path) == 4
+    deadline = time.monotonic() + 10
+    while not finished and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    assert finished == [(path, 4, "")]
+
+
+def test_markdown_export(tmp_path):
+    path = str(tmp_path / "history.md")
+    write_messages(path, sample())
+    with open(path, encoding='utf-8') as f:
+        content = f.read()
+    assert content.count("## 2026年03月") == 2           # 每个日期一个标题
+    assert content.index("**🧑 用户** 09:30:15") < content.index("**🤖 回复** 09:30:20")
+    assert "```python\nprint(1)\n```" in content
+
+
+def test_parquet_export(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    path = str(tmp_path / "history.parquet")
+    assert main.write_parquet(path, sample(), batch_size=3) == 4
+    table = pq.read_table(path).to_pydict()
+    assert table['text'] == [msg.text for msg in sample()]
+    assert table['is_user'] == [True, False, True, False]
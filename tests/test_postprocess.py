@@ -0,0 +1,106 @@
+"""回复后处理：代码块/语言/关键词/标题的提取，工作进程渲染 HTML 后替换气泡内容，失败时回报错误并保持纯文本
+
+运行: python -m pytest -q tests/test_postprocess.py
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtCore import Qt  # noqa: E402
+from PyQt5.QtWidgets import QApplication  # noqa: E402
+import main  # noqa: E402
+from main import HistoryPanel, ReplyPostProcessor, detect_language, postprocess_reply  # noqa: E402
+
+REPLY = "# 结果\n\n**要点**：见下\n\n```python\nprint('hi')\n```\n"
+
+
+def test_code_blocks_and_languages():
+    text = ("说明\n\n```Python title=x\nprint(1)\n```\n\n```\nconst f = () => console.log(1);\n```\n"
+            "\n```\n纯文本\n```\n")
+    meta = postprocess_reply(text)
+    assert [(b['language'], b['code']) for b in meta['code_blocks']] == [
+        ("python", "print(1)\n"),                         # 标注的语言转小写，忽略围栏上的其余内容
+        ("javascript", "const f = () => console.log(1);\n"),
+        (None, "纯文本\n"),                               # 猜不出语言
+    ]
+    assert meta['languages'] == ["javascript", "python"]
+    assert meta['length'] == len(text)
+
+
+@pytest.mark.parametrize("code, language", [
+    ("import os\ndef f(self):\n    print(1)", "python"),
+    ("SELECT a FROM t WHERE b = 1", "sql"),
+    ("#include <vector>\nstd::cout << 1;", "cpp"),
+    ("x", None),
+])
+def test_detect_language(code, language):
+    assert detect_language(code) == language
+
+
+def test_keywords_skip_code_and_stop_words():
+    text = ("缓存策略、缓存命中、缓存失效 the cache cache cache and eviction eviction\n"
+            "```python\nignored_identifier ignored_identifier ignored_identifier\n```\n"
+            "我们可以 我们可以")
+    keywords = postprocess_reply(text, top_keywords=4)['keywords']
+    assert keywords[:3] == ["cache", "缓存", "eviction"]    # 中文按相邻两字统计
+    assert not {"the", "and", "ignored_identifier", "我们", "可以"} & set(keywords)
+    assert len(keywords) == 4
+
+
+def test_headings():
+    assert postprocess_reply("# 一\n正文 # 不是标题\n### 三 ###\n####### 七")['headings'] == ["一", "三 ###"]
+
+
+@pytest.fixture(scope="module")
+def app():
+    app = QApplication.instance() or QApplication(["test"])
+    main.app = app
+    return app
+
+
+def spin(app, done, timeout):
+    deadline = time.monotonic() + timeout
+    while not done() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.01)
+    return done()
+
+
+def test_reply_bubble_switches_to_worker_html(app):
+    panel = HistoryPanel()
+    panel.add_message("问题", is_user=True)
+    record = panel.add_message(REPLY, is_user=False)
+    bubble = panel.pending_bubbles[record.uid]
+    assert bubble.msg_label.textFormat() == Qt.PlainText       # GUI 线程不解析 Markdown
+    assert panel.attach_metadata(record.uid, postprocess_reply(REPLY))
+    assert bubble.msg_label.textFormat() == Qt.RichText
+    assert "<h1" in bubble.msg_label.text()
+    assert 'html' not in record.meta                            # HTML 不随记录保存
+    assert record.uid not in panel.pending_bubbles
+
+
+def test_imported_replies_keep_markdown(app):
+    panel = HistoryPanel()
+    record = main.MessageRecord(REPLY, False, time.time())
+    bubble = panel.render_message(record)
+    assert bubble.msg_label.textFormat() == Qt.MarkdownText
+
+
+def test_worker_failure_is_reported(app):
+    processor = ReplyPostProcessor(max_workers=1)
+    results, failures = [], []
+    processor.processed.connect(lambda uid, meta: results.append(uid))
+    processor.failed.connect(lambda uid, error: failures.append((uid, error)))
+    try:
+        processor.submit(1, None)          # 非字符串：工作进程中抛出 TypeError
+        processor.submit(2, REPLY)
+        assert spin(app, lambda: failures and results, 60)
+    finally:
+        processor.shutdown()
+    assert failures[0][0] == 1 and "TypeError" in failures[0][1]
+    assert results == [2]
@@ -0,0 +1,86 @@
+"""回复缓存：键的组成、TTL/LRU、追加日志与压缩、损坏行的容错
+
+运行: python -m pytest -q tests/test_reply_cache.py
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+import main  # noqa: E402
+from main import ReplyCache, file_digest  # noqa: E402
+
+
+def test_key_normalizes_prompt():
+    assert ReplyCache.make_key("hello   world\n") == ReplyCache.make_key("hello world")
+    assert ReplyCache.make_key("ＡＢＣ") == ReplyCache.make_key("ABC")     # NFKC
+    assert ReplyCache.make_key("hello") != ReplyCache.make_key("hello!")
+
+
+def test_key_depends_on_context():
+    """截图摘要或附件内容不同，键也不同"""
+    assert ReplyCache.make_key("q", b"url|screen-a") != ReplyCache.make_key("q", b"url|screen-b")
+    assert ReplyCache.make_key("q", b"url|screen-a") == ReplyCache.make_key("q", b"url|screen-a")
+
+
+def test_file_digest_follows_content(tmp_path):
+    a, b = tmp_path / "a.txt", tmp_path / "b.txt"
+    a.write_bytes(b"same")
+    b.write_bytes(b"same")
+    assert file_digest(str(a)) == file_digest(str(b))
+    b.write_bytes(b"diff")
+    assert file_digest(str(a)) != file_digest(str(b))
+    assert file_digest(str(tmp_path / "missing")) is None
+
+
+def test_hit_miss_and_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "time", lambda: now[0])
+    cache = ReplyCache(str(tmp_path / "cache.jsonl"), ttl=60)
+    assert cache.get("k") is None
+    cache.put("k", "reply", 2.5)
+    assert cache.get("k") == ("reply", 2.5)
+    now[0] += 61
+    assert cache.get("k") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+    assert cache.saved_seconds == 2.5
+
+
+def test_lru_eviction(tmp_path):
+    cache = ReplyCache(str(tmp_path / "cache.jsonl"), ttl=60, max_entries=2)
+    cache.put("a", "1", 0)
+    cache.put("b", "2", 0)
+    cache.get("a")              # a 最近使用过，淘汰 b
+    cache.put("c", "3", 0)
+    assert list(cache.entries) == ["a", "c"]
+
+
+def test_persist_and_compact(tmp_path):
+    path = str(tmp_path / "cache.jsonl")
+    cache = ReplyCache(path, ttl=60, max_entries=2)
+    for index in range(3):
+        cache.put("k", f"reply {index}", 0)     # 同一键追加 3 行
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) == 3
+    for index in range(5):
+        cache.put(f"x{index}", "r", 0)
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) <= 2 * cache.max_entries + 1
+    reloaded = ReplyCache(path, ttl=60, max_entries=2)
+    assert list(reloaded.entries) == list(cache.entries)
+    with open(path, encoding='utf-8') as f:
+        assert len(f.readlines()) == len(reloaded.entries)     # 启动时已压缩
+
+
+def test_load_skips_bad_lines(tmp_path):
+    path = tmp_path / "cache.jsonl"
+    good = json.dumps(["k", "reply", 9e12, 1.0])
+    path.write_text("\n".join([
+        "not json", json.dumps(["short"]), json.dumps([1, "reply", 0, 0]),
+        json.dumps(["k2", "reply", "soon", 0]), good, '["half", "writ',
+    ]), encoding='utf-8')
+    cache = ReplyCache(str(path), ttl=1e13)
+    assert list(cache.entries) == ["k"]
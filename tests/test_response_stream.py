@@ -0,0 +1,118 @@
+"""回复增量推送：页面桥接脚本在 node 中运行（极简 DOM），由 ResponseMonitor 轮询
+
+运行: python -m pytest -q tests/test_response_stream.py
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtCore import QCoreApplication  # noqa: E402
+from main import PAGE_BRIDGE_JS, ResponseMonitor, to_js_literal  # noqa: E402
+
+NODE = shutil.which("node")
+pytestmark = pytest.mark.skipif(NODE is None, reason="需要 node 执行页面桥接脚本")
+
+# 只实现桥接脚本用到的 DOM 接口；每次改写回复都换一个新节点，相当于 MutationObserver 让缓存失效
+PAGE_SHIM = r"""
+globalThis.window = globalThis;
+globalThis.Node = { TEXT_NODE: 3, ELEMENT_NODE: 1 };
+globalThis.MutationObserver = class { observe() {} disconnect() {} };
+globalThis.XMLHttpRequest = function() {};
+XMLHttpRequest.prototype.send = function() {};
+globalThis.location = { hostname: 'mock.local', href: 'http://mock.local/' };
+let reply = null;
+globalThis.document = {
+    body: { textContent: '' },
+    querySelector: () => null,
+    querySelectorAll: sel => (reply && sel === 'div[data-testid="message_text_content"]') ? [reply] : []
+};
+globalThis.__setReply = function(text) {
+    reply = { nodeType: 1, tagName: 'DIV', className: 'markdown-body', getAttribute: () => null,
+              childNodes: [{ nodeType: 3, nodeValue: text }] };
+    return true;
+};
+"""
+
+LOOP = r"""
+require('readline').createInterface({ input: process.stdin }).on('line', line => {
+    let result = null;
+    try {
+        result = (0, eval)(JSON.parse(line));
+    } catch (error) {
+        result = null;
+    }
+    process.stdout.write(JSON.stringify(result === undefined ? null : result) + '\n');
+});
+"""
+
+
+class NodePage:
+    """代替 BrowserView：与 BrowserView.call 生成同样的脚本，交给 node 同步求值后回调"""
+    def __init__(self):
+        self.process = subprocess.Popen([NODE, "-e", PAGE_SHIM + PAGE_BRIDGE_JS + LOOP],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                        encoding="utf-8")
+
+    def evaluate(self, code):
+        self.process.stdin.write(json.dumps(code) + "\n")
+        self.process.stdin.flush()
+        return json.loads(self.process.stdout.readline())
+
+    def call(self, func_name, *args, callback=None, token=None, priority=None):
+        js_args = ", ".join(to_js_literal(arg) for arg in args)
+        result = self.evaluate(f"window.__mlb ? window.__mlb.{func_name}({js_args}) : null")
+        if callback and (token is None or not token.cancelled):
+            callback(result)
+
+    def set_reply(self, text):
+        self.evaluate(f"__setReply({to_js_literal(text)})")
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait(timeout=5)
+
+
+@pytest.fixture
+def monitor():
+    app = QCoreApplication.instance() or QCoreApplication([])  # noqa: F841
+    page = NodePage()
+    logs = SimpleNamespace(log=lambda message: None)
+    monitor = ResponseMonitor(page, logs, None, None)
+    events = []
+    monitor.reply_delta.connect(lambda delta: events.append(('delta', delta)))
+    monitor.reply_replaced.connect(lambda text: events.append(('replace', text)))
+    monitor.page, monitor.events = page, events
+    yield monitor
+    page.close()
+
+
+def tick(monitor, text):
+    monitor.page.set_reply(text)
+    monitor.check_response_complete()
+    events = list(monitor.events)
+    monitor.events.clear()
+    return events
+
+
+@pytest.mark.parametrize("emoji", ["😀", "👨‍👩‍👧", "中"])
+def test_deltas_after_astral_characters(monitor, emoji):
+    """emoji（UTF-16 代理对）之后仍只推送增量，内容不变的轮询什么也不推送"""
+    assert tick(monitor, "Hi " + emoji) == [('delta', "Hi " + emoji)]
+    assert tick(monitor, "Hi " + emoji) == []
+    assert tick(monitor, "Hi " + emoji + " there") == [('delta', " there")]
+    assert tick(monitor, "Hi " + emoji + " there") == []
+    assert monitor.streamed_text == "Hi " + emoji + " there"
+
+
+def test_rewrite_sends_replace(monitor):
+    """页面改写了已推送的内容时整体替换一次，之后恢复增量"""
+    tick(monitor, "😀 draft")
+    assert tick(monitor, "😀 final") == [('replace', "😀 final")]
+    assert tick(monitor, "😀 final!") == [('delta', "!")]
@@ -0,0 +1,132 @@
+"""定时任务：cron 表达式的解析与下次触发时间，无效任务定义在加载时被跳过，不会让调度器崩溃
+
+运行: python -m pytest -q tests/test_scheduler.py
+"""
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtCore import QCoreApplication  # noqa: E402
+from main import CronTrigger, JobScheduler, ScheduledJob  # noqa: E402
+
+
+@pytest.mark.parametrize("field, low, high, expected", [
+    ("*", 0, 6, set(range(7))),
+    ("*/15", 0, 59, {0, 15, 30, 45}),
+    ("5/20", 0, 59, {5, 25, 45}),           # a/n 从 a 起到上限
+    ("1-5", 0, 6, {1, 2, 3, 4, 5}),
+    ("10-20/5", 0, 59, {10, 15, 20}),
+    ("1,3,5-6", 1, 12, {1, 3, 5, 6}),
+    ("7", 0, 6, {0, 7}),                    # 周字段的 7 也是周日
+])
+def test_parse_field(field, low, high, expected):
+    assert CronTrigger.parse_field(field, low, high) == expected
+
+
+@pytest.mark.parametrize("expression", [
+    "* * * *", "* * * * * *", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *", "* * * * 8",
+    "5-1 * * * *", "*/0 * * * *", "a * * * *",
+])
+def test_invalid_expression(expression):
+    with pytest.raises(ValueError):
+        CronTrigger(expression)
+
+
+@pytest.mark.parametrize("expression, after, expected", [
+    ("0 9 * * 1-5", "2026-10-16 09:00", "2026-10-19 09:00"),    # 周五 9 点之后是下周一
+    ("*/15 * * * *", "2026-10-19 10:07:59", "2026-10-19 10:15"),
+    ("0 0 31 * *", "2026-04-01 00:00", "2026-05-31 00:00"),     # 跳过没有 31 日的月份
+    ("0 0 29 2 *", "2026-03-01 00:00", "2028-02-29 00:00"),     # 闰年
+    ("30 23 31 12 *", "2026-12-31 23:30", "2027-12-31 23:30"),  # 严格晚于 after，跨年
+    ("0 12 13 * 5", "2026-10-19 00:00", "2026-10-23 12:00"),    # 日和周都有限制时满足其一：周五
+    ("0 12 13 * 5", "2026-10-23 12:00", "2026-10-30 12:00"),
+    ("0 12 13 * 5", "2026-11-06 12:00", "2026-11-13 12:00"),    # 13 日（恰好也是周五）
+    ("0 0 * * 7", "2026-10-19 00:00", "2026-10-25 00:00"),      # 7 = 周日
+])
+def test_next_after(expression, after, expected):
+    after = datetime.fromisoformat(after)
+    assert CronTrigger(expression).next_after(after) == datetime.fromisoformat(expected)
+
+
+@pytest.mark.parametrize("expression", ["17 */5 * 2,7 *", "0 0 1,15 * 1", "45 6 * * 0,6", "*/7 3-4 28-31 * *"])
+def test_next_after_matches_minute_scan(expression):
+    """按天/小时跳跃的结果与逐分钟扫描一致"""
+    trigger = CronTrigger(expression)
+
+    def matches(t):
+        return (t.minute in trigger.minutes and t.hour in trigger.hours and t.month in trigger.months
+                and trigger.day_matches(t))
+    t = datetime(2026, 1, 30, 22, 58)
+    for _ in range(20):
+        expected = t + timedelta(minutes=1)
+        while not matches(expected):
+            expected += timedelta(minutes=1)
+        assert trigger.next_after(t) == expected
+        t = expected
+
+
+BAD_JOBS = [
+    {'name': 'feb31', 'cron': '0 0 31 2 *', 'prompt': 'x'},     # 永远不会触发
+    {'name': 'inf', 'every': 1e400, 'prompt': 'x'},             # float 溢出为 inf
+    {'name': 'far', 'every': 1e12, 'prompt': 'x'},              # 超出 datetime 范围
+]
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+class FakeSignal:
+    def connect(self, slot):
+        pass
+
+
+def fake_window(logs):
+    return SimpleNamespace(
+        terminal_panel=SimpleNamespace(log=logs.append),
+        response_monitor=SimpleNamespace(reply_finished=FakeSignal()),
+        send_failed=FakeSignal(),
+        automation_server=None,
+    )
+
+
+@pytest.mark.parametrize("spec", BAD_JOBS, ids=[job['name'] for job in BAD_JOBS])
+def test_bad_job_rejected_at_construction(spec):
+    with pytest.raises((ValueError, OverflowError)):
+        ScheduledJob(spec)
+
+
+@pytest.mark.parametrize("spec", BAD_JOBS, ids=[job['name'] for job in BAD_JOBS])
+def test_bad_job_skipped_on_load(app, tmp_path, spec):
+    good = {'name': 'good', 'every': 3600, 'prompt': 'hi'}
+    (tmp_path / "jobs.json").write_text(json.dumps([spec, good]), encoding='utf-8')
+    logs = []
+    scheduler = JobScheduler(fake_window(logs), str(tmp_path))
+    try:
+        assert set(scheduler.jobs) == {'good'}
+        assert set(scheduler.next_runs) == {'good'}
+        assert any(spec['name'] in line for line in logs)
+    finally:
+        scheduler.timer.stop()
+
+
+def test_bad_job_skipped_on_reload(app, tmp_path):
+    """热加载时遇到无效任务同样跳过，保留有效任务"""
+    jobs_path = tmp_path / "jobs.json"
+    jobs_path.write_text(json.dumps([{'name': 'good', 'every': 60, 'prompt': 'hi'}]), encoding='utf-8')
+    logs = []
+    scheduler = JobScheduler(fake_window(logs), str(tmp_path))
+    try:
+        jobs_path.write_text(json.dumps(BAD_JOBS + [{'name': 'good', 'every': 60, 'prompt': 'hi'}]),
+                             encoding='utf-8')
+        scheduler.load_jobs()
+        assert set(scheduler.jobs) == {'good'}
+    finally:
+        scheduler.timer.stop()
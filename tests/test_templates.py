@@ -0,0 +1,73 @@
+"""提示词模板：占位符、默认值、花括号转义，以及输入栏斜杠命令的展开
+
+运行: python -m pytest -q tests/test_templates.py
+"""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from PyQt5.QtCore import QCoreApplication  # noqa: E402
+from main import PromptTemplate, TemplateError, TemplateLibrary  # noqa: E402
+
+
+def render(source, **values):
+    return PromptTemplate("t", source).render(values)
+
+
+def test_placeholders_and_defaults():
+    template = PromptTemplate("t", "把 {{ text }} 译成 {{lang|英文}}，再说一次 {{text}}")
+    assert template.variables == ["text", "lang"]
+    assert template.render({'text': "你好"}) == "把 你好 译成 英文，再说一次 你好"
+    assert template.render({'text': "你好", 'lang': "日文"}) == "把 你好 译成 日文，再说一次 你好"
+
+
+def test_missing_variable():
+    with pytest.raises(TemplateError):
+        render("{{a}}")
+
+
+@pytest.mark.parametrize("source, expected", [
+    ("code {{{{ {a} }}}}", "code {{ {a} }}"),
+    ("{{{{name}}}} = {{name}}", "{{name}} = X"),
+    ("{{{name}}}", "{X}"),
+    ("a }} b", "a }} b"),
+    ("{{{{{{{{", "{{{{"),
+])
+def test_brace_escapes(source, expected):
+    assert render(source, name="X") == expected
+
+
+@pytest.mark.parametrize("source", ["{{ {a} }}", "{{1x}}", "text {{", "{{a|b}"])
+def test_unparsable_placeholder(source):
+    with pytest.raises(TemplateError):
+        PromptTemplate("t", source)
+
+
+@pytest.fixture
+def library(tmp_path):
+    app = QCoreApplication.instance() or QCoreApplication([])  # noqa: F841
+    (tmp_path / "tr.txt").write_text("[{{lang|英文}}] {{input}}", encoding="utf-8")
+    logs = []
+    library = TemplateLibrary(str(tmp_path), SimpleNamespace(log=logs.append))
+    assert "tr" in library.templates, logs
+    return library
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("/tr hello", "[英文] hello"),
+    ("/tr lang=日文 -- hello world", "[日文] hello world"),
+    ("/tr lang=日文 --", "[日文] "),
+    ("/tr -- x=1 is the answer", "[英文] x=1 is the answer"),
+    ("/tr x=1 is the answer", "[英文] x=1 is the answer"),       # 没有 -- 时不解析变量
+    ("/tr lang=日文 hello -- world", "[英文] lang=日文 hello -- world"),
+    ("/tr a=1 --flag", "[英文] a=1 --flag"),
+    ("/tr 第一行\n  第二行", "[英文] 第一行\n  第二行"),
+    ("/unknown x", "/unknown x"),
+    ("plain text", "plain text"),
+])
+def test_expand(library, text, expected):
+    assert library.expand(text) == expected
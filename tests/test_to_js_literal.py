@@ -0,0 +1,159 @@
+"""to_js_literal 模糊测试与大载荷基准
+
+运行: python -m pytest -q tests/test_to_js_literal.py -s
+单独看基准数据: python tests/test_to_js_literal.py
+"""
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip("PyQt5.QtWebEngineWidgets")
+from main import to_js_literal  # noqa: E402
+
+NODE = shutil.which("node")
+
+# 容易出问题的字符：JS 行终止符、script 结束标签、引号与反斜杠、控制字符、孤立代理项、BOM、组合字符
+SPECIAL = ["\u2028", "\u2029", "</script>", "</", "\"", "\\", "'", "`", "${x}", "\n", "\r", "\t",
+           "\x00", "\x1f", "\x7f", "\ud800", "\udfff", "\ufeff", "\u0301", "😀", "中文"]
+
+
+def random_text(rng, max_len=64):
+    parts = []
+    for _ in range(rng.randint(0, max_len)):
+        roll = rng.random()
+        if roll < 0.2:
+            parts.append(rng.choice(SPECIAL))
+        elif roll < 0.5:
+            parts.append(chr(rng.randint(0x20, 0x7e)))
+        else:
+            parts.append(chr(rng.randint(0, 0x10ffff)))
+    return "".join(parts)
+
+
+def random_value(rng, depth=0):
+    roll = rng.random()
+    if depth > 2 or roll < 0.6:
+        return random_text(rng)
+    if roll < 0.8:
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return {random_text(rng, 8): random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))}
+
+
+def fuzz_cases(count=3000, seed=20261019):
+    rng = random.Random(seed)
+    cases = [random_value(rng) for _ in range(count)]
+    cases.extend(SPECIAL)
+    cases.append("".join(SPECIAL) * 10)
+    return cases
+
+
+def as_js_string(value):
+    """JS 字符串是 UTF-16：相邻的高低代理项在 JS 中就是一个字符，比较前按同样方式合并"""
+    if isinstance(value, str):
+        return value.encode("utf-16-le", "surrogatepass").decode("utf-16-le", "surrogatepass")
+    if isinstance(value, list):
+        return [as_js_string(v) for v in value]
+    if isinstance(value, dict):
+        return {as_js_string(k): as_js_string(v) for k, v in value.items()}
+    return value
+
+
+def assert_safe(literal):
+    assert "\u2028" not in literal
+    assert "\u2029" not in literal
+    assert "</" not in literal
+    literal.encode("utf-8")     # 不能含孤立代理项，否则无法传给 QtWebEngine
+
+
+def test_fuzz_roundtrip_python():
+    for value in fuzz_cases():
+        literal = to_js_literal(value)
+        assert_safe(literal)
+        assert json.loads(literal) == as_js_string(value)
+
+
+@pytest.mark.skipif(NODE is None, reason="需要 node 执行生成的 JS")
+def test_fuzz_roundtrip_node():
+    """在真实 JS 引擎中求值，确认得到的值与原值一致"""
+    cases = fuzz_cases(count=1000, seed=7)
+    source = "const cases = [\n" + ",\n".join(to_js_literal(v) for v in cases) + "\n];\n" \
+             "process.stdout.write(JSON.stringify(cases));\n"
+    with tempfile.NamedTemporaryFile("w", suffix=".js", encoding="utf-8", delete=False) as f:
+        f.write(source)
+    try:
+        output = subprocess.run([NODE, f.name], capture_output=True, check=True).stdout
+    finally:
+        os.remove(f.name)
+    assert json.loads(output.decode("utf-8")) == as_js_string(cases)
+
+
+def large_payload(size=100 * 1024):
+    rng = random.Random(1)
+    alphabet = "abcdefghij 中文回复测试\n\"\\</\u2028"
+    return "".join(rng.choice(alphabet) for _ in range(size))
+
+
+def bench_encode(payload, rounds=20):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        to_js_literal(payload)
+    return (time.perf_counter() - started) / rounds * 1000
+
+
+def bench_node_compile(payload, rounds=50):
+    """对比：脚本内嵌 100 KB 字面量 vs 只携带载荷 ID 的脚本，在 node 中每次编译执行的耗时 (ms)"""
+    embedded = f"window.__mlb ? window.__mlb.sendText({to_js_literal(payload)}, true) : null"
+    by_id = ("window.__mlb ? window.__mlb.withPayload(\"0123456789abcdef0123456789abcdef\", "
+             "\"sendText\", [true]) : null")
+    script = (
+        "const window = { __mlb: { sendText: () => true, withPayload: () => true } };\n"
+        "const sources = JSON.parse(require('fs').readFileSync(0, 'utf8'));\n"
+        f"const rounds = {rounds};\n"
+        "const result = {};\n"
+        "for (const [name, src] of Object.entries(sources)) {\n"
+        "  const t = process.hrtime.bigint();\n"
+        "  for (let i = 0; i < rounds; i++) { (0, eval)(src + ' //' + i); }\n"
+        "  result[name] = Number(process.hrtime.bigint() - t) / 1e6 / rounds;\n"
+        "}\n"
+        "process.stdout.write(JSON.stringify(result));\n"
+    )
+    sources = json.dumps({'embedded': embedded, 'by_id': by_id})
+    output = subprocess.run([NODE, "-e", script], input=sources.encode("utf-8"),
+                            capture_output=True, check=True).stdout
+    result = json.loads(output)
+    result['embedded_bytes'] = len(embedded.encode("utf-8"))
+    result['by_id_bytes'] = len(by_id.encode("utf-8"))
+    return result
+
+
+def test_large_payload_benchmark():
+    payload = large_payload()
+    encode_ms = bench_encode(payload)
+    print(f"\nto_js_literal 100 KB: {encode_ms:.2f} ms/次")
+    assert encode_ms < 50
+    assert json.loads(to_js_literal(payload)) == payload
+
+
+@pytest.mark.skipif(NODE is None, reason="需要 node 测量脚本编译耗时")
+def test_payload_channel_script_size():
+    """WebChannel 通道下每次调用的脚本源码与载荷大小无关"""
+    result = bench_node_compile(large_payload())
+    print(f"\n内嵌字面量: {result['embedded_bytes']} B, {result['embedded']:.3f} ms/次; "
+          f"载荷 ID: {result['by_id_bytes']} B, {result['by_id']:.3f} ms/次")
+    assert result['by_id_bytes'] < 200
+    assert result['by_id'] < result['embedded']
+
+
+if __name__ == "__main__":
+    payload = large_payload()
+    print(f"to_js_literal 100 KB: {bench_encode(payload):.2f} ms/次")
+    if NODE:
+        print(json.dumps(bench_node_compile(payload), ensure_ascii=False))